@@ -0,0 +1,252 @@
+"""
+Compact binary store for CoreNLP annotations
+
+Holds only what the pipeline uses from the CoreNLP output - lemmas, token
+character offsets and parse trees - as array-backed columns in a single
+file per document, which is memory-mapped for reading.
+
+File layout (all integers are little-endian int32 or uint32):
+
+    header          magic, n_sents, n_tokens, n_lemma_bytes, n_parse_bytes
+    sent_starts     index of first token of each sentence, plus n_tokens
+    begins          character offset of begin of each token
+    ends            character offset of end of each token
+    lemma_starts    byte offset of each lemma, plus n_lemma_bytes
+    parse_starts    byte offset of each parse, plus n_parse_bytes
+    lemmas          utf-8 encoded lemmas
+    parses          utf-8 encoded parse trees
+
+Missing lemmas and parse trees (None), e.g. in output of CoreNLP without the
+lemma or parse annotator, are stored as empty strings and read as None.
+
+Also defines an even smaller offset index, holding only the token offsets
+(and hence the sentence offsets) of a document:
+
+    header          magic, n_sents, n_tokens
+    sent_starts     index of first token of each sentence, plus n_tokens
+    begins          character offset of begin of each token
+    ends            character offset of end of each token
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from pathlib import Path
+
+MAGIC = b'BLNANN01'
+HEADER = struct.Struct('<8sIIII')
+EXT = '.ann'
+
+INDEX_MAGIC = b'BLNIDX01'
+INDEX_HEADER = struct.Struct('<8sII')
+INDEX_EXT = '.idx'
+
+Sentence = namedtuple('Sentence', 'lemmas begins ends parse')
+
+
+def _int_array(values):
+    a = array('i', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tobytes()
+
+
+def _encode(s):
+    return b'' if s is None else s.encode('utf-8')
+
+
+def write_store(store_fname, sentences):
+    """
+    Write sentences, each a Sentence tuple, to annotation store file
+    """
+    sent_starts = [0]
+    begins = []
+    ends = []
+    lemma_starts = [0]
+    parse_starts = [0]
+    lemma_bytes = []
+    parse_bytes = []
+
+    for sent in sentences:
+        begins.extend(sent.begins)
+        ends.extend(sent.ends)
+        sent_starts.append(len(begins))
+
+        for lemma in sent.lemmas:
+            lemma_bytes.append(_encode(lemma))
+            lemma_starts.append(lemma_starts[-1] + len(lemma_bytes[-1]))
+
+        parse_bytes.append(_encode(sent.parse))
+        parse_starts.append(parse_starts[-1] + len(parse_bytes[-1]))
+
+    header = HEADER.pack(MAGIC, len(sent_starts) - 1, len(begins),
+                         lemma_starts[-1], parse_starts[-1])
+    store_fname = Path(store_fname)
+    tmp_fname = store_fname.with_name(store_fname.name + '.tmp')
+
+    with tmp_fname.open('wb') as outf:
+        outf.write(header)
+
+        for values in sent_starts, begins, ends, lemma_starts, parse_starts:
+            outf.write(_int_array(values))
+
+        outf.writelines(lemma_bytes)
+        outf.writelines(parse_bytes)
+
+    tmp_fname.replace(store_fname)
+
+
+class AnnotationStore:
+    """
+    Memory-mapped annotation store with random access to sentences
+    """
+
+    def __init__(self, store_fname):
+        with Path(store_fname).open('rb') as inf:
+            self._mm = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_sents, n_tokens, n_lemma_bytes, n_parse_bytes = \
+            HEADER.unpack_from(self._mm)
+
+        if magic != MAGIC:
+            raise ValueError('not an annotation store: {}'.format(store_fname))
+
+        self._n_sents = n_sents
+        offset = HEADER.size
+        columns = []
+
+        for size in n_sents + 1, n_tokens, n_tokens, n_tokens + 1, n_sents + 1:
+            columns.append(self._ints(offset, size))
+            offset += 4 * size
+
+        (self._sent_starts, self._begins, self._ends,
+         self._lemma_starts, self._parse_starts) = columns
+        self._lemma_offset = offset
+        self._parse_offset = offset + n_lemma_bytes
+
+    def _ints(self, offset, size):
+        view = memoryview(self._mm)[offset:offset + 4 * size]
+        if sys.byteorder == 'little':
+            return view.cast('i')
+        a = array('i', view)
+        a.byteswap()
+        return a
+
+    def __len__(self):
+        return self._n_sents
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._n_sents
+        if not 0 <= i < self._n_sents:
+            raise IndexError('sentence index out of range')
+        return Sentence(self.lemmas(i), self.begins(i), self.ends(i),
+                        self.parse(i))
+
+    def __iter__(self):
+        for i in range(self._n_sents):
+            yield self[i]
+
+    def begins(self, i):
+        return self._begins[self._sent_starts[i]:
+                            self._sent_starts[i + 1]].tolist()
+
+    def ends(self, i):
+        return self._ends[self._sent_starts[i]:
+                          self._sent_starts[i + 1]].tolist()
+
+    def lemmas(self, i):
+        starts = self._lemma_starts
+        offset = self._lemma_offset
+        mm = self._mm
+        return [mm[offset + starts[j]:offset + starts[j + 1]].decode('utf-8')
+                or None
+                for j in range(self._sent_starts[i], self._sent_starts[i + 1])]
+
+    def parse(self, i):
+        starts = self._parse_starts
+        offset = self._parse_offset
+        return self._mm[offset + starts[i]:
+                        offset + starts[i + 1]].decode('utf-8') or None
+
+    def close(self):
+        for column in (self._sent_starts, self._begins, self._ends,
+                       self._lemma_starts, self._parse_starts):
+            if isinstance(column, memoryview):
+                column.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_index(index_fname, sentences):
+    """
+    Write token offsets of sentences, each a Sentence tuple, to offset index
+    file
+    """
+    sent_starts = [0]
+    begins = []
+    ends = []
+
+    for sent in sentences:
+        begins.extend(sent.begins)
+        ends.extend(sent.ends)
+        sent_starts.append(len(begins))
+
+    header = INDEX_HEADER.pack(INDEX_MAGIC, len(sent_starts) - 1, len(begins))
+    index_fname = Path(index_fname)
+    tmp_fname = index_fname.with_name(index_fname.name + '.tmp')
+
+    with tmp_fname.open('wb') as outf:
+        outf.write(header)
+
+        for values in sent_starts, begins, ends:
+            outf.write(_int_array(values))
+
+    tmp_fname.replace(index_fname)
+
+
+class OffsetIndex:
+    """
+    Token and sentence offsets of a document, loaded from an offset index
+    """
+
+    def __init__(self, index_fname):
+        data = Path(index_fname).read_bytes()
+        magic, n_sents, n_tokens = INDEX_HEADER.unpack_from(data)
+
+        if magic != INDEX_MAGIC:
+            raise ValueError('not an offset index: {}'.format(index_fname))
+
+        ints = array('i')
+        ints.frombytes(data[INDEX_HEADER.size:])
+        if sys.byteorder != 'little':
+            ints.byteswap()
+
+        self._sent_starts = ints[:n_sents + 1]
+        self._begins = ints[n_sents + 1:n_sents + 1 + n_tokens]
+        self._ends = ints[n_sents + 1 + n_tokens:]
+
+    def __len__(self):
+        return len(self._sent_starts) - 1
+
+    def begins(self, i):
+        return self._begins[self._sent_starts[i]:
+                            self._sent_starts[i + 1]].tolist()
+
+    def ends(self, i):
+        return self._ends[self._sent_starts[i]:
+                          self._sent_starts[i + 1]].tolist()
+
+    def sentence_offsets(self, i):
+        """
+        Return begin and end character offset of sentence i
+        """
+        return (self._begins[self._sent_starts[i]],
+                self._ends[self._sent_starts[i + 1] - 1])
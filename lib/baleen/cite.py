@@ -2,9 +2,17 @@
 citations
 """
 
+import json
 import logging
+import pickle
+import random
+import sqlite3
+import time
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from threading import Lock
 
-import pickleshare
 import requests
 from pathlib import Path
 
@@ -14,21 +22,416 @@ log = logging.getLogger(__name__)
 logging.getLogger("requests.packages.urllib3.connectionpool").setLevel(
     logging.WARNING)
 
+DOI_URL = 'http://dx.doi.org/'
+ISSN_URL = 'http://api.crossref.org/journals/'
+CITATION_STYLE = 'chicago-fullnote-bibliography'
+# max number of concurrent requests
+CONCURRENCY = 8
+# max number of requests per second (0 means no limit)
+RATE_LIMIT = 10
+# max number of attempts per request
+ATTEMPTS = 10
+# base and max delay in seconds between attempts, which grows exponentially
+BACKOFF = 0.5
+MAX_BACKOFF = 60
+# timeout in seconds for connecting to and reading from server
+TIMEOUT = 30
+# statuses of responses to requests which are worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# name of database file in cache dir
+CACHE_FILE = 'cache.sqlite'
+# days before a lookup that failed with a client error (e.g. 404) is retried
+FAILURE_TTL = 30
+
+
+class Fetcher:
+    """
+    Client for CrossRef requests with keep-alive connection pooling, a rate
+    limit and retries with exponential backoff
+
+    Failed requests are retried after a random delay of up to
+    backoff * 2 ** attempt seconds (but at most max_backoff), or after the
+    delay asked for by the Retry-After header of the response, if longer.
+    Requests are not retried if Retry-After asks for more than max_backoff
+    seconds, nor if the response has a client error other than 429. A
+    Fetcher can be shared by threads.
+
+    Parameters
+    ----------
+    concurrency : int
+        max number of concurrent requests, which is the number of pooled
+        connections
+    rate_limit : float
+        max number of requests per second (0 means no limit)
+    attempts : int
+        max number of attempts per request
+    backoff : float
+        base delay between attempts in seconds
+    max_backoff : float
+        max delay between attempts in seconds
+    doi_url : str
+        base url for DOI requests
+    issn_url : str
+        base url for ISSN requests
+    """
+
+    def __init__(self, concurrency=CONCURRENCY, rate_limit=RATE_LIMIT,
+                 attempts=ATTEMPTS, backoff=BACKOFF, max_backoff=MAX_BACKOFF,
+                 doi_url=DOI_URL, issn_url=ISSN_URL):
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.doi_url = doi_url
+        self.issn_url = issn_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = Lock()
+        self._next_request = 0.0
+
+    def get(self, url, headers=None):
+        """
+        Request url, retrying on failure
+
+        Returns the last response, or None if no response was received.
+        """
+        response = None
+
+        for attempt in range(self.attempts):
+            self._wait_turn()
+
+            try:
+                response = self.session.get(url, headers=headers,
+                                            timeout=TIMEOUT)
+            except requests.exceptions.RequestException as err:
+                log.warning('request for {} failed: {}'.format(url, err))
+                response = None
+                delay = self._delay(attempt)
+            else:
+                if response.ok or response.status_code not in RETRY_STATUSES:
+                    return response
+
+                retry_after = _retry_after(response)
+
+                if retry_after > self.max_backoff:
+                    log.warning('giving up on request for {}, which asks to '
+                                'retry after {:.0f}s'.format(url, retry_after))
+                    return response
+
+                delay = max(self._delay(attempt), retry_after)
+
+            if attempt < self.attempts - 1:
+                time.sleep(delay)
+
+        return response
+
+    def _delay(self, attempt):
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def _wait_turn(self):
+        if not self.rate_limit:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            turn = max(now, self._next_request)
+            self._next_request = turn + 1.0 / self.rate_limit
+
+        time.sleep(turn - now)
+
+
+class FetchError(Exception):
+    """
+    Failed request, where status is the HTTP status of the response, or None
+    if no response was received
+    """
+
+    def __init__(self, status, reason):
+        super().__init__('{} {}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+
+
+def is_permanent(status):
+    """
+    Return true if a request failing with status is not worth retrying soon
+    """
+    return (status is not None and 400 <= status < 500 and
+            status not in RETRY_STATUSES)
+
+
+def _retry_after(response):
+    """
+    Return delay in seconds asked for by Retry-After header of response
+    """
+    value = response.headers.get('Retry-After')
+
+    if not value:
+        return 0
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+_default_fetcher = None
+
+
+def default_fetcher():
+    """
+    Return Fetcher with default settings shared by lookups of single items
+    """
+    global _default_fetcher
+
+    if _default_fetcher is None:
+        _default_fetcher = Fetcher()
+
+    return _default_fetcher
 
-def get_cache(cache_dir):
-    # The reason to use pickleshare is that it uses a separate pickle file
-    # for each key (i.e. doi), so if the process crashes, at least most of the
-    # looked up citations/metadata is saved to file
+
+def _get_fetcher(fetcher, attempts):
+    if fetcher is not None:
+        return fetcher
+    elif attempts == ATTEMPTS:
+        return default_fetcher()
+    else:
+        return Fetcher(attempts=attempts)
+
+
+class MetadataCache(MutableMapping):
+    """
+    Persistent mapping of keys (DOIs or ISSNs) to JSON-serializable values
+    in an SQLite database
+
+    Every put is committed at once, so if the process crashes, at least most
+    of the looked up citations/metadata is saved. The database is in WAL
+    mode, so it is safe for use by multiple processes.
+
+    Failed lookups are recorded too. Keys whose lookup failed with a client
+    error (see is_permanent) less than failure_ttl days ago count as failed,
+    so they are not looked up again until then.
+
+    If the database is new and migrate_dir holds a pickleshare cache (one
+    pickle file per key), its items are copied into the database.
+    """
+
+    def __init__(self, cache_file, migrate_dir=None, failure_ttl=FAILURE_TTL):
+        self.failure_ttl = failure_ttl
+        self.conn = sqlite3.connect(str(cache_file), timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # commits in WAL mode survive a crash of the process without fsync
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # lock the database so no other process creates or migrates it too
+        self.conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            exists = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'items'").fetchone()
+
+            if not exists:
+                self.conn.execute('CREATE TABLE items '
+                                  '(key TEXT PRIMARY KEY, value TEXT)')
+                if migrate_dir:
+                    self._migrate_pickleshare(migrate_dir)
+
+            self.conn.execute('CREATE TABLE IF NOT EXISTS failures '
+                              '(key TEXT PRIMARY KEY, status INTEGER, '
+                              'reason TEXT, count INTEGER, time REAL)')
+        except:
+            self.conn.rollback()
+            raise
+
+        self.conn.commit()
+
+    def _migrate_pickleshare(self, cache_dir):
+        cache_path = Path(cache_dir)
+        count = 0
+
+        def items():
+            nonlocal count
+
+            for path in sorted(cache_path.rglob('*')):
+                if not path.is_file() or path.name.startswith(CACHE_FILE):
+                    continue
+                try:
+                    with path.open('rb') as inf:
+                        value = pickle.load(inf)
+                except Exception as err:
+                    log.warning('skipping unreadable pickleshare file {}: '
+                                '{}'.format(path, err))
+                    continue
+                count += 1
+                yield path.relative_to(cache_path).as_posix(), json.dumps(value)
+
+        self.conn.executemany('INSERT OR REPLACE INTO items VALUES (?, ?)',
+                              items())
+
+        if count:
+            log.info('migrated {} items from pickleshare cache in {} (pickle '
+                     'files may now be removed)'.format(count, cache_dir))
+
+    def __getitem__(self, key):
+        row = self.conn.execute('SELECT value FROM items WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.put_many([(key, value)])
+
+    def __delitem__(self, key):
+        with self.conn:
+            cursor = self.conn.execute('DELETE FROM items WHERE key = ?',
+                                       (key,))
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.conn.execute('SELECT 1 FROM items WHERE key = ?',
+                                 (key,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([key for key, in self.conn.execute('SELECT key FROM items')])
+
+    def __len__(self):
+        return self.conn.execute('SELECT count(*) FROM items').fetchone()[0]
+
+    def items(self):
+        return [(key, json.loads(value)) for key, value in
+                self.conn.execute('SELECT key, value FROM items')]
+
+    def get_many(self, keys):
+        """
+        Return dict mapping those keys found in the cache to their values
+        """
+        found = {}
+        keys = list(keys)
+
+        # stay below SQLite's limit on number of query parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            query = ('SELECT key, value FROM items WHERE key IN ({})'
+                     .format(','.join('?' * len(batch))))
+            found.update((key, json.loads(value))
+                         for key, value in self.conn.execute(query, batch))
+        return found
+
+    def missing(self, keys):
+        """
+        Return list of keys not in the cache, in the given order
+        """
+        keys = list(keys)
+        found = set()
+
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            query = ('SELECT key FROM items WHERE key IN ({})'
+                     .format(','.join('?' * len(batch))))
+            found.update(key for key, in self.conn.execute(query, batch))
+        return [key for key in keys if key not in found]
+
+    def put_many(self, items):
+        """
+        Store (key, value) pairs in a single transaction, clearing any
+        failures recorded for their keys
+        """
+        items = list(items)
+
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO items VALUES (?, ?)',
+                                  ((key, json.dumps(value))
+                                   for key, value in items))
+            self.conn.executemany('DELETE FROM failures WHERE key = ?',
+                                  ((key,) for key, _ in items))
+
+    def delete_many(self, keys):
+        """
+        Remove keys, if present, in a single transaction
+        """
+        with self.conn:
+            self.conn.executemany('DELETE FROM items WHERE key = ?',
+                                  ((key,) for key in keys))
+
+    def put_failure(self, key, status, reason):
+        """
+        Record failed lookup of key
+        """
+        with self.conn:
+            self.conn.execute('INSERT INTO failures VALUES (?, ?, ?, 1, ?) '
+                              'ON CONFLICT (key) DO UPDATE SET '
+                              'status = excluded.status, '
+                              'reason = excluded.reason, '
+                              'count = count + 1, time = excluded.time',
+                              (key, status, reason, time.time()))
+
+    def failed(self, keys):
+        """
+        Return set of keys whose lookup failed permanently within the
+        failure TTL
+        """
+        keys = list(keys)
+        failed = set()
+        since = time.time() - self.failure_ttl * 86400
+
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            query = ('SELECT key, status FROM failures '
+                     'WHERE time > ? AND key IN ({})'
+                     .format(','.join('?' * len(batch))))
+            failed.update(key for key, status in
+                          self.conn.execute(query, [since] + batch)
+                          if is_permanent(status))
+        return failed
+
+    def is_failed(self, key):
+        return bool(self.failed([key]))
+
+    def failures(self):
+        """
+        Return list of (key, status, reason, count, time) tuples for all
+        recorded failures
+        """
+        return self.conn.execute('SELECT key, status, reason, count, time '
+                                 'FROM failures ORDER BY key').fetchall()
+
+    def clear_failures(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM failures')
+
+    def close(self):
+        self.conn.close()
+
+
+def get_cache(cache_dir, failure_ttl=FAILURE_TTL):
+    """
+    Return MetadataCache stored in cache_dir
+
+    A pickleshare cache previously stored in cache_dir is migrated on first
+    use.
+    """
     cache_path = Path(cache_dir)
     cache_path.mkdir(parents=True, exist_ok=True)
     log.info('reading cached data from ' + cache_dir)
-    cache = pickleshare.PickleShareDB(cache_dir)
-    return cache
+    return MetadataCache(cache_path / CACHE_FILE, migrate_dir=cache_path,
+                         failure_ttl=failure_ttl)
 
 
 def get_citation(doi, cache,
-                 style='chicago-fullnote-bibliography',
-                 strip_doi=True, online=True):
+                 style=CITATION_STYLE,
+                 strip_doi=True, online=True, fetcher=None):
     """
     Get formatted citation string for DOI from CrossRef
 
@@ -39,6 +442,7 @@ def get_citation(doi, cache,
     style
     strip_doi
     online
+    fetcher
 
     Returns
     -------
@@ -49,35 +453,55 @@ def get_citation(doi, cache,
     except KeyError:
         pass
 
+    if cache.is_failed(doi):
+        log.info('skipping lookup of citation for DOI {}, which failed '
+                 'before'.format(doi))
+        return ''
+
     if not online:
         log.warning('skipping online lookup of citation for DOI {}'.format(doi))
         return ''
 
+    try:
+        citation = fetch_citation(doi, fetcher or default_fetcher(), style,
+                                  strip_doi)
+    except FetchError as err:
+        cache.put_failure(doi, err.status, err.reason)
+        return ''
+
+    cache[doi] = citation
+    return citation
+
+
+def fetch_citation(doi, fetcher, style=CITATION_STYLE, strip_doi=True):
+    """
+    Request formatted citation string for DOI from CrossRef, raising
+    FetchError on failure
+    """
     headers = {'Accept': 'text/bibliography; style={}'.format(style)}
-    attempts = 10
-    response = None
+    response = fetcher.get(fetcher.doi_url + doi, headers=headers)
 
-    for i in range(attempts):
-        response = requests.get('http://dx.doi.org/{}'.format(doi), headers=headers)
-        if response.ok:
-            break
-    else:
-        if response:
-            log.error('request for formated citation of {} returned {}: {}'.format(
-                doi, response.status_code, response.reason))
-        else:
-            log.error('request for formated citation of {} failed'.format(doi))
-        return ''
+    if response is None:
+        log.error('request for formated citation of {} failed'.format(doi))
+        raise FetchError(None, 'no response')
+    elif not response.ok:
+        log.error('request for formated citation of {} returned {}: {}'.format(
+            doi, response.status_code, response.reason))
+        raise FetchError(response.status_code, response.reason)
 
-    log.info('request for formated citation of {} succeeded'.format(doi))
+    try:
+        citation = response.content.decode('utf-8')
+    except UnicodeDecodeError:
+        log.error('request for formated citation of {} returned invalid '
+                  'UTF-8'.format(doi))
+        raise FetchError(response.status_code, 'invalid UTF-8')
 
-    citation = response.content.decode('utf-8')
+    log.info('request for formated citation of {} succeeded'.format(doi))
 
     if strip_doi:
         # TODO 3: won't work for other styles
         citation = citation.split(' doi:')[0]
 
-    cache[doi] = citation
     return citation
 
 
@@ -150,7 +574,8 @@ def get_doi_metadata(doi, cache, online=True):
     return metadata
 
 
-def request_doi_metadata(doi, cache, attempts=10, online=True):
+def request_doi_metadata(doi, cache, attempts=ATTEMPTS, online=True,
+                         fetcher=None):
     """
     Request metadata for DOI from CrossRef
     """
@@ -159,29 +584,51 @@ def request_doi_metadata(doi, cache, attempts=10, online=True):
     except KeyError:
         pass
 
+    if cache.is_failed(doi):
+        log.info('skipping lookup for DOI {}, which failed before'.format(
+            doi))
+        return {}
+
     if not online:
         log.warning('skipping online lookup for DOI {}'.format(doi))
         return {}
 
+    try:
+        metadata = fetch_doi_metadata(doi, _get_fetcher(fetcher, attempts))
+    except FetchError as err:
+        cache.put_failure(doi, err.status, err.reason)
+        return {}
+
+    cache[doi] = metadata
+    return metadata
+
+
+def fetch_doi_metadata(doi, fetcher):
+    """
+    Request metadata for DOI from CrossRef, raising FetchError on failure
+    """
     headers = {'Accept': 'application/vnd.citationstyles.csl+json'}
-    response = None
+    response = fetcher.get(fetcher.doi_url + doi, headers=headers)
 
-    for i in range(attempts):
-        response = requests.get('http://dx.doi.org/{}'.format(doi),
-                                headers=headers)
-        if response.ok:
-            break
-    else:
-        if response:
-            log.error('request for metadata of DOI {} returned {}: {}'.format(
-                doi, response.status_code, response.reason))
-        else:
-            log.error('request for metadata of DOI {} failed'.format(doi))
-        return {}
+    if response is None:
+        log.error('request for metadata of DOI {} failed'.format(doi))
+        raise FetchError(None, 'no response')
+    elif not response.ok:
+        log.error('request for metadata of DOI {} returned {}: {}'.format(
+            doi, response.status_code, response.reason))
+        raise FetchError(response.status_code, response.reason)
+
+    try:
+        metadata = response.json()
+    except ValueError:
+        metadata = None
+
+    if not isinstance(metadata, dict):
+        log.error('request for metadata of DOI {} returned no JSON '
+                  'object'.format(doi))
+        raise FetchError(response.status_code, 'invalid JSON')
 
     log.info('request for metadata of DOI {} succeeded'.format(doi))
-    metadata = response.json()
-    cache[doi] = metadata
     return metadata
 
 
@@ -205,7 +652,8 @@ def get_issn_metadata(issn, cache, online=True):
     return metadata
 
 
-def request_issn_metadata(issn, cache, attempts=10, online=True):
+def request_issn_metadata(issn, cache, attempts=ATTEMPTS, online=True,
+                          fetcher=None):
     """
     Request metadata for ISSN from CrossRef
     """
@@ -214,32 +662,123 @@ def request_issn_metadata(issn, cache, attempts=10, online=True):
     except KeyError:
         pass
 
+    if cache.is_failed(issn):
+        log.info('skipping lookup for ISSN {}, which failed before'.format(
+            issn))
+        return {}
+
     if not online:
         log.warning('skipping online lookup for ISSN {}'.format(issn))
         return {}
 
-    response = None
+    try:
+        message = fetch_issn_metadata(issn, _get_fetcher(fetcher, attempts))
+    except FetchError as err:
+        cache.put_failure(issn, err.status, err.reason)
+        return {}
 
-    for i in range(attempts):
-        response = requests.get(
-            'http://api.crossref.org/journals/{}'.format(issn))
-        if response.ok:
-            break
-    else:
-        if response:
-            log.error('request for metadata of ISSN {} returned {}: {}'.format(
-                issn, response.status_code, response.reason))
-        else:
-            log.error('request for metadata of ISSN {} failed'.format(issn))
+    cache[issn] = message
+    return message
 
-        return {}
+
+def fetch_issn_metadata(issn, fetcher):
+    """
+    Request metadata for ISSN from CrossRef, raising FetchError on failure
+    """
+    response = fetcher.get(fetcher.issn_url + issn)
+
+    if response is None:
+        log.error('request for metadata of ISSN {} failed'.format(issn))
+        raise FetchError(None, 'no response')
+    elif not response.ok:
+        log.error('request for metadata of ISSN {} returned {}: {}'.format(
+            issn, response.status_code, response.reason))
+        raise FetchError(response.status_code, response.reason)
+
+    try:
+        message = response.json()['message']
+    except (ValueError, KeyError, TypeError):
+        log.error('request for metadata of ISSN {} returned no JSON '
+                  'message'.format(issn))
+        raise FetchError(response.status_code, 'invalid JSON')
 
     log.info('request for metadata of ISSN {} succeeded'.format(issn))
-    message = response.json()['message']
-    cache[issn] = message
     return message
 
 
+def prefetch(dois, meta_cache, cit_cache, fetcher=None):
+    """
+    Request metadata, including metadata from ISSN, and citations for DOIs
+    concurrently and store them in the caches
+
+    Only items missing from the caches (instances of MetadataCache) are
+    requested, with up to fetcher.concurrency requests at a time, except
+    those whose lookup failed before (see MetadataCache.failed). Failures
+    are recorded in the caches. Results are stored as they come
+    in, so if the process crashes, most of them are saved. Afterwards,
+    get_all_metadata and get_citation find them in the caches.
+    """
+    fetcher = fetcher or default_fetcher()
+    requested = set()
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=fetcher.concurrency) as executor:
+        def submit(func, key, cache):
+            if (func, key) not in requested:
+                requested.add((func, key))
+                future = executor.submit(func, key, fetcher)
+                pending[future] = func, key, cache
+
+        def submit_issn(metadata):
+            try:
+                issn = metadata['ISSN'][0]
+            except (KeyError, IndexError):
+                return
+            if issn not in meta_cache and not meta_cache.is_failed(issn):
+                submit(fetch_issn_metadata, issn, meta_cache)
+
+        dois = list(dois)
+        cached = meta_cache.get_many(dois)
+        failed = meta_cache.failed(dois)
+
+        for doi in dois:
+            if doi in cached:
+                submit_issn(cached[doi])
+            elif doi not in failed:
+                submit(fetch_doi_metadata, doi, meta_cache)
+
+        missing = cit_cache.missing(dois)
+        cit_failed = cit_cache.failed(missing)
+
+        for doi in missing:
+            if doi not in cit_failed:
+                submit(fetch_citation, doi, cit_cache)
+
+        if failed or cit_failed:
+            log.info('skipping {} lookups which failed before'.format(
+                len(failed) + len(cit_failed)))
+
+        log.info('requesting {} items with up to {} concurrent '
+                 'requests'.format(len(pending), fetcher.concurrency))
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                func, key, cache = pending.pop(future)
+
+                try:
+                    result = future.result()
+                except FetchError as err:
+                    cache.put_failure(key, err.status, err.reason)
+                    continue
+
+                cache[key] = result
+
+                if func is fetch_doi_metadata:
+                    submit_issn(result)
+
+
 def clean_metadata_cache(cache_dir):
     """
     Remove records with None values from metadata cache
@@ -248,15 +787,59 @@ def clean_metadata_cache(cache_dir):
     new metadata will be requested for the removed records.
     """
     log.info('cleaning cached metadata from ' + cache_dir)
-    cache = pickleshare.PickleShareDB(cache_dir)
+    cache = get_cache(cache_dir)
     to_delete = []
 
-    for key in cache.keys():
+    for key, value in cache.items():
         func = get_doi_metadata if '/' in key else get_issn_metadata
-        metadata = func(key, cache)
+        metadata = func(key, {key: value})
         if None in metadata.values():
             to_delete.append(key)
 
     for key in to_delete:
         log.info('removing incomplete cached metadata for key {}'.format(key))
-        del cache[key]
+
+    cache.delete_many(to_delete)
+    cache.close()
+
+
+def failure_report(cache_dir, failure_ttl=FAILURE_TTL, clear=False):
+    """
+    Report failed lookups recorded in the caches in cache_dir or its subdirs
+
+    Lookups that failed with a client error such as 404 (Not Found) are
+    retried once their failure is more than failure_ttl days old; other
+    failed lookups are retried on the next run. If clear is true, all
+    recorded failures are removed, so every failed lookup is retried.
+    """
+    failures = []
+
+    for cache_file in sorted(Path(cache_dir).glob('**/' + CACHE_FILE)):
+        cache = MetadataCache(cache_file)
+
+        for key, status, reason, count, failed in cache.failures():
+            if is_permanent(status):
+                retry = time.strftime('%Y-%m-%d', time.localtime(
+                    failed + failure_ttl * 86400))
+            else:
+                retry = 'next run'
+            failures.append((str(cache_file.parent), key, status, reason,
+                             count, retry))
+
+        if clear:
+            cache.clear_failures()
+
+        cache.close()
+
+    if failures:
+        log.warning('{} failed lookups cached in {} (cache, key, status, '
+                    'reason, failures, retry):\n{}'.format(
+            len(failures), cache_dir,
+            '\n'.join('\t'.join(str(field) for field in failure)
+                      for failure in failures)))
+
+        if clear:
+            log.info('removed {} failed lookups from caches'.format(
+                len(failures)))
+
+    return failures
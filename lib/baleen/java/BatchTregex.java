@@ -0,0 +1,57 @@
+import java.io.BufferedWriter;
+import java.io.IOException;
+import java.io.OutputStreamWriter;
+import java.io.PrintWriter;
+import java.util.ArrayList;
+import java.util.List;
+
+import edu.stanford.nlp.trees.DiskTreebank;
+import edu.stanford.nlp.trees.Tree;
+import edu.stanford.nlp.trees.tregex.TregexMatcher;
+import edu.stanford.nlp.trees.tregex.TregexPattern;
+
+/**
+ * Match multiple Tregex patterns against a treebank, reading the trees once
+ * and evaluating every pattern on each tree.
+ *
+ * Usage: java BatchTregex TREES_PATH PATTERN...
+ *
+ * For every match, prints the index of the pattern, the label of the node
+ * assigned to handle "from" and the label of the node assigned to handle
+ * "to", separated by tabs. Trees are read in the same way as by
+ * TregexPattern's main method.
+ */
+public class BatchTregex {
+
+    public static void main(String[] args) throws IOException {
+        List<TregexPattern> patterns = new ArrayList<TregexPattern>();
+
+        for (int i = 1; i < args.length; i++) {
+            patterns.add(TregexPattern.compile(args[i]));
+        }
+
+        DiskTreebank treebank = new DiskTreebank(
+                new TregexPattern.TRegexTreeReaderFactory(), "UTF-8");
+        treebank.loadPath(args[0]);
+
+        PrintWriter out = new PrintWriter(new BufferedWriter(
+                new OutputStreamWriter(System.out, "UTF-8")));
+
+        for (Tree tree : treebank) {
+            for (int i = 0; i < patterns.size(); i++) {
+                TregexMatcher matcher = patterns.get(i).matcher(tree);
+
+                while (matcher.find()) {
+                    Tree from = matcher.getNode("from");
+                    Tree to = matcher.getNode("to");
+
+                    if (from != null && to != null) {
+                        out.println(i + "\t" + from.value() + "\t" + to.value());
+                    }
+                }
+            }
+        }
+
+        out.flush();
+    }
+}
@@ -12,10 +12,13 @@ from glob import glob
 from pathlib import Path
 
 import neokit
-from lxml import etree
 
+from baleen import scnlp
+from baleen.records import record_files, read_records, peek
 from baleen.utils import get_doi, derive_path
-from baleen.cite import get_cache, get_all_metadata, get_citation
+from baleen.cite import (get_cache, get_all_metadata, get_citation, prefetch,
+                         Fetcher, CONCURRENCY, RATE_LIMIT, DOI_URL, ISSN_URL,
+                         FAILURE_TTL)
 
 log = logging.getLogger(__name__)
 
@@ -186,10 +189,15 @@ def neo4j_import_multi(warehouse_home, server_name, node_file_pats, rel_file_pat
 
 
 def articles_to_csv(vars_dir, text_dir, meta_cache_dir, cit_cache_dir, nodes_csv_dir,
-                    max_n=None, online=True):
+                    max_n=None, online=True, concurrency=CONCURRENCY,
+                    rate_limit=RATE_LIMIT, doi_url=DOI_URL, issn_url=ISSN_URL,
+                    failure_ttl=FAILURE_TTL):
     """
     Transform articles to csv tables that can be imported by neo4j
 
+    Metadata and citations missing from the caches are first requested
+    concurrently (see cite.prefetch).
+
     Parameters
     ----------
     vars_dir
@@ -199,6 +207,17 @@ def articles_to_csv(vars_dir, text_dir, meta_cache_dir, cit_cache_dir, nodes_csv
     nodes_csv_dir
     max_n
     online
+    concurrency : int
+        max number of concurrent online lookups
+    rate_limit : float
+        max number of online lookups per second (0 means no limit)
+    doi_url : str
+        base url for DOI lookups
+    issn_url : str
+        base url for ISSN lookups
+    failure_ttl : float
+        days before lookups that failed with a client error (e.g. 404) are
+        retried
 
     Returns
     -------
@@ -226,10 +245,20 @@ def articles_to_csv(vars_dir, text_dir, meta_cache_dir, cit_cache_dir, nodes_csv
     # mapping from DOI to text files
     doi2txt = _doi2txt_fname(text_dir)
 
-    meta_cache = get_cache(meta_cache_dir)
-    cit_cache = get_cache(cit_cache_dir)
+    meta_cache = get_cache(meta_cache_dir, failure_ttl)
+    cit_cache = get_cache(cit_cache_dir, failure_ttl)
     pattern = re.compile(r"\s+")
-    fnames = list(Path(vars_dir).glob('*.json'))[:max_n]
+    fnames = record_files(vars_dir)[:max_n]
+
+    if online:
+        fetcher = Fetcher(concurrency=concurrency, rate_limit=rate_limit,
+                          doi_url=doi_url, issn_url=issn_url)
+        dois = [get_doi(fname) for fname in fnames]
+        prefetch([doi for doi in dois if doi in doi2txt], meta_cache,
+                 cit_cache, fetcher)
+        # whatever is still missing from the caches failed in prefetch,
+        # so do not request it again
+        online = False
 
     for json_fname in fnames:
         doi = get_doi(json_fname)
@@ -270,9 +299,11 @@ def vars_to_csv(vars_dir, scnlp_dir, text_dir, nodes_csv_dir,
     Parameters
     ----------
     vars_dir : str
-        directory containing files with extracted variables in json format
+        directory containing files with extracted variables in json or json
+        lines format
     scnlp_dir : str
-        directory containing files with scnlp output in xml format
+        directory containing files with scnlp output in xml or json format,
+        from which only the offset index is read (built if needed)
     text_dir : str
         directory containing files with original text or sentences (one per line)
     nodes_csv_dir : str
@@ -347,12 +378,12 @@ def vars_to_csv(vars_dir, scnlp_dir, text_dir, nodes_csv_dir,
     doi2txt = _doi2txt_fname(text_dir)
 
     pattern = re.compile('[\n\r]')
-    filenames = list(Path(vars_dir).glob('*.json'))[:max_n]
+    filenames = record_files(vars_dir)[:max_n]
 
     for json_fname in filenames:
-        records = json.load(json_fname.open())
+        first, records = peek(read_records(json_fname))
 
-        if not records:
+        if first is None:
             log.warning('skipping empty variables file: {}'.format(json_fname))
             continue
 
@@ -369,10 +400,9 @@ def vars_to_csv(vars_dir, scnlp_dir, text_dir, nodes_csv_dir,
         text = text_fname.open().read()
 
         # read corenlp analysis
-        tree_fname = records[0]['filename']
+        tree_fname = first['filename']
         scnlp_fname = derive_path(tree_fname, new_dir=scnlp_dir, new_ext='xml')
-        xml_tree = etree.parse(str(scnlp_fname))
-        sentences_elem = xml_tree.getroot()[0][0]
+        index = scnlp.load_offset_index(scnlp_fname)
 
         tree_number = None
 
@@ -387,9 +417,7 @@ def vars_to_csv(vars_dir, scnlp_dir, text_dir, nodes_csv_dir,
                 tree_number = rec['treeNumber']
                 sent_id = '{}/{}'.format(doi, tree_number)
                 # get char offsets for sentence (tree numbers start at 1)
-                sent_elem = sentences_elem[int(tree_number) - 1]
-                begin = int(sent_elem[0][0][2].text)
-                end = int(sent_elem[0][-1][3].text)
+                begin, end = index.sentence_offsets(int(tree_number) - 1)
                 sent_chars = text[begin:end]
                 # neo4j-import fails on newlines, so replace all \n and \r with a space
                 sent_chars = pattern.sub(' ', sent_chars)
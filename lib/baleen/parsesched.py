@@ -0,0 +1,179 @@
+"""
+Length-bucketed scheduling of sentence parsing
+
+Parse time grows superlinearly with sentence length. Sentences are therefore
+measured and divided into buckets: short sentences go to the PCFG parser,
+long ones to the faster shift-reduce parser. Buckets are parsed as separate
+CoreNLP jobs running in parallel, and their results are merged back into a
+CoreNLP XML file per input document, with sentences in original order.
+"""
+
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from lxml.etree import fromstring
+
+from baleen import scnlp, sentcache
+from baleen.utils import file_list, make_dir, read_manifest, write_manifest
+
+log = logging.getLogger(__name__)
+
+# sentences with more tokens are parsed with the shift-reduce parser
+# (0 means all sentences are parsed with the PCFG parser)
+SR_THRESHOLD = 40
+# sentences with more tokens are not parsed (0 means no limit)
+MAX_LENGTH = 0
+# number of sentences per input file for CoreNLP
+LINES_PER_FILE = 250
+
+# rough approximation of CoreNLP's tokenizer
+TOKEN_RE = re.compile(r"\w+(?:[-'.]\w+)*|[^\w\s]")
+
+
+def sentence_length(sentence):
+    """
+    Return approximate number of tokens in sentence
+    """
+    return len(TOKEN_RE.findall(sentence))
+
+
+def parse_sent_bucketed(input,
+                        sr_threshold=SR_THRESHOLD,
+                        max_length=MAX_LENGTH,
+                        lines_per_file=LINES_PER_FILE,
+                        out_dir=scnlp.OUT_DIR,
+                        annotators=scnlp.ANNOTATORS,
+                        version=scnlp.VERSION,
+                        replace_ext=scnlp.REPLACE_EXT,
+                        output_ext=scnlp.OUTPUT_EXT,
+                        options='-ssplit.eolonly',
+                        stamp=scnlp.STAMP,
+                        resume=scnlp.RESUME,
+                        isolate=scnlp.ISOLATE,
+                        **kwargs):
+    """
+    Parse sentences (one sentence per line) in buckets by sentence length
+
+    Sentences up to sr_threshold tokens are parsed with the PCFG parser,
+    longer ones with the shift-reduce parser. Sentences in each bucket are
+    sorted by length, so every CoreNLP input file holds sentences of similar
+    length, and the buckets are processed in parallel. Outputs are recorded
+    in the manifest and documents with sentences that made CoreNLP fail in
+    the quarantine file of out_dir, as by scnlp.core_nlp, so resume works
+    the same. Remaining keyword arguments are passed on to scnlp.core_nlp,
+    so e.g. jvms applies to each bucket.
+
+    Parameters
+    ----------
+    input : str
+        input directory or file
+    sr_threshold : int
+        max length in tokens of sentences parsed with the PCFG parser
+        (0 means all sentences are parsed with the PCFG parser)
+    max_length : int
+        max length in tokens of sentences to be parsed at all (0 means no
+        limit); longer sentences get a flat parse from CoreNLP
+    lines_per_file : int
+        number of sentences per input file for CoreNLP
+    """
+    in_files = file_list(input)
+    make_dir(out_dir)
+
+    if stamp:
+        replace_ext = True
+        output_ext = scnlp.stamped_ext(version, output_ext)
+
+    out_files = {fname: scnlp.output_path(fname, out_dir, output_ext,
+                                          replace_ext)
+                 for fname in in_files}
+
+    if max_length:
+        options += ' -parse.maxlen {}'.format(max_length)
+
+    fingerprints = {fname: dict(scnlp.fingerprint(fname, annotators, options,
+                                                  version, bool(sr_threshold)),
+                                sr_threshold=sr_threshold)
+                    for fname in in_files}
+    manifest_fname = Path(out_dir or '.') / scnlp.MANIFEST_FNAME
+    manifest = read_manifest(manifest_fname)
+    quarantine = scnlp.read_quarantine(out_dir)
+
+    if resume:
+        in_files = scnlp.resume_files(in_files, out_files, fingerprints,
+                                      manifest,
+                                      quarantine if isolate else None)
+
+    # bucket for shift-reduce parser is keyed True, for PCFG parser False
+    buckets = {False: [], True: []}
+    docs = {}
+
+    for fname in in_files:
+        lines = list(sentcache.split_lines(
+            Path(fname).read_text(encoding='utf-8')))
+        docs[fname] = [start for start, _ in lines]
+
+        for i, (_, line) in enumerate(lines):
+            length = sentence_length(line)
+            use_sr_parser = bool(sr_threshold) and length > sr_threshold
+            buckets[use_sr_parser].append((length, (fname, i), line))
+
+    log.info('{} sentences for PCFG parser, {} for shift-reduce parser'.format(
+        len(buckets[False]), len(buckets[True])))
+
+    # reasons of failure of sentences, per bucket
+    failures = {use_sr_parser: {} for use_sr_parser in buckets}
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+            futures = [executor.submit(sentcache.parse_lines,
+                                       {key: line for _, key, line
+                                        in sorted(bucket, key=lambda t: t[0])},
+                                       lines_per_file=lines_per_file,
+                                       failures=failures[use_sr_parser],
+                                       annotators=annotators,
+                                       version=version,
+                                       options=options,
+                                       use_sr_parser=use_sr_parser,
+                                       isolate=isolate,
+                                       **kwargs)
+                       for use_sr_parser, bucket in buckets.items() if bucket]
+            parsed = {}
+
+            for future in futures:
+                parsed.update(future.result())
+
+        failures = {key: reason
+                    for bucket_failures in failures.values()
+                    for key, reason in bucket_failures.items()}
+
+        for fname, starts in docs.items():
+            keys = [(fname, i) for i in range(len(starts))]
+
+            if any(key not in parsed for key in keys):
+                log.error('skipping {} because some of its sentences could '
+                          'not be parsed'.format(fname))
+                manifest.pop(out_files[fname].name, None)
+
+                if isolate:
+                    sentcache.quarantine_doc(quarantine, fname, keys,
+                                             failures)
+                continue
+
+            sent_elems = []
+
+            for start, key in zip(starts, keys):
+                for sent_elem in fromstring(parsed[key]):
+                    scnlp.shift_offsets(sent_elem, start)
+                    sent_elems.append(sent_elem)
+
+            log.info('writing {}'.format(out_files[fname]))
+            scnlp.write_document(sent_elems, out_files[fname])
+            manifest[out_files[fname].name] = fingerprints[fname]
+    finally:
+        write_manifest(manifest_fname, manifest)
+
+        if isolate:
+            scnlp.write_quarantine(out_dir, quarantine)
+            scnlp.quarantine_report(out_dir)
@@ -0,0 +1,124 @@
+"""
+streaming reading and writing of JSON record files
+
+Records (e.g. extracted variables) are stored either as a single JSON array
+(format 'json', as read and written by the Java tools) or as JSON Lines with
+one record per line (format 'jsonl'), optionally gzip-compressed (format
+'jsonl.gz'). The format of a file follows from its extension. JSON Lines
+files are read and written incrementally, so memory use does not grow with
+file size.
+"""
+
+import gzip
+import json
+import logging
+from itertools import chain
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+FORMAT = 'json'
+FORMATS = ['json', 'jsonl', 'jsonl.gz']
+
+
+def record_format(fname):
+    """
+    Return format of record file from its extension, or None if unknown
+    """
+    name = Path(fname).name
+
+    for fmt in sorted(FORMATS, key=len, reverse=True):
+        if name.endswith('.' + fmt):
+            return fmt
+
+
+def record_files(records_dir):
+    """
+    List record files, in any of the supported formats, in directory
+    """
+    return sorted(fname
+                  for fmt in FORMATS
+                  for fname in Path(records_dir).glob('*.' + fmt)
+                  # skip e.g. manifests and, for json, jsonl.gz files
+                  if not fname.name.startswith('.') and
+                  record_format(fname) == fmt)
+
+
+def records_path(fname, fmt=FORMAT, new_dir=None):
+    """
+    Derive path of record file in another format and/or directory
+    """
+    fname = Path(fname)
+    old_fmt = record_format(fname)
+    name = fname.name[:-len(old_fmt) - 1] if old_fmt else fname.stem
+    return Path(fname.parent if new_dir is None else new_dir) / (
+        name + '.' + fmt)
+
+
+def _open(fname, mode, compressed):
+    if compressed:
+        return gzip.open(str(fname), mode + 't', encoding='utf-8')
+    return Path(fname).open(mode, encoding='utf-8')
+
+
+def read_records(fname):
+    """
+    Iterate over records in file
+
+    Files in JSON Lines format are read incrementally. A .json file is read
+    as a JSON array if it starts with '[', otherwise as JSON Lines.
+    """
+    with _open(fname, 'r', str(fname).endswith('.gz')) as inf:
+        first = inf.read(1)
+
+        while first.isspace():
+            first = inf.read(1)
+
+        if first == '[':
+            yield from json.loads(first + inf.read())
+        else:
+            for line in chain([first + inf.readline()], inf):
+                if line.strip():
+                    yield json.loads(line)
+
+
+def peek(records):
+    """
+    Return first of records, or None if there are none, plus an iterator
+    over all records
+    """
+    records = iter(records)
+    first = next(records, None)
+
+    if first is None:
+        return None, iter(())
+
+    return first, chain([first], records)
+
+
+def write_records(fname, records):
+    """
+    Write records to file in the format following from its extension
+
+    Records may be any iterable and are written incrementally. The file is
+    written to a temporary file and renamed, so it is never partially
+    written. Returns the number of records written.
+    """
+    fname = Path(fname)
+    tmp_fname = fname.with_name(fname.name + '.tmp')
+    count = 0
+
+    with _open(tmp_fname, 'w', fname.name.endswith('.gz')) as outf:
+        if record_format(fname) == 'json':
+            # same layout as json.dump(records, outf, indent=0)
+            for count, rec in enumerate(records, 1):
+                outf.write('[\n' if count == 1 else ',\n')
+                outf.write(json.dumps(rec, indent=0))
+            outf.write('\n]' if count else '[]')
+        else:
+            for count, rec in enumerate(records, 1):
+                outf.write(json.dumps(rec))
+                outf.write('\n')
+
+    tmp_fname.replace(fname)
+    return count
@@ -4,23 +4,46 @@ relation extraction through tree pattern matching
 
 import logging
 import json
+import os
+import shutil
 import subprocess
-from collections import defaultdict
+from collections import Counter, defaultdict
 from configparser import ConfigParser
+from tempfile import TemporaryDirectory, gettempdir
 
 from pathlib import Path
-from nltk.tree import Tree
 
-from baleen.utils import derive_path, get_doi
+from baleen import treepat
+from baleen.records import record_files, read_records
+from baleen.tree import ParseTree, split_trees, tag_nodes
+from baleen.utils import (derive_path, get_doi, iter_process_files,
+                          process_files)
 
 log = logging.getLogger(__name__)
 log.setLevel('INFO')
 
+# number of processes for tagging trees and native pattern matching
+# (0 means one per CPU core)
+PROCESSES = 1
+# engine for matching relation patterns: 'jvm' runs Stanford Tregex,
+# 'native' matches in Python, falling back to Tregex for patterns with
+# unsupported syntax, and 'compare' runs both and reports differences
+ENGINE = 'jvm'
+ENGINES = ['jvm', 'native', 'compare']
+# match all relation patterns in a single JVM
+BATCH = True
+# source of the Java driver for matching multiple patterns, which is
+# compiled once and cached next to the source (or in a temp dir if that is
+# not writable)
+BATCH_TREGEX_SOURCE = Path(__file__).parent / 'java' / 'BatchTregex.java'
+BATCH_TREGEX_CACHE_DIRS = [BATCH_TREGEX_SOURCE.parent,
+                           Path(gettempdir()) / 'baleen-java']
 
 # TODO 3: doc strings
 
 
-def tag_var_nodes(vars_dir, trees_dir, tagged_dir):
+def tag_var_nodes(vars_dir, trees_dir, tagged_dir, index_dir=None,
+                  processes=PROCESSES):
     """
     Tag variable nodes in tree
 
@@ -30,100 +53,294 @@ def tag_var_nodes(vars_dir, trees_dir, tagged_dir):
     m is the variable's node number and
     e is name of the pattern(s) used for extracting this variable.
     Will only output those trees containing at least two variables.
+    Files are processed in parallel if processes > 1 (or 0 for one process
+    per CPU core).
+
+    If index_dir is given, an inverted index of the labels of the nodes in
+    the tagged trees, i.e. of their lemmas and syntactic categories, is
+    written there for each file of tagged trees, which extract_relations
+    uses to skip trees that cannot match a pattern.
     """
     # At first I used the tregex's '-f' option to print the filename,
     # but when traversing the files in a directory,
     # it prints the wrong filenames (after the first one?),
     # so now the filename is encoded in the node label too.
-    trees_dir = Path(trees_dir)
     tagged_dir = Path(tagged_dir)
     tagged_dir.mkdir(parents=True, exist_ok=True)
 
-    for vars_fname in Path(vars_dir).glob('*.json'):
-        records = json.load(vars_fname.open())
+    if index_dir:
+        Path(index_dir).mkdir(parents=True, exist_ok=True)
+
+    process_files(_tag_var_nodes, record_files(vars_dir), trees_dir,
+                  tagged_dir, index_dir, processes=processes)
+
+
+def _tag_var_nodes(vars_fname, trees_dir, tagged_dir, index_dir):
+    tag_file_var_nodes(read_records(vars_fname), trees_dir, tagged_dir,
+                       index_dir)
+
+
+def tag_file_var_nodes(var_records, trees_dir, tagged_dir, index_dir=None):
+    """
+    Tag variable nodes in trees for the variable records of a single file
+
+    See tag_var_nodes.
+    """
+    trees_dir = Path(trees_dir)
+    # create a dict mapping each tree number to a list of
+    # (nodeNumber, extractName) tuples for its variables
+    d = defaultdict(list)
+    record = {}
+    n_records = 0
+
+    for n_records, record in enumerate(var_records, 1):
+        pair = record['nodeNumber'], record['key']
+        d[record['treeNumber']].append(pair)
+
+    if not n_records > 1:
+        # must contain at least two variables
+        return
+
+    lemtree_fname = record['filename']
+    parses_path = (trees_dir / lemtree_fname)
+    log.info('reading parses from {}'.format(parses_path))
+    parses = parses_path.open().readlines()
+    tagged_parses = []
+    # inverted index mapping node labels to positions of tagged trees
+    index = defaultdict(list)
+
+    for tree_number, pairs in d.items():
+        if len(pairs) > 1:
+            # tree numbers in records count from one
+            lbs = parses[tree_number - 1]
+            log.debug(lbs)
+            # map node indices to keys of variables
+            # (node numbers in records count from one)
+            node_keys = defaultdict(list)
+
+            for node_number, key in pairs:
+                node_keys[node_number - 1].append(key)
+
+            tagged_parse, leaves = tag_nodes(
+                lbs.strip(),
+                {n: ''.join('_VAR_{}'.format(key) for key in keys)
+                 for n, keys in node_keys.items()})
+            vars_count = 0
+
+            for n, keys in node_keys.items():
+                if n in leaves:
+                    for key in keys:
+                        log.error('skipping variable "{}" because it is a '
+                                  'leaf node ({})'.format(leaves[n], key))
+                else:
+                    vars_count += len(keys)
+
+            if vars_count > 1:
+                if index_dir:
+                    # labels before tagging, so that labels of tagged nodes
+                    # are indexed without their (unique) suffixes
+                    for label in set(ParseTree.fromstring(lbs).labels):
+                        index[label].append(len(tagged_parses))
+
+                tagged_parses.append(tagged_parse)
+
+    if tagged_parses:
+        tagged_fname = derive_path(lemtree_fname, new_dir=tagged_dir)
+        log.info('writing tagged trees to {}'.format(tagged_fname))
+        with tagged_fname.open('w') as outf:
+            outf.writelines(tagged_parses)
+
+        if index_dir:
+            index_fname = lemma_index_path(tagged_fname, index_dir)
+            log.info('writing lemma index to {}'.format(index_fname))
+            json.dump(index, index_fname.open('w'))
+
+
+def lemma_index_path(tagged_fname, index_dir):
+    return derive_path(tagged_fname, new_dir=index_dir, new_ext='json')
+
+
+def _candidate_trees(trees_fname, index_dir, patterns):
+    """
+    Return for each compiled pattern (or None for a pattern that could not
+    be compiled) a set with the positions of the trees in file that contain
+    its anchors, or None if all trees are to be matched
+    """
+    candidates = [None] * len(patterns)
+    index_fname = lemma_index_path(trees_fname, index_dir)
+
+    if (not index_fname.exists() or
+            index_fname.stat().st_mtime < trees_fname.stat().st_mtime):
+        log.warning('no up-to-date lemma index for {}'.format(trees_fname))
+        return candidates
+
+    index = json.load(index_fname.open())
+
+    for i, pattern in enumerate(patterns):
+        if pattern is None:
+            continue
+
+        for words in treepat.anchors(pattern):
+            trees = set().union(*(index.get(word, ()) for word in words))
+
+            if candidates[i] is not None:
+                trees &= candidates[i]
+
+            candidates[i] = trees
+
+    return candidates
 
-        if not len(records) > 1:
-            # must contain at least two variables
+
+def _write_candidate_trees(candidates, out_dir):
+    """
+    Write trees that are candidates for any pattern to files in out_dir
+    """
+    for trees_fname, file_candidates in candidates.items():
+        out_fname = Path(out_dir) / trees_fname.name
+
+        if None in file_candidates:
+            out_fname.symlink_to(trees_fname.resolve())
             continue
 
-        # create a dict mapping each tree number to a list of
-        # (nodeNumber, extractName) tuples for its variables
-        d = defaultdict(list)
-        record = {}
-
-        for record in records:
-            pair = record['nodeNumber'], record['key']
-            d[record['treeNumber']].append(pair)
-
-        lemtree_fname = record['filename']
-        parses_path = (trees_dir / lemtree_fname)
-        log.info('reading parses from {}'.format(parses_path))
-        parses = parses_path.open().readlines()
-        tagged_parses = []
-
-        for tree_number, pairs in d.items():
-            if len(pairs) > 1:
-                # tree numbers in records count from one
-                lbs = parses[tree_number - 1]
-                log.debug(lbs)
-                tree = Tree.fromstring(lbs)
-                # get NLTK-style indices for all nodes in a preorder
-                # traversal of the tree
-                positions = tree.treepositions()
-                vars_count = 0
-
-                for node_number, key in pairs:
-                    # node numbers in records count from one
-                    position = positions[node_number - 1]
-
-                    try:
-                        subtree = tree[position]
-                    except RecursionError:
-                        # TODO This is a quick fix for some problem with extremely long trees
-                        log.error('skipping node_number {}, key {} because of RecursionError in tree\n{}'.format(
-                            node_number, key, tree))
-                        continue
-
-                    try:
-                        subtree.set_label(
-                            '{}_VAR_{}'.format(subtree.label(), key))
-                    except AttributeError:
-                        log.error('skipping variable "{}" because it is a leaf '
-                                  'node ({})'.format(subtree, key))
-                    else:
-                        vars_count += 1
-
-                if vars_count > 1:
-                    tagged_parses.append(tree.pformat(margin=99999))
-
-        if tagged_parses:
-            tagged_fname = derive_path(lemtree_fname, new_dir=tagged_dir)
-            log.info('writing tagged trees to {}'.format(tagged_fname))
-            with tagged_fname.open('w') as outf:
-                outf.writelines(tagged_parses)
+        positions = set().union(*file_candidates)
+
+        if positions:
+            trees = split_trees(trees_fname.read_text(encoding='utf-8'))
+            out_fname.write_text(
+                '\n'.join(tree for i, tree in enumerate(trees)
+                          if i in positions) + '\n', encoding='utf-8')
 
 
 def extract_relations(class_path,
                       tagged_dir,
                       pattern_path,
-                      rels_dir):
+                      rels_dir,
+                      batch=BATCH,
+                      engine=ENGINE,
+                      processes=PROCESSES,
+                      index_dir=None):
     """
     Extract relations between events
+
+    If batch is true, all patterns are matched in a single run of the JVM,
+    reading the tagged trees only once. Otherwise, or if the driver for this
+    is not compiled and javac is missing, Tregex is run separately for each
+    pattern.
+
+    With engine 'native', patterns are matched in Python (see
+    baleen.treepat), in parallel if processes > 1 (or 0 for one process per
+    CPU core), and only patterns with unsupported syntax are matched with
+    Tregex. With engine 'compare', patterns are matched both ways and
+    differences are logged; the relations written are those from Tregex.
+
+    If index_dir holds the lemma indices written by tag_var_nodes, each
+    pattern is only matched against trees containing the words it requires
+    (see treepat.anchors).
     """
+    if engine not in ENGINES:
+        raise ValueError('unsupported engine: {}'.format(engine))
+
     pat_defs = read_patterns(pattern_path)
+    patterns = [(pat_name, items['relation'], items['pattern'].strip())
+                for pat_name, items in pat_defs.items()
+                if pat_name != 'DEFAULT']
+    compiled = [None] * len(patterns)
+    all_matches = [None] * len(patterns)
     rel_records = defaultdict(list)
 
-    for pat_name, items in pat_defs.items():
-        if pat_name != 'DEFAULT':
-            relation = items['relation']
-            pattern = items['pattern'].strip()
+    for i, (pat_name, _, pattern) in enumerate(patterns):
+        try:
+            compiled[i] = treepat.compile_pattern(pattern)
+        except treepat.UnsupportedPattern as err:
+            if engine != 'jvm':
+                log.warning('matching pattern {} with Tregex: {}'.format(
+                    pat_name, err))
 
-            matches = tregex(class_path, tagged_dir, pattern)
-            parse_matches(matches, pat_name, relation, rel_records)
+    trees_fnames = _tree_files(tagged_dir)
+
+    if index_dir:
+        candidates = {fname: _candidate_trees(fname, index_dir, compiled)
+                      for fname in trees_fnames}
+    else:
+        candidates = {fname: [None] * len(patterns) for fname in trees_fnames}
+
+    if engine != 'jvm':
+        native_indices = [i for i, pattern in enumerate(compiled)
+                          if pattern is not None]
+        native_matches = native_tregex(
+            tagged_dir, [compiled[i] for i in native_indices],
+            processes=processes,
+            candidates={fname: [file_candidates[i] for i in native_indices]
+                        for fname, file_candidates in candidates.items()})
+
+        for i, matches in zip(native_indices, native_matches):
+            all_matches[i] = matches
+
+    jvm_indices = [i for i, matches in enumerate(all_matches)
+                   if matches is None or engine == 'compare']
+
+    with TemporaryDirectory() as filtered_dir:
+        trees_dir = tagged_dir
+
+        if index_dir and jvm_indices:
+            # only trees that are candidates for any pattern
+            trees_dir = filtered_dir
+            _write_candidate_trees(
+                {fname: [file_candidates[i] for i in jvm_indices]
+                 for fname, file_candidates in candidates.items()},
+                filtered_dir)
+
+        if batch and jvm_indices and not batch_tregex_classes(class_path):
+            log.warning('cannot compile {} without javac, so running Tregex '
+                        'for each pattern'.format(BATCH_TREGEX_SOURCE.name))
+            batch = False
+
+        if batch and jvm_indices:
+            jvm_matches = iter_tregex_batch(
+                class_path, trees_dir, [patterns[i][2] for i in jvm_indices])
+
+            if engine == 'jvm':
+                # all patterns are matched by Tregex, so relations can be
+                # written per file while its output is read
+                write_relation_stream(jvm_matches, patterns, rels_dir)
+                return
+
+            jvm_matches = _group_matches(jvm_matches, len(jvm_indices))
+        else:
+            jvm_matches = [list(tregex(class_path, trees_dir, patterns[i][2]))
+                           for i in jvm_indices]
+
+    for i, matches in zip(jvm_indices, jvm_matches):
+        if all_matches[i] is not None:
+            _compare_matches(patterns[i][0], matches, all_matches[i])
+
+        all_matches[i] = matches
+
+    for (pat_name, relation, _), matches in zip(patterns, all_matches):
+        parse_matches(matches, pat_name, relation, rel_records)
 
     write_relations(rel_records, rels_dir)
 
 
+def _compare_matches(pat_name, jvm_matches, native_matches):
+    jvm_pairs, native_pairs = Counter(jvm_matches), Counter(native_matches)
+
+    if jvm_pairs == native_pairs:
+        log.info('pattern {}: same {} matches from Tregex and native '
+                 'matcher'.format(pat_name, sum(jvm_pairs.values())))
+    else:
+        log.warning('pattern {}: {} matches only from Tregex, {} only from '
+                    'native matcher:\n{}'.format(
+                        pat_name,
+                        sum((jvm_pairs - native_pairs).values()),
+                        sum((native_pairs - jvm_pairs).values()),
+                        '\n'.join('{} {} ({})'.format(from_node, to_node, src)
+                                  for src, diff in
+                                  [('Tregex', jvm_pairs - native_pairs),
+                                   ('native', native_pairs - jvm_pairs)]
+                                  for from_node, to_node in diff.elements())))
+
+
 def read_patterns(pattern_path):
     # abusing config parser to read patterns, e.g.
     #
@@ -154,6 +371,9 @@ def tregex(class_path,
            memory='3g'):
     """
     Run Stanford Tregex
+
+    Yields a (from node, to node) tuple of node labels for each match,
+    while the output of Tregex is read.
     """
     cmd = ('java '
            '-Xmx{memory} '
@@ -169,26 +389,174 @@ def tregex(class_path,
                     trees_dir=trees_dir)
 
     log.info('\n' + cmd)
-    matches = subprocess.check_output(cmd, shell=True, universal_newlines=True)
-    log.debug('\n{}'.format(matches))
-    return matches
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+
+    try:
+        lines = (line.rstrip('\n') for line in proc.stdout)
+        # the node assigned to 'from' is printed first, then that to 'to'
+        yield from zip(lines, lines)
+    finally:
+        proc.stdout.close()
+
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def iter_tregex_batch(class_path,
+                      trees_dir,
+                      patterns,
+                      memory='3g'):
+    """
+    Run Stanford Tregex with multiple patterns in a single JVM
+
+    The driver in BATCH_TREGEX_SOURCE (see batch_tregex_classes) reads the
+    trees only once, matching every pattern against each tree. Yields a
+    (pattern index, from node, to node) tuple for each match, while the
+    output of the driver is read. Matches come per file of trees and, within
+    a file, per tree.
+    """
+    classes_dir = batch_tregex_classes(class_path)
+
+    if not classes_dir:
+        raise FileNotFoundError('no compiled {} and no javac to compile '
+                                'it'.format(BATCH_TREGEX_SOURCE.name))
+
+    cmd = ['java', '-Xmx' + memory,
+           '-cp', os.pathsep.join([str(classes_dir), '{}/*'.format(class_path)]),
+           'BatchTregex', str(trees_dir)] + list(patterns)
+    log.info('\n' + ' '.join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+
+    try:
+        for line in proc.stdout:
+            i, from_node, to_node = line.rstrip('\n').split('\t')
+            yield int(i), from_node, to_node
+    finally:
+        proc.stdout.close()
+
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def batch_tregex_classes(class_path):
+    """
+    Return dir holding the compiled BatchTregex driver, or None if there is
+    no compiled driver and no javac to compile it
+
+    The driver is compiled against the Stanford classes in class_path only
+    if no cache dir in BATCH_TREGEX_CACHE_DIRS holds a class file newer than
+    the source, so a JRE suffices once it has been compiled.
+    """
+    class_name = BATCH_TREGEX_SOURCE.with_suffix('.class').name
+    source_mtime = BATCH_TREGEX_SOURCE.stat().st_mtime
+
+    for cache_dir in BATCH_TREGEX_CACHE_DIRS:
+        class_fname = cache_dir / class_name
+        if (class_fname.exists() and
+                class_fname.stat().st_mtime >= source_mtime):
+            return cache_dir
+
+    if not shutil.which('javac'):
+        return
+
+    for cache_dir in BATCH_TREGEX_CACHE_DIRS:
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # compile to a temp dir first, so concurrent runs never see a
+            # partially written class file
+            with TemporaryDirectory(dir=str(cache_dir)) as tmp_dir:
+                cmd = ['javac', '-cp', '{}/*'.format(class_path),
+                       '-d', tmp_dir, str(BATCH_TREGEX_SOURCE)]
+                log.info('\n' + ' '.join(cmd))
+                subprocess.check_call(cmd)
+                os.replace(os.path.join(tmp_dir, class_name),
+                           str(cache_dir / class_name))
+        except OSError as err:
+            log.warning('cannot cache compiled {} in {}: {}'.format(
+                class_name, cache_dir, err))
+        else:
+            return cache_dir
+
+
+def tregex_batch(class_path,
+                 trees_dir,
+                 patterns,
+                 memory='3g'):
+    """
+    Run Stanford Tregex with multiple patterns in a single JVM
+
+    Returns a list with the matches of each pattern as (from node, to node)
+    tuples (see iter_tregex_batch).
+    """
+    return _group_matches(iter_tregex_batch(class_path, trees_dir, patterns,
+                                            memory),
+                          len(patterns))
+
+
+def _group_matches(matches, n_patterns):
+    grouped = [[] for _ in range(n_patterns)]
+
+    for i, from_node, to_node in matches:
+        grouped[i].append((from_node, to_node))
+
+    return grouped
+
+
+def native_tregex(trees_dir, patterns, processes=PROCESSES,
+                  candidates=None):
+    """
+    Match patterns compiled by treepat.compile_pattern with the native
+    matcher
+
+    Candidates optionally maps tree files to the candidate trees for each
+    pattern (see treepat.match_file). Returns a list with the matches of
+    each pattern as (from node, to node) tuples.
+    """
+    candidates = candidates or {}
+    items = [(fname, candidates.get(fname))
+             for fname in _tree_files(trees_dir)]
+    all_matches = [[] for _ in patterns]
+
+    for file_matches in iter_process_files(_native_match_file, items,
+                                           patterns, processes=processes):
+        for pat_matches, matches in zip(all_matches, file_matches):
+            pat_matches += matches
+
+    return all_matches
+
+
+def _native_match_file(item, patterns):
+    trees_fname, candidates = item
+    return treepat.match_file(trees_fname, patterns, candidates=candidates)
+
+
+def _tree_files(trees_dir):
+    return sorted(fname for fname in Path(trees_dir).iterdir()
+                  if fname.is_file() and not fname.name.startswith('.'))
 
 
 def parse_matches(matches, pat_name, relation, rel_records):
-    if matches:
-        lines = matches.strip().split('\n')
-        for i in range(0, len(lines), 2):
-            from_node, to_node = lines[i:i + 2]
-            filename, tree_number, node_number, *_ = from_node.split('_VAR_')[-1].split(':')
-            sent_id = get_doi(filename) + '/' + tree_number
-            record = dict(
-                filename=filename,
-                sentenceId=sent_id,
-                fromNodeId=from_node.split('_VAR_')[-1],
-                toNodeId=to_node.split('_VAR_')[-1],
-                patternName=pat_name,
-                relation=relation)
-            rel_records[filename].append(record)
+    """
+    Add a relation record for each (from node, to node) tuple in matches
+    to the records of its file in rel_records
+    """
+    for from_node, to_node in matches:
+        record = match_record(from_node, to_node, pat_name, relation)
+        rel_records[record['filename']].append(record)
+
+
+def match_record(from_node, to_node, pat_name, relation):
+    filename, tree_number, node_number, *_ = from_node.split('_VAR_')[-1].split(':')
+    sent_id = get_doi(filename) + '/' + tree_number
+    return dict(
+        filename=filename,
+        sentenceId=sent_id,
+        fromNodeId=from_node.split('_VAR_')[-1],
+        toNodeId=to_node.split('_VAR_')[-1],
+        patternName=pat_name,
+        relation=relation)
 
 
 # Old version for use with '-f' option
@@ -210,11 +578,63 @@ def write_relations(rel_records, rels_dir):
     """
     write extracted relations per file as json records
     """
-    rels_dir = Path(rels_dir)
-    rels_dir.mkdir(parents=True, exist_ok=True)
+    Path(rels_dir).mkdir(parents=True, exist_ok=True)
 
     for fname, rec_list in rel_records.items():
-        rels_fname = derive_path(fname, new_dir=rels_dir, append_tags=['rels'],
-                                 new_ext='json')
-        log.info('writing extracted relations to {}'.format(rels_fname))
-        json.dump(rec_list, rels_fname.open('w'), indent=0)
+        write_file_relations(fname, rec_list, rels_dir)
+
+
+def write_file_relations(fname, rec_list, rels_dir):
+    rels_fname = relations_path(fname, rels_dir)
+    log.info('writing extracted relations to {}'.format(rels_fname))
+    json.dump(rec_list, rels_fname.open('w'), indent=0)
+
+
+def relations_path(fname, rels_dir):
+    return derive_path(fname, new_dir=rels_dir, append_tags=['rels'],
+                       new_ext='json')
+
+
+def write_relation_stream(matches, patterns, rels_dir):
+    """
+    Write extracted relations per file as json records from a stream of
+    (pattern index, from node, to node) tuples, such as yielded by
+    iter_tregex_batch
+
+    Matches are expected to come per file. The relations of a file are
+    written as soon as matches for another file come in, so only the
+    records of a single file are held in memory. Records are in the same
+    order as written by write_relations, i.e. by pattern and then by tree.
+    """
+    Path(rels_dir).mkdir(parents=True, exist_ok=True)
+    pat_indices = {pat_name: i for i, (pat_name, _, _) in enumerate(patterns)}
+    written = set()
+    file_records = []
+
+    def flush():
+        fname = file_records[0]['filename']
+        # stable sort, so records of a pattern remain in tree order
+        rec_list = sorted(file_records,
+                          key=lambda rec: pat_indices[rec['patternName']])
+
+        if fname in written:
+            log.warning('matches for {} were not contiguous'.format(fname))
+            rec_list = sorted(
+                json.load(relations_path(fname, rels_dir).open()) + rec_list,
+                key=lambda rec: pat_indices[rec['patternName']])
+
+        write_file_relations(fname, rec_list, rels_dir)
+        written.add(fname)
+        file_records.clear()
+
+    for i, from_node, to_node in matches:
+        pat_name, relation, _ = patterns[i]
+        record = match_record(from_node, to_node, pat_name, relation)
+
+        if file_records and record['filename'] != file_records[0]['filename']:
+            flush()
+
+        file_records.append(record)
+
+    if file_records:
+        flush()
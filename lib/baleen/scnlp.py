@@ -2,15 +2,30 @@
 Stanford CoreNLP wrapper and CoreNLP related post-processing
 """
 
+import hashlib
+import json
 import logging
-
-from os.path import join
+import os
+import shutil
+import signal
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, isdir
+from pathlib import Path
 from tempfile import NamedTemporaryFile
-from subprocess import check_output
+from subprocess import check_output, CalledProcessError, Popen, PIPE, STDOUT
+from threading import Lock, Thread
 
-from lxml.etree import ElementTree
+from lxml.etree import Element, SubElement, tostring, iterparse
 
-from baleen.utils import make_dir, file_list, derive_path
+from baleen import scnlp_server, annstore
+from baleen.annstore import (Sentence, AnnotationStore, OffsetIndex,
+                             write_store, write_index)
+from baleen.tree import ParseTree
+from baleen.utils import (make_dir, file_list, derive_path, process_files,
+                          read_manifest, write_manifest)
 
 log = logging.getLogger(__name__)
 
@@ -22,10 +37,28 @@ MEMORY = '3g'
 THREADS = 1
 REPLACE_EXT = True
 OUTPUT_EXT = '.xml'
+OUTPUT_FORMAT = 'xml'
+# extensions of output formats which can be read, in order of preference
+FORMAT_EXTS = ['.xml', '.json']
 OPTIONS = ''
 STAMP = True
 RESUME = False
 USE_SR_PARSER = False
+SR_PARSER_MODEL = 'edu/stanford/nlp/models/srparser/englishSR.ser.gz'
+SERVER = ''
+WORKERS = scnlp_server.WORKERS
+JVMS = 1
+CHUNK_SIZE = 25
+MANIFEST_FNAME = '.scnlp_manifest.json'
+# number of processes for extracting parse trees (0 means all cores)
+PROCESSES = 1
+ISOLATE = False
+DOC_TIMEOUT = 0
+# extra time allowed for JVM startup and model loading
+STARTUP_TIMEOUT = 300
+QUARANTINE_FNAME = '.scnlp_quarantine.json'
+DEDUP = ''
+DEDUP_MODES = ['', 'link', 'copy']
 
 
 def core_nlp(input,
@@ -40,7 +73,15 @@ def core_nlp(input,
              options=OPTIONS,
              stamp=STAMP,
              resume=RESUME,
-             use_sr_parser=USE_SR_PARSER):
+             use_sr_parser=USE_SR_PARSER,
+             server=SERVER,
+             workers=WORKERS,
+             jvms=JVMS,
+             chunk_size=CHUNK_SIZE,
+             output_format=OUTPUT_FORMAT,
+             isolate=ISOLATE,
+             doc_timeout=DOC_TIMEOUT,
+             dedup=DEDUP):
     """
     Run Stanford CoreNLP
 
@@ -58,7 +99,39 @@ def core_nlp(input,
     options
     stamp
     resume
+        only process files which have no complete output yet, or whose
+        input text, annotators, options or version changed since the
+        output was created
     use_sr_parser
+    server : str
+        url(s) of running CoreNLP server(s), separated by commas;
+        if given, documents are sent to the server(s) instead of starting
+        a new JVM
+    workers : int
+        number of concurrent requests to CoreNLP server(s)
+    jvms : int
+        number of JVMs to run in parallel, each with its own heap of size
+        memory and its own threads
+    chunk_size : int
+        number of files passed to a JVM at once when running multiple JVMs
+    output_format : str
+        'xml' or 'json', the output formats which can be read by all
+        further processing steps; an output_ext of '.xml' is then replaced
+        by '.json'
+    isolate : bool
+        isolate failing documents: when CoreNLP runs out of memory or times
+        out, the offending input is quarantined and processing restarts on
+        the remaining files; quarantined files are listed in the quarantine
+        file in out_dir and skipped on resume (other failures still raise
+        CalledProcessError)
+    doc_timeout : int
+        max time in seconds for a single document when isolating failures
+        (0 means no timeout)
+    dedup : str
+        '' to process every input file, 'link' or 'copy' to process only one
+        of several input files with identical content and to hard link
+        (falling back to copying) or copy its output to the output filenames
+        of the duplicates
 
     Returns
     -------
@@ -67,6 +140,201 @@ def core_nlp(input,
     in_files = file_list(input)
     make_dir(out_dir)
 
+    if output_format not in ('xml', 'json'):
+        raise ValueError('unsupported output format: {}'.format(output_format))
+
+    if dedup not in DEDUP_MODES:
+        raise ValueError('unsupported dedup mode: {}'.format(dedup))
+
+    if output_format != 'xml' and output_ext == '.xml':
+        output_ext = '.' + output_format
+
+    if stamp:
+        replace_ext = True
+        output_ext = stamped_ext(version, output_ext)
+
+    out_files = {fname: output_path(fname, out_dir, output_ext, replace_ext)
+                 for fname in in_files}
+    fingerprints = {fname: fingerprint(fname, annotators, options, version,
+                                       use_sr_parser)
+                    for fname in in_files}
+    manifest_fname = Path(out_dir or '.') / MANIFEST_FNAME
+    manifest = read_manifest(manifest_fname)
+
+    quarantine = read_quarantine(out_dir)
+
+    if resume:
+        in_files = resume_files(in_files, out_files, fingerprints, manifest,
+                                quarantine if isolate else None)
+
+    duplicates = {}
+
+    if dedup:
+        in_files, duplicates = _dedup(in_files, out_files, fingerprints,
+                                      manifest)
+
+        if dedup == 'link':
+            # CoreNLP overwrites output in place, which would also change
+            # any hard links to it
+            for fname in in_files:
+                if out_files[fname].exists():
+                    out_files[fname].unlink()
+
+    if not in_files and not duplicates:
+        return ''
+
+    # snapshot of output files, to tell which outputs are written in this run
+    mtimes = {fname: _mtime_ns(out_files[fname]) for fname in in_files}
+
+    try:
+        if not in_files:
+            # only duplicates of files processed before
+            return ''
+
+        if server:
+            properties = scnlp_server.options_to_properties(options)
+            properties['outputFormat'] = output_format
+
+            if annotators:
+                properties['annotators'] = annotators
+
+            if 'parse' in annotators and use_sr_parser:
+                properties['parse.model'] = SR_PARSER_MODEL
+
+            file_pairs = [(fname, out_files[fname]) for fname in in_files]
+            log.info('annotating {} files on CoreNLP server {}'.format(
+                len(file_pairs), server))
+            failures = scnlp_server.annotate_files(
+                file_pairs, server.split(','), properties, workers=workers,
+                timeout=doc_timeout or scnlp_server.TIMEOUT)
+
+            if failures and not isolate:
+                raise RuntimeError('CoreNLP server failed on {} files'.format(
+                    len(failures)))
+
+            quarantine.update(failures)
+            return ''
+
+        cmd = _core_nlp_cmd(out_dir, annotators, class_path, memory, threads,
+                            replace_ext, output_ext, options, use_sr_parser,
+                            output_format)
+
+        if isolate:
+            # make the JVM exit rather than limp on after running out of heap
+            cmd.insert(1, '-XX:+ExitOnOutOfMemoryError')
+
+            def run(files):
+                return _run_isolating(cmd, files, out_files, threads,
+                                      doc_timeout, quarantine)
+        else:
+            def run(files):
+                return _run_jvm(cmd, files)
+
+        if jvms > 1:
+            return _run_sharded(run, in_files, jvms, chunk_size)
+
+        return run(in_files)
+    finally:
+        for canonical, dup_files in duplicates.items():
+            if is_complete(out_files[canonical]):
+                for fname in dup_files:
+                    _materialize(out_files[canonical], out_files[fname],
+                                 dedup)
+                    manifest[out_files[fname].name] = fingerprints[fname]
+
+        # record outputs completed in this run, even if CoreNLP crashed
+        # halfway
+        for fname in in_files:
+            out_fname = out_files[fname]
+            if _completed(out_fname, mtimes[fname]):
+                manifest[out_fname.name] = fingerprints[fname]
+            else:
+                manifest.pop(out_fname.name, None)
+
+        write_manifest(manifest_fname, manifest)
+
+        if isolate:
+            write_quarantine(out_dir, quarantine)
+            quarantine_report(out_dir)
+
+
+def _dedup(in_files, out_files, fingerprints, manifest):
+    """
+    Select a single canonical file from each group of input files with
+    identical content
+
+    An input file whose output is already up to date is preferred as
+    canonical file, as it needs no processing at all.
+
+    Returns
+    -------
+    in_files : list
+        canonical input files to be processed
+    duplicates : dict
+        mapping of each canonical file to the input files, in need of
+        processing, that are duplicates of it
+    """
+    todo = set(in_files)
+    groups = {}
+
+    for fname in sorted(fingerprints):
+        groups.setdefault(fingerprints[fname]['input'], []).append(fname)
+
+    in_files = []
+    duplicates = {}
+
+    for fnames in groups.values():
+        pending = [fname for fname in fnames if fname in todo]
+
+        if not pending:
+            continue
+
+        done = [fname for fname in fnames
+                if fname not in todo and
+                up_to_date(out_files[fname], fingerprints[fname], manifest)]
+
+        if done:
+            canonical = done[0]
+        else:
+            canonical = pending.pop(0)
+            in_files.append(canonical)
+
+        if pending:
+            duplicates[canonical] = pending
+
+    log.info('{} duplicate input files are not processed'.format(
+        sum(len(fnames) for fnames in duplicates.values())))
+    return in_files, duplicates
+
+
+def _materialize(src_fname, dest_fname, dedup):
+    """
+    Hard link or copy output of canonical file to output of duplicate file
+    """
+    log.info('{} output of {} to {}'.format(dedup, src_fname, dest_fname))
+    tmp_fname = dest_fname.with_name(dest_fname.name + '.tmp')
+
+    if tmp_fname.exists():
+        tmp_fname.unlink()
+
+    if dedup == 'link':
+        try:
+            os.link(str(src_fname), str(tmp_fname))
+        except OSError:
+            # e.g. file system without support for hard links
+            shutil.copyfile(str(src_fname), str(tmp_fname))
+    else:
+        shutil.copyfile(str(src_fname), str(tmp_fname))
+
+    tmp_fname.replace(dest_fname)
+
+
+def _core_nlp_cmd(out_dir, annotators, class_path, memory, threads,
+                  replace_ext, output_ext, options, use_sr_parser,
+                  output_format=OUTPUT_FORMAT):
+    """
+    Build CoreNLP command, without the -filelist option
+    """
     cmd = ['java']
 
     if memory:
@@ -81,9 +349,8 @@ def core_nlp(input,
     if annotators:
         cmd.append('-annotators ' + annotators)
 
-    if stamp:
-        replace_ext = True
-        output_ext = '#scnlp_v{}{}'.format(version or '', output_ext)
+    if output_format != 'xml':
+        cmd.append('-outputFormat ' + output_format)
 
     if replace_ext:
         cmd.append('-replaceExtension')
@@ -97,26 +364,24 @@ def core_nlp(input,
     if threads:
         cmd.append('-threads {}'.format(threads))
 
-    if resume:
-        in_files = [fname for fname in in_files
-                    if not derive_path(fname,
-                                       new_dir=out_dir,
-                                       new_ext=output_ext).exists()]
-
     if options:
         cmd.append(options)
 
     if 'parse' in annotators and use_sr_parser:
-        cmd.append(
-            '-parse.model edu/stanford/nlp/models/srparser/englishSR.ser.gz')
+        cmd.append('-parse.model ' + SR_PARSER_MODEL)
+
+    return cmd
+
 
+def _run_jvm(cmd, in_files):
+    """
+    Run a single CoreNLP JVM on a list of input files
+    """
     # create a temporary file with input filenames
     tmp_file = NamedTemporaryFile("wt", buffering=1)
     tmp_file.write('\n'.join(in_files) + "\n")
 
-    cmd.append('-filelist ' + tmp_file.name)
-
-    cmd = ' '.join(cmd)
+    cmd = ' '.join(cmd + ['-filelist ' + tmp_file.name])
     log.info('\n' + cmd)
     ret = check_output(cmd, shell=True, universal_newlines=True)
     log.info('\n {}'.format(ret))
@@ -124,55 +389,624 @@ def core_nlp(input,
     return ret
 
 
-def extract_parse_trees(scnlp_files, parse_dir):
+def _run_isolating(cmd, in_files, out_files, threads, doc_timeout,
+                   quarantine):
+    """
+    Run CoreNLP JVMs on a list of input files, isolating failing files
+
+    Whenever the JVM fails or times out, the remaining files without output
+    are determined. As CoreNLP processes files in list order, the failing
+    file must be among the first of these, one per thread. A single suspect
+    is quarantined right away; multiple suspects are first run one by one to
+    find the culprit(s). Processing then restarts on the remaining files.
+
+    Only running out of memory and timing out are blamed on documents. A JVM
+    exiting with any other error raises CalledProcessError if it wrote no
+    output at all, as it then failed for reasons unrelated to the documents
+    (e.g. a wrong class path), or if it was run on a single suspect.
+    """
+    rets = []
+    remaining = list(in_files)
+
+    while remaining:
+        mtimes = {fname: _mtime_ns(out_files[fname]) for fname in remaining}
+
+        try:
+            ret, reason = _run_jvm_watched(cmd, remaining, out_files,
+                                           doc_timeout)
+        except CalledProcessError as err:
+            error = err
+            ret, reason = err.output, 'exit status {}'.format(err.returncode)
+        else:
+            error = None
+
+        rets.append(ret)
+        n_remaining = len(remaining)
+        remaining = [fname for fname in remaining
+                     if not _completed(out_files[fname], mtimes[fname])]
+
+        if not remaining:
+            break
+
+        if reason is None:
+            # JVM succeeded, but without producing output for some files
+            for fname in remaining:
+                _quarantine(quarantine, fname, 'no output')
+            break
+
+        suspects = remaining[:max(1, threads)]
+
+        if error is not None and (len(remaining) == n_remaining or
+                                  len(suspects) == 1):
+            raise error
+
+        remaining = remaining[len(suspects):]
+
+        if len(suspects) == 1:
+            _quarantine(quarantine, suspects[0], reason)
+            continue
+
+        log.warning('CoreNLP failed ({}); running {} suspect files '
+                    'one by one'.format(reason, len(suspects)))
+
+        for fname in suspects:
+            mtime = _mtime_ns(out_files[fname])
+            ret, reason = _run_jvm_watched(cmd, [fname], out_files,
+                                           doc_timeout)
+            rets.append(ret)
+
+            if not _completed(out_files[fname], mtime):
+                _quarantine(quarantine, fname, reason or 'no output')
+
+        if remaining:
+            log.warning('restarting CoreNLP on {} remaining files'.format(
+                len(remaining)))
+
+    return ''.join(rets)
+
+
+def _run_jvm_watched(cmd, in_files, out_files, doc_timeout):
+    """
+    Run a single CoreNLP JVM on a list of input files, killing it when no
+    output appears within doc_timeout seconds
+
+    Returns the JVM output and the reason of failure (running out of memory
+    or timing out), or None on success. Raises CalledProcessError if the JVM
+    fails otherwise.
+    """
+    tmp_file = NamedTemporaryFile("wt", buffering=1)
+    tmp_file.write('\n'.join(in_files) + "\n")
+
+    cmd = ' '.join(cmd + ['-filelist ' + tmp_file.name])
+    log.info('\n' + cmd)
+    # run in its own session, so the JVM can be killed along with the shell
+    proc = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT,
+                 universal_newlines=True, start_new_session=True)
+    lines = []
+    reader = Thread(target=lambda: lines.extend(proc.stdout))
+    reader.start()
+
+    mtimes = {fname: _mtime_ns(out_files[fname]) for fname in in_files}
+    last_progress = time.time()
+    deadline = STARTUP_TIMEOUT + doc_timeout
+    n_done = 0
+    reason = None
+
+    while proc.poll() is None:
+        time.sleep(1)
+
+        if not doc_timeout:
+            continue
+
+        done = sum(_completed(out_files[fname], mtimes[fname])
+                   for fname in in_files)
+
+        if done > n_done:
+            n_done = done
+            last_progress = time.time()
+            deadline = doc_timeout
+        elif time.time() - last_progress > deadline:
+            reason = 'timeout after {} seconds'.format(doc_timeout)
+            log.error('CoreNLP {}; killing JVM'.format(reason))
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+
+    reader.join()
+    ret = ''.join(lines)
+    log.info('\n {}'.format(ret))
+
+    if reason is None and proc.returncode != 0:
+        if 'OutOfMemoryError' not in ret:
+            log.error('CoreNLP failed with exit status {}'.format(
+                proc.returncode))
+            raise CalledProcessError(proc.returncode, cmd, output=ret)
+
+        reason = 'out of memory'
+        log.error('CoreNLP failed: {}'.format(reason))
+
+    return ret, reason
+
+
+def _mtime_ns(fname):
+    try:
+        return Path(fname).stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _completed(out_fname, mtime):
+    """
+    Check if output file is complete and was written after its modification
+    time was taken as mtime (None if it did not exist)
+
+    Comparing with a snapshot rather than with the start time of the run also
+    works on file systems with coarse timestamps.
+    """
+    return is_complete(out_fname) and _mtime_ns(out_fname) != mtime
+
+
+def _quarantine(quarantine, fname, reason):
+    log.error('quarantining {}: {}'.format(fname, reason))
+    quarantine[fname] = reason
+
+
+def read_quarantine(out_dir):
+    """
+    Read quarantine mapping input files that made CoreNLP fail to the reason
+    of failure
+    """
+    quarantine_fname = Path(out_dir or '.') / QUARANTINE_FNAME
+
+    try:
+        with quarantine_fname.open() as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        log.warning('ignoring unreadable quarantine file {}'.format(
+            quarantine_fname))
+        return {}
+
+
+def write_quarantine(out_dir, quarantine):
+    quarantine_fname = Path(out_dir or '.') / QUARANTINE_FNAME
+    tmp_fname = quarantine_fname.with_name(quarantine_fname.name + '.tmp')
+
+    with tmp_fname.open('w') as outf:
+        json.dump(quarantine, outf, indent=0, sort_keys=True)
+
+    tmp_fname.replace(quarantine_fname)
+
+
+def quarantine_report(out_dir):
+    """
+    Report input files quarantined because they made CoreNLP fail
+
+    To retry quarantined files, remove them from the quarantine file, or
+    remove the file altogether.
+    """
+    quarantine = read_quarantine(out_dir)
+
+    if quarantine:
+        log.warning('{} files quarantined in {}:\n{}'.format(
+            len(quarantine), Path(out_dir or '.') / QUARANTINE_FNAME,
+            '\n'.join('{}\t{}'.format(fname, reason)
+                      for fname, reason in sorted(quarantine.items()))))
+
+    return quarantine
+
+
+def _run_sharded(run, in_files, jvms, chunk_size):
+    """
+    Run multiple CoreNLP JVMs in parallel with work stealing
+
+    Input files are split into chunks, largest files first, which are dealt
+    round-robin to a queue per JVM. A JVM takes the next chunk from the front
+    of its own queue and, once that is empty, steals a chunk from the back of
+    the longest remaining queue, so no single shard becomes the straggler.
+    """
+    in_files = sorted(in_files, key=lambda fname: Path(fname).stat().st_size,
+                      reverse=True)
+    chunks = [in_files[i:i + chunk_size]
+              for i in range(0, len(in_files), chunk_size)]
+    queues = [deque(chunks[n::jvms]) for n in range(jvms)]
+    lock = Lock()
+
+    def next_chunk(n):
+        with lock:
+            if queues[n]:
+                return queues[n].popleft()
+
+            victim = max(queues, key=len)
+
+            if victim:
+                log.info('JVM {} stealing chunk from JVM {}'.format(
+                    n, queues.index(victim)))
+                return victim.pop()
+
+    def work(n):
+        rets = []
+        chunk = next_chunk(n)
+
+        while chunk:
+            rets.append(run(chunk))
+            chunk = next_chunk(n)
+
+        return ''.join(rets)
+
+    log.info('running {} JVMs on {} chunks of {} files'.format(
+        jvms, len(chunks), chunk_size))
+
+    with ThreadPoolExecutor(max_workers=jvms) as executor:
+        return ''.join(executor.map(work, range(jvms)))
+
+
+def stamped_ext(version=VERSION, output_ext=OUTPUT_EXT):
+    """
+    Output extension stamped with CoreNLP version
+    """
+    return '#scnlp_v{}{}'.format(version or '', output_ext)
+
+
+def output_path(fname, out_dir=OUT_DIR, output_ext=OUTPUT_EXT,
+                replace_ext=REPLACE_EXT):
+    """
+    Path of CoreNLP output file for input file, following the naming of
+    CoreNLP's -outputDirectory, -outputExtension and -replaceExtension options
+    """
+    name = Path(fname).name
+
+    if replace_ext and '.' in name:
+        name = name[:name.rindex('.')]
+
+    return Path(out_dir or '.') / (name + output_ext)
+
+
+def fingerprint(fname, annotators, options, version, use_sr_parser):
+    """
+    Fingerprint of everything determining the CoreNLP output for a file
+    """
+    return dict(input=hashlib.sha1(Path(fname).read_bytes()).hexdigest(),
+                annotators=annotators,
+                options=options,
+                version=version,
+                parse_model=(SR_PARSER_MODEL
+                             if 'parse' in annotators and use_sr_parser
+                             else ''))
+
+
+def up_to_date(out_fname, fingerprint, manifest):
+    """
+    Check if output file is complete and recorded in manifest with the given
+    fingerprint
+    """
+    return (manifest.get(out_fname.name) == fingerprint and
+            is_complete(out_fname))
+
+
+def resume_files(in_files, out_files, fingerprints, manifest,
+                 quarantine=None):
+    """
+    Select input files which have no complete output yet, or whose input
+    text, annotators, options or version changed since the output was
+    created, leaving out any files in quarantine
+
+    Parameters
+    ----------
+    in_files : list
+        input files
+    out_files : dict
+        mapping of input files to output files
+    fingerprints : dict
+        mapping of input files to their fingerprint (see fingerprint)
+    manifest : dict
+        mapping of names of output files to the fingerprint of their input
+        when they were created
+    quarantine : dict
+        mapping of quarantined input files to the reason of failure
+    """
+    in_files = [fname for fname in in_files
+                if not up_to_date(out_files[fname], fingerprints[fname],
+                                  manifest)]
+    log.info('resuming with {} new, changed or incomplete files'.format(
+        len(in_files)))
+
+    if quarantine:
+        n_files = len(in_files)
+        in_files = [fname for fname in in_files if fname not in quarantine]
+        log.warning('skipping {} quarantined files'.format(
+            n_files - len(in_files)))
+
+    return in_files
+
+
+def is_complete(out_fname):
+    """
+    Check if CoreNLP output file exists and is complete,
+    i.e. not truncated by a crashed or killed JVM
+    """
+    try:
+        with Path(out_fname).open('rb') as f:
+            f.seek(0, 2)
+            f.seek(max(0, f.tell() - 64))
+            tail = f.read().rstrip()
+    except FileNotFoundError:
+        return False
+
+    if Path(out_fname).suffix == '.xml':
+        return tail.endswith(b'</root>')
+
+    if Path(out_fname).suffix == '.json':
+        return tail.endswith(b'}')
+
+    return bool(tail)
+
+
+def shift_offsets(sent_elem, shift):
+    """
+    Shift character offsets of all tokens in sentence element
+    """
+    for tag in 'CharacterOffsetBegin', 'CharacterOffsetEnd':
+        for offset_elem in sent_elem.iter(tag):
+            offset_elem.text = str(int(offset_elem.text) + shift)
+
+
+def write_document(sent_elems, out_fname):
+    """
+    Write sentence elements as a CoreNLP XML document
+
+    Sentences are renumbered in the given order. The file is written to a
+    temporary file first and then renamed, so output is never partial.
+    """
+    root = Element('root')
+    sentences_elem = SubElement(SubElement(root, 'document'), 'sentences')
+
+    for sent_n, sent_elem in enumerate(sent_elems, 1):
+        sent_elem.set('id', str(sent_n))
+        sentences_elem.append(sent_elem)
+
+    out_fname = Path(out_fname)
+    tmp_fname = out_fname.with_name(out_fname.name + '.tmp')
+    tmp_fname.write_bytes(tostring(root, encoding='UTF-8', xml_declaration=True,
+                                   pretty_print=True))
+    tmp_fname.replace(out_fname)
+
+
+def iter_sentences(scnlp_fname):
+    """
+    Iterate over sentence elements in Stanford CoreNLP XML output
+
+    The file is parsed incrementally and each sentence is cleared after
+    processing, so memory use stays flat regardless of document size.
+    """
+    for _, sent_elem in iterparse(str(scnlp_fname), tag='sentence'):
+        # skip sentence references in coreference mentions
+        if sent_elem.getparent().tag != 'sentences':
+            continue
+
+        yield sent_elem
+
+        sent_elem.clear()
+        # also drop references to preceding, already processed sentences
+        while sent_elem.getprevious() is not None:
+            del sent_elem.getparent()[0]
+
+
+def annotation_path(scnlp_fname):
+    """
+    Find the CoreNLP annotation file to read for a CoreNLP output file
+
+    The suffix of scnlp_fname is ignored. Returns the path of an up-to-date
+    annotation store if one exists, otherwise that of the most recent output
+    file in any of the supported output formats (e.g. the JSON output of a
+    rerun with output_format='json' rather than the XML output of an earlier
+    run).
+    """
+    scnlp_fname = Path(scnlp_fname)
+    candidates = [scnlp_fname.with_suffix(ext) for ext in FORMAT_EXTS]
+    candidates = [fname for fname in candidates if fname.exists()]
+    store_fname = scnlp_fname.with_suffix(annstore.EXT)
+
+    if store_fname.exists() and all(
+            fname.stat().st_mtime <= store_fname.stat().st_mtime
+            for fname in candidates):
+        return store_fname
+
+    if candidates:
+        return _newest(candidates)
+
+    raise FileNotFoundError('no CoreNLP output found for {}'.format(
+        scnlp_fname))
+
+
+def _newest(fnames):
+    # on equal modification times, the first file is taken
+    return max(fnames, key=lambda fname: Path(fname).stat().st_mtime_ns)
+
+
+def annotation_files(scnlp_files):
+    """
+    List CoreNLP output files in any of the supported output formats
+
+    For a directory holding output of the same document in more than one
+    format, only the most recent output file is listed.
+    """
+    if isinstance(scnlp_files, str) and isdir(scnlp_files):
+        outputs = {}
+
+        for ext in FORMAT_EXTS:
+            for fname in file_list(scnlp_files, '*' + ext):
+                outputs.setdefault(fname[:-len(ext)], []).append(fname)
+
+        return sorted(_newest(fnames) for fnames in outputs.values())
+
+    return file_list(scnlp_files)
+
+
+def read_sentences(scnlp_fname):
+    """
+    Iterate over sentences in Stanford CoreNLP output as Sentence tuples
+
+    Reads from the annotation store if it exists and is up to date,
+    otherwise from the CoreNLP output in XML or JSON format.
+    """
+    fname = annotation_path(scnlp_fname)
+
+    if fname.suffix == annstore.EXT:
+        with AnnotationStore(fname) as store:
+            yield from store
+    elif fname.suffix == '.json':
+        yield from _json_sentences(fname)
+    else:
+        for sent_elem in iter_sentences(fname):
+            yield _xml_sentence(sent_elem)
+
+
+@contextmanager
+def load_sentences(scnlp_fname):
+    """
+    Load sentences in Stanford CoreNLP output for random access
+
+    A context manager providing a memory-mapped annotation store if one
+    exists and is up to date, otherwise a list of Sentence tuples read from
+    the CoreNLP output. The store is closed on exit, e.g.
+
+        with load_sentences(scnlp_fname) as sentences:
+            parse = sentences[0].parse
+    """
+    fname = annotation_path(scnlp_fname)
+
+    if fname.suffix == annstore.EXT:
+        with AnnotationStore(fname) as store:
+            yield store
+    else:
+        yield list(read_sentences(fname))
+
+
+def load_offset_index(scnlp_fname, sentences=None):
+    """
+    Load offset index for Stanford CoreNLP output
+
+    The index is stored next to the CoreNLP output and (re)built when it is
+    missing or older than the annotations, from the given sentences or else
+    by reading the annotations.
+
+    Parameters
+    ----------
+    scnlp_fname : str or Path
+        CoreNLP output file, where the suffix is ignored
+    sentences : iterable of Sentence tuples
+        sentences already read from the annotations, if any
+
+    Returns
+    -------
+    index : annstore.OffsetIndex
+    """
+    source_fname = annotation_path(scnlp_fname)
+    index_fname = source_fname.with_suffix(annstore.INDEX_EXT)
+
+    if (not index_fname.exists() or
+            index_fname.stat().st_mtime < source_fname.stat().st_mtime):
+        log.info('writing {}'.format(index_fname))
+        write_index(index_fname, read_sentences(source_fname)
+                    if sentences is None else sentences)
+
+    return OffsetIndex(index_fname)
+
+
+def _xml_sentence(sent_elem):
+    lemmas = []
+    begins = []
+    ends = []
+
+    for token_elem in sent_elem.iterfind('tokens/token'):
+        lemmas.append(token_elem.findtext('lemma'))
+        begins.append(int(token_elem.findtext('CharacterOffsetBegin')))
+        ends.append(int(token_elem.findtext('CharacterOffsetEnd')))
+
+    return Sentence(lemmas, begins, ends, sent_elem.findtext('parse'))
+
+
+def _json_sentences(json_fname):
+    with Path(json_fname).open(encoding='utf-8') as inf:
+        doc = json.load(inf)
+
+    for sent in doc['sentences']:
+        tokens = sent['tokens']
+        # the JSON output has parse trees pretty-printed over multiple lines
+        parse = sent.get('parse')
+        if parse is not None:
+            parse = ' '.join(parse.split())
+        yield Sentence([token.get('lemma') for token in tokens],
+                       [token['characterOffsetBegin'] for token in tokens],
+                       [token['characterOffsetEnd'] for token in tokens],
+                       parse)
+
+
+def convert_to_store(scnlp_files, processes=PROCESSES):
+    """
+    Convert Stanford CoreNLP output to compact annotation stores
+
+    Writes a memory-mappable store with only lemmas, token offsets and parse
+    trees next to each XML or JSON file, which is then read instead by
+    extract_lemmatized_parse_trees, add_offsets and vars_to_csv.
+    """
+    process_files(_convert_to_store, annotation_files(scnlp_files),
+                  processes=processes)
+
+
+def _convert_to_store(scnlp_fname):
+    store_fname = Path(scnlp_fname).with_suffix(annstore.EXT)
+    log.info('writing {}'.format(store_fname))
+    write_store(store_fname, read_sentences(scnlp_fname))
+
+
+def extract_parse_trees(scnlp_files, parse_dir, processes=PROCESSES):
     """
     extract parse trees (PTB labeled bracket structures) from Stanford
-    CoreNLP XML ouput
+    CoreNLP XML or JSON ouput
     """
     make_dir(parse_dir)
+    process_files(_extract_parse_trees, annotation_files(scnlp_files),
+                  parse_dir, processes=processes)
 
-    for scnlp_fname in file_list(scnlp_files, "*.xml"):
-        nlp_doc = ElementTree(file=scnlp_fname)
 
-        parse_fname = derive_path(scnlp_fname,
-                                  new_dir=parse_dir,
-                                  new_ext='.parse')
-        log.info('writing {}'.format(parse_fname))
+def _extract_parse_trees(scnlp_fname, parse_dir):
+    parse_fname = derive_path(scnlp_fname,
+                              new_dir=parse_dir,
+                              new_ext='.parse')
+    log.info('writing {}'.format(parse_fname))
 
-        with open(parse_fname, "wt", encoding="utf-8") as parse_file:
-            for parse_elem in nlp_doc.findall(".//parse"):
-                parse_file.write(parse_elem.text + "\n")
+    with open(parse_fname, "wt", encoding="utf-8") as parse_file:
+        for sentence in read_sentences(scnlp_fname):
+            parse_file.write(sentence.parse + "\n")
 
 
-def extract_lemmatized_parse_trees(scnlp_files, parse_dir):
+def extract_lemmatized_parse_trees(scnlp_files, parse_dir,
+                                   processes=PROCESSES):
     """
     extract lemmatzied parse trees (PTB labeled bracket structures) from
-    Stanford CoreNLP XML ouput
+    Stanford CoreNLP XML or JSON ouput
     """
     make_dir(parse_dir)
+    process_files(_extract_lemmatized_parse_trees,
+                  annotation_files(scnlp_files), parse_dir,
+                  processes=processes)
 
-    for scnlp_fname in file_list(scnlp_files, "*.xml"):
-        nlp_doc = ElementTree(file=scnlp_fname)
 
-        parse_fname = derive_path(scnlp_fname,
-                                  new_dir=parse_dir,
-                                  new_ext='.parse')
-        log.info('writing {}'.format(parse_fname))
+def _extract_lemmatized_parse_trees(scnlp_fname, parse_dir):
+    parse_fname = derive_path(scnlp_fname,
+                              new_dir=parse_dir,
+                              new_ext='.parse')
+    log.info('writing {}'.format(parse_fname))
 
-        with parse_fname.open("wt", encoding="utf-8") as parse_file:
-            for sentence_elem in nlp_doc.iterfind(".//sentence"):
-                lemmas = sentence_elem.iterfind("tokens/token/lemma")
-                word_parse = sentence_elem.find("parse").text.strip()
-                lemma_parse = " ".join(_lemmatized_node(node, lemmas)
-                                       for node in word_parse.split(" "))
-                parse_file.write(lemma_parse + "\n")
+    with parse_fname.open("wt", encoding="utf-8") as parse_file:
+        for sentence in read_sentences(scnlp_fname):
+            tree = ParseTree.fromstring(sentence.parse, multiword_leaves=True)
+            lemmas = iter(sentence.lemmas)
 
+            for n in range(len(tree)):
+                if tree.is_leaf(n):
+                    tree.labels[n] = next(lemmas)
 
-def _lemmatized_node(node, lemmas):
-    if node.startswith("("):
-        # non-terminal node
-        return node
-    else:
-        # terminal
-        brackets = "".join(node.partition(")")[1:])
-        return next(lemmas).text + brackets
+            parse_file.write(tree.tostring() + "\n")
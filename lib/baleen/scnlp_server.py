@@ -0,0 +1,496 @@
+"""
+Persistent Stanford CoreNLP server and client
+
+Runs CoreNLP as a long-lived server which keeps its annotator pipelines
+loaded, so the JVM startup and model loading is paid only once instead of on
+every call to core_nlp. Also provides a stand-in server which mimics the
+CoreNLP server API, allowing the client to be run and tested offline without
+Java or CoreNLP models.
+"""
+
+import json
+import logging
+import os
+import re
+import shlex
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from pathlib import Path
+from subprocess import Popen, STDOUT, TimeoutExpired
+from tempfile import gettempdir
+from threading import local
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+import requests
+
+log = logging.getLogger(__name__)
+
+# silence request logging
+logging.getLogger("requests.packages.urllib3.connectionpool").setLevel(
+    logging.WARNING)
+
+HOST = 'localhost'
+PORT = 9000
+MEMORY = '4g'
+WORKERS = 4
+TIMEOUT = 600
+PRELOAD = 'tokenize,ssplit,pos,lemma,parse'
+STATE_DIR = gettempdir()
+START_WAIT = 300
+# max time in seconds for a running server to respond to a status request
+STATUS_WAIT = 5
+
+
+def server_url(host=HOST, port=PORT):
+    return 'http://{}:{}'.format(host, port)
+
+
+def _pid_fname(port, state_dir=STATE_DIR):
+    return Path(state_dir) / 'baleen-scnlp-server-{}.pid'.format(port)
+
+
+def start_server(class_path,
+                 port=PORT,
+                 memory=MEMORY,
+                 threads=WORKERS,
+                 timeout=TIMEOUT,
+                 preload=PRELOAD,
+                 state_dir=STATE_DIR,
+                 wait=START_WAIT):
+    """
+    Start a persistent Stanford CoreNLP server
+
+    Parameters
+    ----------
+    class_path : str
+        directory containing the CoreNLP jar files
+    port : int
+        port number of server
+    memory : str
+        max Java heap size
+    threads : int
+        number of worker threads, i.e. annotator pipelines kept warm
+    timeout : int
+        max time in seconds for annotating a single document
+    preload : str
+        annotators to load on startup
+    state_dir : str
+        directory for pid and log file of server
+    wait : int
+        max time in seconds to wait for server to come up
+
+    Returns
+    -------
+    pid : int
+        process id of server, which is that of the server already running if
+        its pid file exists and it responds to requests (a stale pid file is
+        removed)
+
+    Raises
+    ------
+    RuntimeError
+        if the server does not come up within wait seconds, in which case it
+        is terminated
+    """
+    pid_fname = _pid_fname(port, state_dir)
+
+    if pid_fname.exists():
+        try:
+            pid = int(pid_fname.read_text())
+        except ValueError:
+            pid = None
+
+        if (pid is not None and _is_running(pid) and
+                wait_for_server(server_url(port=port), STATUS_WAIT)):
+            log.info('CoreNLP server on port {} already running '
+                     '(pid={})'.format(port, pid))
+            return pid
+
+        log.warning('removing stale pid file {} of CoreNLP server which is '
+                    'no longer running'.format(pid_fname))
+        pid_fname.unlink()
+
+    cmd = ['java']
+
+    if memory:
+        cmd.append('-Xmx' + memory)
+
+    if class_path:
+        cmd += ['-cp', join(class_path, '*')]
+
+    cmd += ['edu.stanford.nlp.pipeline.StanfordCoreNLPServer',
+            '-port', str(port),
+            '-threads', str(threads),
+            '-timeout', str(timeout * 1000)]
+
+    if preload:
+        cmd += ['-preload', preload]
+
+    log_fname = pid_fname.with_suffix('.log')
+    log.info('\n' + ' '.join(shlex.quote(part) for part in cmd))
+    # detach server from process group, so it survives the pipeline step
+    proc = Popen(cmd, stdout=log_fname.open('w'), stderr=STDOUT,
+                 start_new_session=True)
+    pid_fname.write_text(str(proc.pid))
+
+    if not wait_for_server(server_url(port=port), wait):
+        # clean up, so a dead server does not block the next start
+        proc.terminate()
+
+        try:
+            proc.wait(timeout=10)
+        except TimeoutExpired:
+            proc.kill()
+
+        pid_fname.unlink()
+        raise RuntimeError('CoreNLP server did not come up within {} seconds; '
+                           'see {}'.format(wait, log_fname))
+
+    log.info('Started CoreNLP server at {} (pid={})'.format(
+        server_url(port=port), proc.pid))
+    return proc.pid
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process exists, but belongs to another user
+        pass
+
+    return True
+
+
+def stop_server(port=PORT, state_dir=STATE_DIR):
+    """
+    Stop a persistent Stanford CoreNLP server
+    """
+    pid_fname = _pid_fname(port, state_dir)
+
+    try:
+        pid = int(pid_fname.read_text())
+    except FileNotFoundError:
+        log.error('no CoreNLP server running on port {}'.format(port))
+        return
+
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        log.warning('CoreNLP server process {} no longer exists'.format(pid))
+
+    pid_fname.unlink()
+    log.info('Stopped CoreNLP server on port {} (pid={})'.format(port, pid))
+
+
+def wait_for_server(url, wait=START_WAIT, interval=1):
+    """
+    Wait until server at url responds; return True if it does
+    """
+    deadline = time.time() + wait
+
+    while time.time() < deadline:
+        try:
+            requests.get(url + '/live', timeout=interval)
+        except requests.exceptions.RequestException:
+            time.sleep(interval)
+        else:
+            return True
+
+    return False
+
+
+def options_to_properties(options):
+    """
+    Convert CoreNLP command line options to a dict of properties
+
+    E.g. '-ssplit.eolonly -parse.maxlen 80' is converted to
+    {'ssplit.eolonly': 'true', 'parse.maxlen': '80'}
+    """
+    properties = {}
+    key = None
+
+    for part in shlex.split(options or ''):
+        if part.startswith('-') and not _is_number(part):
+            key = part.lstrip('-')
+            properties[key] = 'true'
+        elif key:
+            properties[key] = part
+            key = None
+        else:
+            log.warning('ignoring option value {!r} without key'.format(part))
+
+    return properties
+
+
+def _is_number(s):
+    try:
+        float(s)
+    except ValueError:
+        return False
+    return True
+
+
+# one requests session per thread for connection reuse
+_thread_data = local()
+
+
+def _session():
+    try:
+        return _thread_data.session
+    except AttributeError:
+        _thread_data.session = requests.Session()
+        return _thread_data.session
+
+
+def annotate(text, url, properties, timeout=TIMEOUT):
+    """
+    Annotate text on a CoreNLP server and return the output as bytes
+    """
+    properties = dict(properties)
+    properties.setdefault('outputFormat', 'xml')
+    response = _session().post(url,
+                               params={'properties': json.dumps(properties)},
+                               data=text.encode('utf-8'),
+                               headers={'Content-Type':
+                                        'text/plain; charset=utf-8'},
+                               timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def annotate_files(file_pairs, urls, properties,
+                   workers=WORKERS,
+                   timeout=TIMEOUT):
+    """
+    Annotate files on one or more CoreNLP servers
+
+    Documents are streamed to the servers by a pool of worker threads,
+    distributing them round-robin over the server urls.
+
+    Parameters
+    ----------
+    file_pairs : list of (str, Path) tuples
+        pairs of input text filename and output filename
+    urls : list of str
+        server urls
+    properties : dict
+        CoreNLP properties, including annotators
+    workers : int
+        number of concurrent requests
+    timeout : int
+        max time in seconds for annotating a single document
+
+    Returns
+    -------
+    failures : dict
+        mapping of input filenames that failed to the reason of failure
+    """
+    def work(i, in_fname, out_fname):
+        url = urls[i % len(urls)]
+        text = Path(in_fname).read_text(encoding='utf-8')
+        content = annotate(text, url, properties, timeout=timeout)
+        # write to temp file and rename, so output is never partial
+        tmp_fname = Path(out_fname).with_name(Path(out_fname).name + '.tmp')
+        tmp_fname.write_bytes(content)
+        tmp_fname.replace(out_fname)
+        log.info('wrote {}'.format(out_fname))
+
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(work, i, in_fname, out_fname): in_fname
+                   for i, (in_fname, out_fname) in enumerate(file_pairs)}
+        for future, in_fname in futures.items():
+            try:
+                future.result()
+            except requests.exceptions.ReadTimeout:
+                failures[in_fname] = 'timeout after {} seconds'.format(timeout)
+            except requests.exceptions.HTTPError as err:
+                # server is up, but failed on this document;
+                # other errors such as a refused connection are fatal
+                failures[in_fname] = str(err)
+
+            if in_fname in failures:
+                log.error('annotating {} failed: {}'.format(
+                    in_fname, failures[in_fname]))
+
+    return failures
+
+
+# -----------------------------------------------------------------------------
+# Stand-in server
+# -----------------------------------------------------------------------------
+
+TOKEN_RE = re.compile(r"\w+(?:[-'.]\w+)*|[^\w\s]")
+SENT_END = {'.', '!', '?'}
+PTB_ESCAPES = {'(': '-LRB-', ')': '-RRB-', '[': '-LSB-', ']': '-RSB-',
+               '{': '-LCB-', '}': '-RCB-'}
+
+
+def standin_annotate(text, properties):
+    """
+    Mimic CoreNLP XML or JSON output with trivial tokenization, sentence
+    splitting, tagging and flat parse trees
+    """
+    annotators = properties.get('annotators', PRELOAD).split(',')
+    eol_only = properties.get('ssplit.eolonly') == 'true'
+    newline_break = properties.get('ssplit.newlineIsSentenceBreak') in (
+        'always', 'two')
+
+    sentences = []
+    tokens = []
+
+    for line_match in re.finditer(r'[^\n]*\n?', text):
+        line_start = line_match.start()
+
+        for match in TOKEN_RE.finditer(line_match.group()):
+            tokens.append((match.group(), line_start + match.start(),
+                           line_start + match.end()))
+            if not eol_only and match.group() in SENT_END:
+                sentences.append(tokens)
+                tokens = []
+
+        if tokens and (eol_only or newline_break):
+            sentences.append(tokens)
+            tokens = []
+
+    if tokens:
+        sentences.append(tokens)
+
+    if properties.get('outputFormat') == 'json':
+        return _standin_json(sentences, annotators)
+
+    return _standin_xml(sentences, annotators)
+
+
+def _standin_tokens(tokens):
+    for word, begin, end in tokens:
+        word = PTB_ESCAPES.get(word, word)
+        pos = '.' if word in SENT_END else 'NN'
+        yield word, begin, end, pos
+
+
+def _standin_parse(tokens):
+    return '(ROOT (S {}))'.format(' '.join(
+        '({} {})'.format(pos, word)
+        for word, _, _, pos in _standin_tokens(tokens)))
+
+
+def _standin_xml(sentences, annotators):
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<root>\n  <document>\n    <sentences>\n']
+
+    for sent_n, tokens in enumerate(sentences, 1):
+        parts.append('      <sentence id="{}">\n        <tokens>\n'.format(
+            sent_n))
+
+        for tok_n, (word, begin, end, pos) in enumerate(
+                _standin_tokens(tokens), 1):
+            parts.append('          <token id="{}">\n'
+                         '            <word>{}</word>\n'.format(tok_n,
+                                                                escape(word)))
+            if 'lemma' in annotators:
+                parts.append('            <lemma>{}</lemma>\n'.format(
+                    escape(word.lower())))
+            parts.append('            <CharacterOffsetBegin>{}'
+                         '</CharacterOffsetBegin>\n'
+                         '            <CharacterOffsetEnd>{}'
+                         '</CharacterOffsetEnd>\n'.format(begin, end))
+            if 'pos' in annotators:
+                parts.append('            <POS>{}</POS>\n'.format(pos))
+            parts.append('          </token>\n')
+
+        parts.append('        </tokens>\n')
+
+        if 'parse' in annotators:
+            parts.append('        <parse>{} </parse>\n'.format(
+                escape(_standin_parse(tokens))))
+
+        parts.append('      </sentence>\n')
+
+    parts.append('    </sentences>\n  </document>\n</root>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def _standin_json(sentences, annotators):
+    doc = {'sentences': []}
+
+    for sent_n, tokens in enumerate(sentences):
+        sent = {'index': sent_n, 'tokens': []}
+
+        for tok_n, (word, begin, end, pos) in enumerate(
+                _standin_tokens(tokens), 1):
+            token = {'index': tok_n,
+                     'word': word,
+                     'characterOffsetBegin': begin,
+                     'characterOffsetEnd': end}
+            if 'lemma' in annotators:
+                token['lemma'] = word.lower()
+            if 'pos' in annotators:
+                token['pos'] = pos
+            sent['tokens'].append(token)
+
+        if 'parse' in annotators:
+            sent['parse'] = _standin_parse(tokens)
+
+        doc['sentences'].append(sent)
+
+    return json.dumps(doc, indent=2).encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Request handler mimicking the CoreNLP server API
+    """
+
+    def do_GET(self):
+        self._respond(200, b'ok', 'text/plain')
+
+    def do_POST(self):
+        query = parse_qs(urlparse(self.path).query)
+        properties = json.loads(query.get('properties', ['{}'])[0])
+        length = int(self.headers.get('Content-Length', 0))
+        text = self.rfile.read(length).decode('utf-8')
+        content_type = ('application/json'
+                        if properties.get('outputFormat') == 'json'
+                        else 'application/xml')
+        self._respond(200, standin_annotate(text, properties),
+                      content_type + '; charset=utf-8')
+
+    def _respond(self, status, content, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def standin_server(host=HOST, port=PORT):
+    """
+    Create a stand-in CoreNLP server; call serve_forever() to run it
+    """
+    return ThreadingHTTPServer((host, port), StandInHandler)
+
+
+def run_standin_server(host=HOST, port=PORT):
+    """
+    Run a stand-in CoreNLP server for offline testing
+    """
+    server = standin_server(host, port)
+    log.info('Running stand-in CoreNLP server at {}'.format(
+        server_url(host, port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,321 @@
+"""
+Persistent cache of CoreNLP sentence analyses
+
+Caches the analysis of each sentence, keyed by sentence text plus annotator
+configuration, so that sentences seen before (e.g. boilerplate such as
+copyright or funding statements, or the same abstracts on a rebuild of the
+corpus) need not be parsed again.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from lxml.etree import ElementTree, fromstring, tostring, Element
+
+from baleen import scnlp
+from baleen.utils import file_list, make_dir, read_manifest, write_manifest
+
+log = logging.getLogger(__name__)
+
+CACHE_FILE = ''
+CACHE_SIZE = 1000000
+# number of uncached sentences per input file for CoreNLP
+MISSES_PER_FILE = 1000
+
+
+class SentenceCache:
+    """
+    Least recently used cache of sentence analyses in an SQLite database
+
+    Safe for use by multiple processes. Entries beyond max_size are evicted
+    on close.
+    """
+
+    def __init__(self, cache_file, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+        log.info('opening sentence cache {}'.format(cache_file))
+        self.conn = sqlite3.connect(str(cache_file), timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sentences '
+                          '(key TEXT PRIMARY KEY, value BLOB, used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS sentences_used '
+                          'ON sentences (used)')
+
+    def get_many(self, keys):
+        """
+        Return dict mapping those keys found in the cache to their values
+        """
+        found = {}
+        keys = list(keys)
+
+        # stay below SQLite's limit on number of query parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            query = ('SELECT key, value FROM sentences WHERE key IN ({})'
+                     .format(','.join('?' * len(batch))))
+            found.update(self.conn.execute(query, batch))
+
+        with self.conn:
+            self.conn.executemany('UPDATE sentences SET used = ? WHERE key = ?',
+                                  ((time.time(), key) for key in found))
+        return found
+
+    def put_many(self, items):
+        """
+        Store (key, value) pairs
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO sentences '
+                                  'VALUES (?, ?, ?)',
+                                  ((key, value, now) for key, value in items))
+
+    def evict(self):
+        """
+        Remove least recently used entries beyond max_size
+        """
+        count = self.conn.execute('SELECT count(*) FROM sentences').fetchone()[0]
+        excess = count - self.max_size
+
+        if excess > 0:
+            log.info('evicting {} sentences from cache'.format(excess))
+            with self.conn:
+                self.conn.execute('DELETE FROM sentences WHERE key IN '
+                                  '(SELECT key FROM sentences '
+                                  'ORDER BY used LIMIT ?)', (excess,))
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+
+def sentence_key(text, config):
+    return hashlib.sha1((config + '\0' + text).encode('utf-8')).hexdigest()
+
+
+def split_lines(text):
+    """
+    Yield (start offset, line) pairs for all non-blank lines in text
+    """
+    start = 0
+
+    # like CoreNLP's ssplit.eolonly, split on newlines only
+    for line in text.split('\n'):
+        if line.strip():
+            yield start, line.rstrip('\r')
+        start += len(line) + 1
+
+
+def parse_sent_cached(input,
+                      cache_file,
+                      cache_size=CACHE_SIZE,
+                      out_dir=scnlp.OUT_DIR,
+                      annotators=scnlp.ANNOTATORS,
+                      version=scnlp.VERSION,
+                      replace_ext=scnlp.REPLACE_EXT,
+                      output_ext=scnlp.OUTPUT_EXT,
+                      options='-ssplit.eolonly',
+                      stamp=scnlp.STAMP,
+                      resume=scnlp.RESUME,
+                      use_sr_parser=scnlp.USE_SR_PARSER,
+                      isolate=scnlp.ISOLATE,
+                      **kwargs):
+    """
+    Parse sentences (one sentence per line) using a sentence cache
+
+    Only sentences not in the cache are passed to CoreNLP. The analyses of
+    cached and newly parsed sentences are spliced into a CoreNLP XML file per
+    input document, with character offsets relative to the document.
+    Outputs are recorded in the manifest and documents with sentences that
+    made CoreNLP fail in the quarantine file of out_dir, as by
+    scnlp.core_nlp, so resume works the same. Remaining keyword arguments
+    are passed on to parse_lines and scnlp.core_nlp.
+    """
+    in_files = file_list(input)
+    make_dir(out_dir)
+
+    if stamp:
+        replace_ext = True
+        output_ext = scnlp.stamped_ext(version, output_ext)
+
+    out_files = {fname: scnlp.output_path(fname, out_dir, output_ext,
+                                          replace_ext)
+                 for fname in in_files}
+
+    fingerprints = {fname: scnlp.fingerprint(fname, annotators, options,
+                                             version, use_sr_parser)
+                    for fname in in_files}
+    manifest_fname = Path(out_dir or '.') / scnlp.MANIFEST_FNAME
+    manifest = read_manifest(manifest_fname)
+    quarantine = scnlp.read_quarantine(out_dir)
+
+    if resume:
+        in_files = scnlp.resume_files(in_files, out_files, fingerprints,
+                                      manifest,
+                                      quarantine if isolate else None)
+
+    config = json.dumps([annotators, options, version,
+                         scnlp.SR_PARSER_MODEL if use_sr_parser else ''])
+    cache = SentenceCache(cache_file, cache_size)
+
+    try:
+        docs = {}
+        misses = {}
+
+        for fname in in_files:
+            lines = [(start, sentence_key(line, config), line)
+                     for start, line in split_lines(Path(fname).read_text(
+                        encoding='utf-8'))]
+            docs[fname] = lines
+            misses.update((key, line) for _, key, line in lines)
+
+        found = cache.get_many(misses)
+        failures = {}
+
+        for key in found:
+            del misses[key]
+
+        log.info('{} sentences found in cache, {} to be parsed'.format(
+            len(found), len(misses)))
+
+        if misses:
+            parsed = parse_lines(misses, failures=failures,
+                                 annotators=annotators, version=version,
+                                 options=options, use_sr_parser=use_sr_parser,
+                                 isolate=isolate, **kwargs)
+            cache.put_many(parsed.items())
+            found.update(parsed)
+
+        for fname, lines in docs.items():
+            if any(key not in found for _, key, _ in lines):
+                log.error('skipping {} because some of its sentences could '
+                          'not be parsed'.format(fname))
+                manifest.pop(out_files[fname].name, None)
+
+                if isolate:
+                    quarantine_doc(quarantine, fname,
+                                   (key for _, key, _ in lines), failures)
+                continue
+
+            sent_elems = []
+
+            for start, key, _ in lines:
+                for sent_elem in fromstring(found[key]):
+                    scnlp.shift_offsets(sent_elem, start)
+                    sent_elems.append(sent_elem)
+
+            log.info('writing {}'.format(out_files[fname]))
+            scnlp.write_document(sent_elems, out_files[fname])
+            manifest[out_files[fname].name] = fingerprints[fname]
+    finally:
+        cache.close()
+        write_manifest(manifest_fname, manifest)
+
+        if isolate:
+            scnlp.write_quarantine(out_dir, quarantine)
+            scnlp.quarantine_report(out_dir)
+
+
+def quarantine_doc(quarantine, fname, keys, failures):
+    """
+    Quarantine input document if any of the sentences with the given keys
+    made CoreNLP fail
+    """
+    reasons = {failures[key] for key in keys if key in failures}
+
+    if reasons:
+        quarantine[fname] = '; '.join(sorted(reasons))
+        log.error('quarantining {}: {}'.format(fname, quarantine[fname]))
+
+
+def parse_lines(lines, lines_per_file=MISSES_PER_FILE, failures=None,
+                **kwargs):
+    """
+    Parse sentences with CoreNLP and return dict mapping sentence keys to
+    their analysis, with character offsets relative to the sentence
+
+    Parameters
+    ----------
+    lines : dict
+        mapping of keys to sentences, where each sentence is a single line
+    lines_per_file : int
+        number of sentences per input file for CoreNLP
+    failures : dict
+        if given, updated with a mapping of the keys of sentences without
+        analysis to the reason of failure, e.g. when the CoreNLP input file
+        holding them was quarantined (see isolate option of scnlp.core_nlp)
+    kwargs
+        passed on to scnlp.core_nlp, where options should include
+        -ssplit.eolonly
+
+    Returns
+    -------
+    parsed : dict
+        mapping of keys to a CoreNLP XML fragment (bytes) with a <sentences>
+        element containing the analyses of the sentence
+    """
+    items = list(lines.items())
+    parsed = {}
+
+    with TemporaryDirectory() as tmp_dir:
+        in_dir = Path(tmp_dir) / 'in'
+        out_dir = Path(tmp_dir) / 'out'
+        in_dir.mkdir()
+        batches = {}
+
+        for n, i in enumerate(range(0, len(items), lines_per_file)):
+            batch = items[i:i + lines_per_file]
+            in_fname = in_dir / 'lines{:06d}.txt'.format(n)
+            in_fname.write_text(''.join(line + '\n' for _, line in batch),
+                                encoding='utf-8')
+            batches[in_fname] = batch
+
+        scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), stamp=False,
+                       replace_ext=True, output_ext='.xml', resume=False,
+                       **kwargs)
+        # input files quarantined when isolating failures, which are lost
+        # along with the temporary directory
+        quarantine = scnlp.read_quarantine(str(out_dir))
+
+        for in_fname, batch in batches.items():
+            out_fname = scnlp.output_path(in_fname, out_dir, '.xml', True)
+
+            if not scnlp.is_complete(out_fname):
+                reason = quarantine.get(str(in_fname), 'no output')
+                log.error('no CoreNLP output for {} lines: {}'.format(
+                    len(batch), reason))
+
+                if failures is not None:
+                    failures.update((key, reason) for key, _ in batch)
+
+                continue
+
+            sentences_elem = ElementTree(file=str(out_fname)).find(
+                './/sentences')
+            sent_iter = iter(list(sentences_elem))
+            sent_elem = next(sent_iter, None)
+            start = 0
+
+            for key, line in batch:
+                end = start + len(line) + 1
+                value = Element('sentences')
+
+                # assign sentences to line on the basis of their offsets,
+                # which is robust to lines without any tokens
+                while (sent_elem is not None and
+                       int(sent_elem.findtext('.//CharacterOffsetBegin')) <
+                       end):
+                    scnlp.shift_offsets(sent_elem, -start)
+                    value.append(sent_elem)
+                    sent_elem = next(sent_iter, None)
+
+                parsed[key] = tostring(value, encoding='UTF-8')
+                start = end
+
+    return parsed
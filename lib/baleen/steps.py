@@ -1,7 +1,8 @@
 from argh import arg
 
 from baleen.arghconfig import docstring
-from baleen import scnlp, vars, cite, rels
+from baleen import (scnlp, scnlp_server, sentcache, parsesched, records, vars,
+                    cite, rels)
 from baleen.utils import remove_any
 from baleen.n4j.csvimport import articles_to_csv, vars_to_csv, rels_to_csv, neo4j_import, neo4j_import_multi, \
     create_unique_csv_nodes
@@ -31,7 +32,15 @@ def core_nlp(input,
              options=scnlp.OPTIONS,
              stamp=scnlp.STAMP,
              resume=scnlp.RESUME,
-             use_sr_parser=scnlp.USE_SR_PARSER):
+             use_sr_parser=scnlp.USE_SR_PARSER,
+             server=scnlp.SERVER,
+             workers=scnlp.WORKERS,
+             jvms=scnlp.JVMS,
+             chunk_size=scnlp.CHUNK_SIZE,
+             output_format=scnlp.OUTPUT_FORMAT,
+             isolate=scnlp.ISOLATE,
+             doc_timeout=scnlp.DOC_TIMEOUT,
+             dedup=scnlp.DEDUP):
     scnlp.core_nlp(input=input,
                    out_dir=out_dir,
                    annotators=annotators,
@@ -44,7 +53,15 @@ def core_nlp(input,
                    options=options,
                    stamp=stamp,
                    resume=resume,
-                   use_sr_parser=use_sr_parser)
+                   use_sr_parser=use_sr_parser,
+                   server=server,
+                   workers=workers,
+                   jvms=jvms,
+                   chunk_size=chunk_size,
+                   output_format=output_format,
+                   isolate=isolate,
+                   doc_timeout=doc_timeout,
+                   dedup=dedup)
 
 
 def split_sent(input,
@@ -57,7 +74,15 @@ def split_sent(input,
                output_ext=scnlp.OUTPUT_EXT,
                options='-ssplit.newlineIsSentenceBreak always',
                stamp=scnlp.STAMP,
-               resume=scnlp.RESUME):
+               resume=scnlp.RESUME,
+               server=scnlp.SERVER,
+               workers=scnlp.WORKERS,
+               jvms=scnlp.JVMS,
+               chunk_size=scnlp.CHUNK_SIZE,
+               output_format=scnlp.OUTPUT_FORMAT,
+               isolate=scnlp.ISOLATE,
+               doc_timeout=scnlp.DOC_TIMEOUT,
+               dedup=scnlp.DEDUP):
     """
     Split text into sentences
     """
@@ -72,7 +97,15 @@ def split_sent(input,
              output_ext=output_ext,
              options=options,
              stamp=stamp,
-             resume=resume)
+             resume=resume,
+             server=server,
+             workers=workers,
+             jvms=jvms,
+             chunk_size=chunk_size,
+             output_format=output_format,
+             isolate=isolate,
+             doc_timeout=doc_timeout,
+             dedup=dedup)
 
 
 def parse_sent(input,
@@ -87,10 +120,78 @@ def parse_sent(input,
                options='-ssplit.eolonly',
                stamp=scnlp.STAMP,
                resume=scnlp.RESUME,
-               use_sr_parser=scnlp.USE_SR_PARSER):
+               use_sr_parser=scnlp.USE_SR_PARSER,
+               server=scnlp.SERVER,
+               workers=scnlp.WORKERS,
+               jvms=scnlp.JVMS,
+               chunk_size=scnlp.CHUNK_SIZE,
+               output_format=scnlp.OUTPUT_FORMAT,
+               isolate=scnlp.ISOLATE,
+               doc_timeout=scnlp.DOC_TIMEOUT,
+               dedup=scnlp.DEDUP,
+               cache_file=sentcache.CACHE_FILE,
+               cache_size=sentcache.CACHE_SIZE,
+               bucketed=False,
+               sr_threshold=parsesched.SR_THRESHOLD,
+               max_length=parsesched.MAX_LENGTH):
     """
     Parse sentences (one sentence per line)
+
+    If a cache_file is given, output is always in XML format.
+    If bucketed, short sentences are parsed with the PCFG parser and
+    sentences longer than sr_threshold tokens with the shift-reduce parser
+    (ignoring use_sr_parser), and output is always in XML format.
+    Sentences longer than max_length tokens (if non-zero) are not parsed.
+    A cache_file takes precedence over bucketing. Deduplication (dedup) does
+    not apply with a cache_file or bucketing.
     """
+    if cache_file:
+        sentcache.parse_sent_cached(input=input,
+                                    cache_file=cache_file,
+                                    cache_size=cache_size,
+                                    out_dir=out_dir,
+                                    annotators=annotators,
+                                    class_path=class_path,
+                                    version=version,
+                                    memory=memory,
+                                    threads=threads,
+                                    replace_ext=replace_ext,
+                                    output_ext=output_ext,
+                                    options=options,
+                                    stamp=stamp,
+                                    resume=resume,
+                                    use_sr_parser=use_sr_parser,
+                                    server=server,
+                                    workers=workers,
+                                    jvms=jvms,
+                                    chunk_size=chunk_size,
+                                    isolate=isolate,
+                                    doc_timeout=doc_timeout)
+        return
+
+    if bucketed:
+        parsesched.parse_sent_bucketed(input=input,
+                                       sr_threshold=sr_threshold,
+                                       max_length=max_length,
+                                       out_dir=out_dir,
+                                       annotators=annotators,
+                                       class_path=class_path,
+                                       version=version,
+                                       memory=memory,
+                                       threads=threads,
+                                       replace_ext=replace_ext,
+                                       output_ext=output_ext,
+                                       options=options,
+                                       stamp=stamp,
+                                       resume=resume,
+                                       server=server,
+                                       workers=workers,
+                                       jvms=jvms,
+                                       chunk_size=chunk_size,
+                                       isolate=isolate,
+                                       doc_timeout=doc_timeout)
+        return
+
     core_nlp(input=input,
              out_dir=out_dir,
              annotators=annotators,
@@ -103,14 +204,56 @@ def parse_sent(input,
              options=options,
              stamp=stamp,
              resume=resume,
-             use_sr_parser=use_sr_parser)
+             use_sr_parser=use_sr_parser,
+             server=server,
+             workers=workers,
+             jvms=jvms,
+             chunk_size=chunk_size,
+             output_format=output_format,
+             isolate=isolate,
+             doc_timeout=doc_timeout,
+             dedup=dedup)
+
+
+@docstring(scnlp.quarantine_report)
+def nlp_quarantine(out_dir=scnlp.OUT_DIR):
+    scnlp.quarantine_report(out_dir)
+
+
+@docstring(scnlp_server.start_server)
+def start_nlp_server(class_path=scnlp.CLASS_PATH,
+                     port=scnlp_server.PORT,
+                     memory=scnlp_server.MEMORY,
+                     threads=scnlp_server.WORKERS,
+                     timeout=scnlp_server.TIMEOUT,
+                     preload=scnlp_server.PRELOAD,
+                     state_dir=scnlp_server.STATE_DIR,
+                     wait=scnlp_server.START_WAIT):
+    scnlp_server.start_server(class_path, port, memory, threads, timeout,
+                              preload, state_dir, wait)
+
+
+@docstring(scnlp_server.stop_server)
+def stop_nlp_server(port=scnlp_server.PORT,
+                    state_dir=scnlp_server.STATE_DIR):
+    scnlp_server.stop_server(port, state_dir)
 
 
-def lemma_trees(scnlp_dir, out_dir):
+@docstring(scnlp_server.run_standin_server)
+def standin_nlp_server(host=scnlp_server.HOST, port=scnlp_server.PORT):
+    scnlp_server.run_standin_server(host, port)
+
+
+def lemma_trees(scnlp_dir, out_dir, processes=scnlp.PROCESSES):
     """
     Extract lemmatized parse trees
     """
-    scnlp.extract_lemmatized_parse_trees(scnlp_dir, out_dir)
+    scnlp.extract_lemmatized_parse_trees(scnlp_dir, out_dir, processes)
+
+
+@docstring(scnlp.convert_to_store)
+def ann_store(scnlp_dir, processes=scnlp.PROCESSES):
+    scnlp.convert_to_store(scnlp_dir, processes)
 
 
 @docstring(vars.extract_vars)
@@ -122,15 +265,28 @@ def ext_vars(extract_vars_exec, trees_dir, vars_dir,
 
 @docstring(vars.add_offsets)
 @arg('-r', '--resume', help='toggle default for resuming process')
-def offsets(vars_dir, scnlp_dir, resume=vars.RESUME_OFFSET):
-    vars.add_offsets(vars_dir, scnlp_dir, resume)
+def offsets(vars_dir, scnlp_dir, resume=vars.RESUME_OFFSET,
+            processes=vars.PROCESSES):
+    vars.add_offsets(vars_dir, scnlp_dir, resume, processes)
 
 
 @docstring(vars.preproc_vars)
 def prep_vars(trans_exec, trans_file, in_vars_dir, out_vars_dir, tmp_dir=None,
-              resume=vars.RESUME_PREP):
+              resume=vars.RESUME_PREP, out_format=records.FORMAT,
+              processes=vars.PROCESSES):
     vars.preproc_vars(trans_exec, trans_file, in_vars_dir, out_vars_dir,
-                      tmp_dir, resume)
+                      tmp_dir, resume, out_format, processes)
+
+
+@docstring(vars.postproc_vars)
+@arg('-r', '--resume', help='toggle default for resuming process')
+def postproc(vars_dir, scnlp_dir, trees_dir, trans_exec, trans_file,
+             prune_vars_exec, pruned_dir, tagged_dir,
+             prune_options=vars.PRUNE_OPTIONS, resume=vars.RESUME_POSTPROC,
+             processes=vars.PROCESSES):
+    vars.postproc_vars(vars_dir, scnlp_dir, trees_dir, trans_exec, trans_file,
+                       prune_vars_exec, pruned_dir, tagged_dir, prune_options,
+                       resume, processes)
 
 
 @docstring(vars.prune_vars)
@@ -141,9 +297,14 @@ def prune_vars(prune_vars_exec, in_vars_dir, out_vars_dir,
 
 
 @arg('--max-n-vars', type=int)
+@arg('--rate-limit', type=float)
+@arg('--failure-ttl', type=float)
 @docstring(articles_to_csv)
-def arts2csv(vars_dir, text_dir, meta_cache_dir, cit_cache_dir, nodes_dir, max_n_vars=None, online=True):
-    articles_to_csv(vars_dir, text_dir, meta_cache_dir, cit_cache_dir, nodes_dir, max_n_vars, online)
+def arts2csv(vars_dir, text_dir, meta_cache_dir, cit_cache_dir, nodes_dir, max_n_vars=None, online=True,
+             concurrency=cite.CONCURRENCY, rate_limit=cite.RATE_LIMIT, doi_url=cite.DOI_URL,
+             issn_url=cite.ISSN_URL, failure_ttl=cite.FAILURE_TTL):
+    articles_to_csv(vars_dir, text_dir, meta_cache_dir, cit_cache_dir, nodes_dir, max_n_vars, online,
+                    concurrency, rate_limit, doi_url, issn_url, failure_ttl)
 
 
 @arg('--max-n-vars', type=int)
@@ -202,14 +363,26 @@ def clean_cache(cache_dir):
     cite.clean_metadata_cache(cache_dir)
 
 
+@arg('--failure-ttl', type=float)
+@docstring(cite.failure_report)
+def cache_failures(cache_dir, failure_ttl=cite.FAILURE_TTL, clear=False):
+    cite.failure_report(cache_dir, failure_ttl, clear)
+
+
 @docstring(rels.tag_var_nodes)
-def tag_trees(vars_dir, trees_dir, tagged_dir):
-    rels.tag_var_nodes(vars_dir, trees_dir, tagged_dir)
+def tag_trees(vars_dir, trees_dir, tagged_dir, index_dir=None,
+              processes=rels.PROCESSES):
+    rels.tag_var_nodes(vars_dir, trees_dir, tagged_dir, index_dir=index_dir,
+                       processes=processes)
 
 
 @docstring(rels.extract_relations)
-def ext_rels(class_path, tagged_dir, pattern_path, rels_dir):
-    rels.extract_relations(class_path, tagged_dir, pattern_path, rels_dir)
+def ext_rels(class_path, tagged_dir, pattern_path, rels_dir,
+             batch=rels.BATCH, engine=rels.ENGINE, processes=rels.PROCESSES,
+             index_dir=None):
+    rels.extract_relations(class_path, tagged_dir, pattern_path, rels_dir,
+                           batch=batch, engine=engine, processes=processes,
+                           index_dir=index_dir)
 
 
 # Old commands superseded by CSV import of citations and metadata
@@ -0,0 +1,255 @@
+"""
+compact phrase structure trees
+
+A ParseTree holds a tree in labeled bracket format (as output by Stanford
+CoreNLP) in flat arrays indexed by the preorder number of its nodes, where
+0 is the top node and leaves are nodes too. Parsing and serializing are
+iterative, so there is no limit on tree depth.
+"""
+
+import re
+from array import array
+
+OPEN_B, CLOSE_B = '()'
+
+# Regexps that tokenize a tree in labeled bracket format. Group 1 matches
+# the label of a non-terminal, group 2 a leaf.
+SYMBOL_RE = re.compile(r'{0}\s*([^\s{0}{1}]+)?|{1}|([^\s{0}{1}]+)'.format(
+    re.escape(OPEN_B), re.escape(CLOSE_B)))
+# The leaf pattern is modified from NLTK's to accommodate cases like
+# (NP (NP (DT the) (CD 8 1/2) (NN day) (NN period))
+# where the leaf "8 1/2" contains whitespace.
+MULTIWORD_SYMBOL_RE = re.compile(
+    r'{0}\s*([^\s{0}{1}]+)?|{1}|([^\s{0}{1}]+[^{0}{1}]*)'.format(
+        re.escape(OPEN_B), re.escape(CLOSE_B)))
+
+
+class ParseTree:
+    """
+    Phrase structure tree backed by arrays in preorder
+
+    Attributes
+    ----------
+    labels : list of str
+        label of each node, which is the word for a leaf
+    parents : array of int
+        index of parent of each node, -1 for the top node
+    ends : array of int
+        index one past the last node in the subtree of each node
+    leaf_starts : array of int
+        number of leaves preceding the subtree of each node, i.e. the index
+        of its first leaf among all leaves
+    leaf_ends : array of int
+        index one past the last leaf in the subtree of each node
+    """
+
+    __slots__ = ('labels', 'parents', 'ends', 'leaf_starts', 'leaf_ends')
+
+    def __init__(self, labels, parents, ends, leaf_starts, leaf_ends):
+        self.labels = labels
+        self.parents = array('i', parents)
+        self.ends = array('i', ends)
+        self.leaf_starts = array('i', leaf_starts)
+        self.leaf_ends = array('i', leaf_ends)
+
+    @classmethod
+    def fromstring(cls, s, multiword_leaves=False):
+        """
+        Parse tree in labeled bracket format
+
+        If multiword_leaves is true, a leaf extends up to the next bracket,
+        so it may contain whitespace, as tokens in CoreNLP parses may do.
+        Otherwise whitespace separates leaves, as in NLTK and Tregex.
+        """
+        symbol_re = MULTIWORD_SYMBOL_RE if multiword_leaves else SYMBOL_RE
+        labels = []
+        parents = []
+        ends = []
+        leaf_starts = []
+        leaf_ends = []
+        stack = []
+        n_leaves = 0
+
+        for match in symbol_re.finditer(s):
+            if match.group() == CLOSE_B:
+                try:
+                    n = stack.pop()
+                except IndexError:
+                    raise ValueError('unbalanced brackets in tree: {}'.format(
+                        s))
+                ends[n] = len(labels)
+                leaf_ends[n] = n_leaves
+                continue
+
+            parents.append(stack[-1] if stack else -1)
+            leaf_starts.append(n_leaves)
+
+            if match.lastindex == 2:
+                labels.append(match.group(2).rstrip())
+                ends.append(len(labels))
+                n_leaves += 1
+                leaf_ends.append(n_leaves)
+            else:
+                stack.append(len(labels))
+                labels.append(match.group(1) or '')
+                # set when the node is closed
+                ends.append(0)
+                leaf_ends.append(0)
+
+        if stack or parents.count(-1) > 1:
+            raise ValueError('not a single well-formed tree: {}'.format(s))
+
+        return cls(labels, parents, ends, leaf_starts, leaf_ends)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def is_leaf(self, n):
+        return (self.ends[n] == n + 1 and
+                self.leaf_ends[n] - self.leaf_starts[n] == 1)
+
+    def children(self, n):
+        """
+        Return indices of children of node n
+        """
+        children = []
+        child = n + 1
+
+        while child < self.ends[n]:
+            children.append(child)
+            child = self.ends[child]
+
+        return children
+
+    def leaves(self):
+        return [label for n, label in enumerate(self.labels)
+                if self.is_leaf(n)]
+
+    def offsets(self, n, begins, ends):
+        """
+        Return character offsets of node n, given the begin and end offsets
+        of the tokens (i.e. leaves)
+        """
+        return begins[self.leaf_starts[n]], ends[self.leaf_ends[n] - 1]
+
+    def tostring(self):
+        """
+        Serialize tree in labeled bracket format on a single line
+        """
+        parts = []
+        # ends of the subtrees of open non-terminals
+        stack = []
+
+        for n, label in enumerate(self.labels):
+            while stack and stack[-1] <= n:
+                stack.pop()
+                parts.append(CLOSE_B)
+
+            if n:
+                parts.append(' ')
+
+            if self.is_leaf(n):
+                parts.append(label)
+            else:
+                parts.append(OPEN_B + label)
+                stack.append(self.ends[n])
+
+        parts.append(CLOSE_B * len(stack))
+        return ''.join(parts)
+
+    def __str__(self):
+        return self.tostring()
+
+
+def split_trees(s, multiword_leaves=False):
+    """
+    Iterate over trees in string holding any number of trees in labeled
+    bracket format, e.g. a file of trees that may or may not be separated by
+    newlines, yielding the substring of each tree
+    """
+    symbol_re = MULTIWORD_SYMBOL_RE if multiword_leaves else SYMBOL_RE
+    depth = 0
+    start = None
+
+    for match in symbol_re.finditer(s):
+        if match.group() == CLOSE_B:
+            depth -= 1
+
+            if not depth:
+                yield s[start:match.end()]
+        elif match.lastindex != 2:
+            if not depth:
+                start = match.start()
+
+            depth += 1
+
+    if depth:
+        raise ValueError('unbalanced brackets in trees')
+
+
+def iter_trees(s, multiword_leaves=False, tree_class=ParseTree):
+    """
+    Iterate over trees in string as split by split_trees, yielding
+    instances of tree_class, a subclass of ParseTree
+    """
+    for tree in split_trees(s, multiword_leaves):
+        yield tree_class.fromstring(tree, multiword_leaves)
+
+
+def tag_nodes(s, suffixes, multiword_leaves=False):
+    """
+    Append suffixes to labels of nodes in tree in labeled bracket format
+
+    The tree is not parsed: labels are edited in place in the string, which
+    is scanned only up to the last node to be tagged.
+
+    Parameters
+    ----------
+    s : str
+        tree in labeled bracket format
+    suffixes : dict
+        mapping of preorder node indices to suffixes
+    multiword_leaves : bool
+        whether leaves may contain whitespace (see ParseTree.fromstring)
+
+    Returns
+    -------
+    tuple
+        tagged tree and a dict mapping indices of nodes that were not tagged
+        because they are leaves to the leaves
+    """
+    symbol_re = MULTIWORD_SYMBOL_RE if multiword_leaves else SYMBOL_RE
+    parts = []
+    leaves = {}
+    pos = 0
+    n = -1
+    remaining = len(suffixes)
+
+    for match in symbol_re.finditer(s):
+        if not remaining:
+            break
+
+        if match.group() == CLOSE_B:
+            continue
+
+        n += 1
+
+        if n not in suffixes:
+            continue
+
+        remaining -= 1
+
+        if match.lastindex == 2:
+            leaves[n] = match.group(2).rstrip()
+        else:
+            at = match.end(1) if match.group(1) else match.start() + 1
+            parts.append(s[pos:at])
+            parts.append(suffixes[n])
+            pos = at
+
+    if remaining:
+        raise ValueError('node index {} out of range for tree: {}'.format(
+            max(suffixes), s))
+
+    parts.append(s[pos:])
+    return ''.join(parts), leaves
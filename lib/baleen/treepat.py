@@ -0,0 +1,495 @@
+"""
+native tree pattern matching
+
+Matches the subset of Stanford Tregex syntax used for relation extraction
+against ParseTrees, without running a JVM. Supported are node descriptions
+(a word, alternatives like thus|therefore, a /regex/ or __ for any node),
+named nodes (/VAR/=from) and references to them (=from), parentheses,
+negated relations (!) and the relations
+
+    A < B      A is the parent of B
+    A > B      A is a child of B
+    A << B     A dominates B
+    A >> B     A is dominated by B
+    A <# B     B is the immediate head of A
+    A ># B     A is the immediate head of B
+    A <<# B    B is a head of A
+    A >># B    A is a head of B
+    A . B      A immediately precedes B
+    A .. B     A precedes B
+    A , B      A immediately follows B
+    A ,, B     A follows B
+
+where heads are determined as by Tregex's default CollinsHeadFinder.
+Compiling a pattern with any other syntax raises UnsupportedPattern.
+Because ParseTree holds the span of each node in preorder and in leaves, the
+nodes dominated by, preceding or following a node are found as ranges of
+preorder indices, in time linear in the depth of the tree rather than in its
+size.
+"""
+
+import re
+from collections import namedtuple
+from itertools import chain
+
+from baleen.tree import ParseTree, iter_trees
+
+
+class UnsupportedPattern(ValueError):
+    """
+    Raised for patterns outside of the supported subset of Tregex syntax
+    """
+
+
+NodePattern = namedtuple('NodePattern', 'label_re words name ref relations')
+Relation = namedtuple('Relation', 'negated op target')
+
+RELATION_OPS = ['<<#', '>>#', '<#', '>#', '<<', '>>', '<', '>',
+                '..', '.', ',,', ',']
+# characters following a relation in Tregex relations that are not supported
+UNSUPPORTED_OP_SUFFIXES = set('-+:`0123456789')
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<regex>/(?:[^/\\]|\\.)*/) |
+        (?P<op>{ops}) |
+        (?P<word>[^\s()/=!<>.,\#@$%&|\[\]?~:;]+(?:\|[^\s()/=!<>.,\#@$%&|\[\]?~:;]+)*) |
+        (?P<punct>[()=!]) |
+        (?P<other>\S)
+    )'''.format(ops='|'.join(re.escape(op) for op in RELATION_OPS)),
+    re.VERBOSE)
+
+# Head rules of edu.stanford.nlp.trees.CollinsHeadFinder,
+# after Collins (1999: 236-238)
+HEAD_RULES = {
+    'ADJP': [('left', 'NNS', 'QP', 'NN', '$', 'ADVP', 'JJ', 'VBN', 'VBG',
+              'ADJP', 'JJR', 'NP', 'JJS', 'DT', 'FW', 'RBR', 'RBS', 'SBAR',
+              'RB')],
+    'ADVP': [('right', 'RB', 'RBR', 'RBS', 'FW', 'ADVP', 'TO', 'CD', 'JJR',
+              'JJ', 'IN', 'NP', 'JJS', 'NN')],
+    'CONJP': [('right', 'CC', 'RB', 'IN')],
+    'FRAG': [('right',)],
+    'INTJ': [('left',)],
+    'LST': [('right', 'LS', ':')],
+    'NAC': [('left', 'NN', 'NNS', 'NNP', 'NNPS', 'NP', 'NAC', 'EX', '$', 'CD',
+             'QP', 'PRP', 'VBG', 'JJ', 'JJS', 'JJR', 'ADJP', 'FW')],
+    'PP': [('right', 'IN', 'TO', 'VBG', 'VBN', 'RP', 'FW')],
+    'PRN': [('left',)],
+    'PRT': [('right', 'RP')],
+    'QP': [('left', '$', 'IN', 'NNS', 'NN', 'JJ', 'RB', 'DT', 'CD', 'NCD',
+            'QP', 'JJR', 'JJS')],
+    'RRC': [('right', 'VP', 'NP', 'ADVP', 'ADJP', 'PP')],
+    'S': [('left', 'TO', 'IN', 'VP', 'S', 'SBAR', 'ADJP', 'UCP', 'NP')],
+    'SBAR': [('left', 'WHNP', 'WHPP', 'WHADVP', 'WHADJP', 'IN', 'DT', 'S',
+              'SQ', 'SINV', 'SBAR', 'FRAG')],
+    'SBARQ': [('left', 'SQ', 'S', 'SINV', 'SBARQ', 'FRAG')],
+    'SINV': [('left', 'VBZ', 'VBD', 'VBP', 'VB', 'MD', 'VP', 'S', 'SINV',
+              'ADJP', 'NP')],
+    'SQ': [('left', 'VBZ', 'VBD', 'VBP', 'VB', 'MD', 'VP', 'SQ')],
+    'UCP': [('right',)],
+    'VP': [('left', 'TO', 'VBD', 'VBN', 'MD', 'VBZ', 'VB', 'VBG', 'VBP',
+            'AUX', 'AUXG', 'VP', 'ADJP', 'NN', 'NNS', 'NP')],
+    'WHADJP': [('left', 'CC', 'WRB', 'JJ', 'ADJP')],
+    'WHADVP': [('right', 'CC', 'WRB')],
+    'WHNP': [('left', 'WDT', 'WP', 'WP$', 'WHADJP', 'WHPP', 'WHNP')],
+    'WHPP': [('right', 'IN', 'TO', 'FW')],
+    'NX': [('left',)],
+    'X': [('right',)],
+    'NP': [('rightdis', 'NN', 'NNP', 'NNPS', 'NNS', 'NX', 'POS', 'JJR'),
+           ('left', 'NP'),
+           ('rightdis', '$', 'ADJP', 'PRN'),
+           ('right', 'CD'),
+           ('rightdis', 'JJ', 'JJS', 'RB', 'QP')],
+    'TYPO': [('left',)],
+    'EDITED': [('left',)],
+    'XS': [('right', 'IN')],
+}
+
+PUNCTUATION_TAGS = {"''", '``', '-LRB-', '-RRB-', '.', ':', ','}
+
+# characters introducing functional annotations on Penn Treebank labels
+ANNOTATION_CHARS = '-=|#^~_'
+
+
+def basic_category(label):
+    """
+    Strip functional annotations from label, e.g. NP-SBJ or NP_VAR_... to NP
+    """
+    for i, char in enumerate(label):
+        if i and char in ANNOTATION_CHARS:
+            return label[:i]
+
+    return label
+
+
+def compile_pattern(pattern):
+    """
+    Compile a tree pattern in Tregex syntax into a NodePattern
+
+    Raises UnsupportedPattern if the pattern is not in the supported subset
+    of Tregex syntax.
+    """
+    pattern = pattern.strip()
+    tokens = []
+
+    for match in TOKEN_RE.finditer(pattern):
+        kind = match.lastgroup
+
+        # e.g. "<-1", "<+(NP)" or "<:" are relations that are not supported
+        if kind == 'other' or (kind == 'op' and
+                               pattern[match.end():match.end() + 1] in
+                               UNSUPPORTED_OP_SUFFIXES):
+            raise UnsupportedPattern('unsupported syntax at "{}" in pattern: '
+                                     '{}'.format(pattern[match.start(kind):],
+                                                 pattern))
+
+        tokens.append((kind, match.group(kind)))
+
+    tokens.append((None, None))
+    node, pos = _parse_node(tokens, 0, pattern)
+
+    if pos != len(tokens) - 1:
+        raise UnsupportedPattern('unsupported syntax at "{}" in pattern: '
+                                 '{}'.format(tokens[pos][1], pattern))
+
+    return node
+
+
+def _parse_node(tokens, pos, pattern):
+    """
+    Parse node, possibly parenthesized, with its relations
+    """
+    if tokens[pos][1] == '(':
+        node, pos = _parse_node(tokens, pos + 1, pattern)
+
+        if tokens[pos][1] != ')':
+            raise UnsupportedPattern('unbalanced parentheses in pattern: '
+                                     '{}'.format(pattern))
+
+        return node, pos + 1
+
+    node, pos = _parse_description(tokens, pos, pattern)
+    relations = []
+
+    while True:
+        negated = tokens[pos][1] == '!'
+        kind, op = tokens[pos + negated]
+
+        if kind != 'op':
+            break
+
+        pos += negated + 1
+
+        if tokens[pos][1] == '(':
+            target, pos = _parse_node(tokens, pos, pattern)
+        else:
+            # without parentheses, the target is a single node and any
+            # following relations apply to the node on the left
+            target, pos = _parse_description(tokens, pos, pattern)
+
+        relations.append(Relation(negated, op, target))
+
+    return node._replace(relations=tuple(relations)), pos
+
+
+def _parse_description(tokens, pos, pattern):
+    """
+    Parse node description or reference, optionally named, into a
+    NodePattern without relations
+    """
+    kind, value = tokens[pos]
+    label_re = words = name = None
+
+    if value == '=' and tokens[pos + 1][0] == 'word':
+        # reference to named node
+        return NodePattern(None, None, None, tokens[pos + 1][1], ()), pos + 2
+    elif kind == 'regex':
+        try:
+            label_re = re.compile(value[1:-1])
+        except re.error:
+            raise UnsupportedPattern('unsupported regular expression {} in '
+                                     'pattern: {}'.format(value, pattern))
+    elif kind == 'word':
+        if value != '__':
+            words = tuple(value.split('|'))
+            label_re = re.compile('^(?:{})$'.format('|'.join(
+                re.escape(word) for word in words)))
+    else:
+        raise UnsupportedPattern('unsupported syntax at "{}" in pattern: '
+                                 '{}'.format(value, pattern))
+
+    pos += 1
+
+    if tokens[pos][1] == '=' and tokens[pos + 1][0] == 'word':
+        name = tokens[pos + 1][1]
+        pos += 2
+
+    return NodePattern(label_re, words, name, None, ()), pos
+
+
+def anchors(pattern):
+    """
+    Return words required by compiled pattern
+
+    Returns a list of sets of words, where every match of the pattern has,
+    for each set, a node labeled with one of its words. Nodes described by
+    a regular expression or under a negated relation are not required.
+    """
+    required = [set(pattern.words)] if pattern.words else []
+
+    for negated, _, target in pattern.relations:
+        if not negated:
+            required += anchors(target)
+
+    return required
+
+
+class PatternTree(ParseTree):
+    """
+    ParseTree with the indices needed for pattern matching
+    """
+
+    __slots__ = ('leaf_nodes', '_heads')
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.leaf_nodes = [n for n in range(len(self)) if self.is_leaf(n)]
+        self._heads = {}
+
+    def head(self, n):
+        """
+        Return index of the immediate head of node n, or None if n is a leaf
+        or has no head rule for its category
+        """
+        try:
+            return self._heads[n]
+        except KeyError:
+            head = self._heads[n] = self._determine_head(n)
+            return head
+
+    def _determine_head(self, n):
+        children = self.children(n)
+
+        if not children:
+            return None
+
+        if len(children) == 1:
+            return children[0]
+
+        rules = HEAD_RULES.get(basic_category(self.labels[n]))
+
+        if rules is None:
+            return None
+
+        categories = [basic_category(self.labels[child])
+                      for child in children]
+
+        for i, rule in enumerate(rules):
+            head = _locate_head(categories, rule)
+
+            if head is not None:
+                return children[self._fix_coordination(head, children)]
+
+        # last resort: leftmost or rightmost child, according to last rule
+        return children[0 if rules[-1][0].startswith('left') else -1]
+
+    def _fix_coordination(self, i, children):
+        # as CollinsHeadFinder.postOperationFix
+        if i >= 2 and basic_category(self.labels[children[i - 1]]) in (
+                'CC', 'CONJP'):
+            j = i - 2
+
+            while (j >= 0 and self._is_preterminal(children[j]) and
+                   self.labels[children[j]] in PUNCTUATION_TAGS):
+                j -= 1
+
+            if j >= 0:
+                i = j
+
+        return i
+
+    def _is_preterminal(self, n):
+        return self.ends[n] == n + 2 and self.is_leaf(n + 1)
+
+    def related(self, op, n):
+        """
+        Return indices of nodes m for which "n op m" holds
+        """
+        if op == '<':
+            return self.children(n)
+        elif op == '>':
+            return [self.parents[n]] if self.parents[n] >= 0 else []
+        elif op == '<<':
+            return range(n + 1, self.ends[n])
+        elif op == '>>':
+            return self._ancestors(n)
+        elif op == '<#':
+            head = None if self.is_leaf(n) else self.head(n)
+            return [] if head is None else [head]
+        elif op == '>#':
+            parent = self.parents[n]
+            return [parent] if parent >= 0 and self.head(parent) == n else []
+        elif op == '<<#':
+            heads = []
+            head = n
+
+            while not self.is_leaf(head):
+                head = self.head(head)
+
+                if head is None:
+                    break
+
+                heads.append(head)
+
+            return heads
+        elif op == '>>#':
+            phrases = []
+            head, parent = n, self.parents[n]
+
+            while parent >= 0 and self.head(parent) == head:
+                phrases.append(parent)
+                head, parent = parent, self.parents[parent]
+
+            return phrases
+        elif op == '..':
+            # in preorder, all nodes after the subtree of n follow it
+            return range(self.ends[n], len(self))
+        elif op == ',,':
+            # in preorder, all nodes before n precede it, except its ancestors
+            bounds = self._ancestors(n)[::-1] + [n]
+            return chain.from_iterable(range(start + 1, end)
+                                       for start, end in zip(bounds,
+                                                             bounds[1:]))
+        elif op == '.':
+            return self._edge_nodes(self.leaf_ends[n], self.leaf_starts)
+        elif op == ',':
+            return self._edge_nodes(self.leaf_starts[n] - 1, self.leaf_ends)
+
+    def _ancestors(self, n):
+        ancestors = []
+        parent = self.parents[n]
+
+        while parent >= 0:
+            ancestors.append(parent)
+            parent = self.parents[parent]
+
+        return ancestors
+
+    def _edge_nodes(self, leaf, edges):
+        """
+        Return nodes, top-down, for which edges[node] equals the edge of
+        the given leaf
+        """
+        if not 0 <= leaf < len(self.leaf_nodes):
+            return []
+
+        n = self.leaf_nodes[leaf]
+        edge = edges[n]
+        nodes = [n]
+
+        while self.parents[n] >= 0 and edges[self.parents[n]] == edge:
+            n = self.parents[n]
+            nodes.append(n)
+
+        return nodes[::-1]
+
+
+def _locate_head(categories, rule):
+    """
+    Return index of head among categories of children according to rule,
+    or None if no child matches, as CollinsHeadFinder.traverseLocate
+    """
+    how, targets = rule[0], rule[1:]
+    indices = range(len(categories))
+
+    if how.startswith('right'):
+        indices = indices[::-1]
+
+    if how.endswith('dis'):
+        order = ((target, i) for i in indices for target in targets)
+    else:
+        order = ((target, i) for target in targets for i in indices)
+
+    for target, i in order:
+        if categories[i] == target:
+            return i
+
+
+def match_tree(tree, pattern):
+    """
+    Iterate over matches of compiled pattern in PatternTree, yielding a
+    dict mapping names to node indices for each match
+
+    As with Tregex, every node is tried in preorder as the root of the
+    pattern, and every distinct assignment of nodes is a separate match.
+    """
+    for n in range(len(tree)):
+        yield from _match_node(tree, pattern, n, {})
+
+
+def _match_node(tree, pattern, n, bindings):
+    if pattern.ref is not None:
+        if bindings.get(pattern.ref) != n:
+            return
+    elif pattern.label_re and not pattern.label_re.search(tree.labels[n]):
+        return
+
+    if pattern.name is not None:
+        if bindings.get(pattern.name, n) != n:
+            return
+        bindings = dict(bindings)
+        bindings[pattern.name] = n
+
+    yield from _match_relations(tree, pattern.relations, n, bindings)
+
+
+def _match_relations(tree, relations, n, bindings):
+    if not relations:
+        yield bindings
+        return
+
+    (negated, op, target), rest = relations[0], relations[1:]
+
+    if negated:
+        for m in tree.related(op, n):
+            for _ in _match_node(tree, target, m, bindings):
+                return
+
+        yield from _match_relations(tree, rest, n, bindings)
+    else:
+        for m in tree.related(op, n):
+            for target_bindings in _match_node(tree, target, m, bindings):
+                yield from _match_relations(tree, rest, n, target_bindings)
+
+
+def match_file(trees_fname, patterns, handles=('from', 'to'),
+               candidates=None):
+    """
+    Match compiled patterns against trees in file
+
+    Returns for each pattern a list of matches, where a match is a tuple of
+    the labels of the nodes named by handles, in the order in which Tregex
+    prints them with the -h option. If candidates is given, it holds for
+    each pattern either a set with the positions of the trees in the file
+    that are to be matched, or None to match all trees.
+    """
+    if candidates is None:
+        candidates = [None] * len(patterns)
+
+    with open(str(trees_fname), encoding='utf-8') as inf:
+        trees = inf.read()
+
+    matches = [[] for _ in patterns]
+
+    for i, tree in enumerate(iter_trees(trees, tree_class=PatternTree)):
+        for pat_matches, pattern, pat_candidates in zip(matches, patterns,
+                                                        candidates):
+            if pat_candidates is not None and i not in pat_candidates:
+                continue
+
+            for bindings in match_tree(tree, pattern):
+                if all(handle in bindings for handle in handles):
+                    pat_matches.append(tuple(tree.labels[bindings[handle]]
+                                             for handle in handles))
+
+    return matches
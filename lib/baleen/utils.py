@@ -1,7 +1,10 @@
+import json
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from os.path import isdir, isfile, basename, dirname, join
 from shutil import rmtree
-from os import makedirs, remove
+from os import makedirs, remove, cpu_count
 from glob import glob
 from pathlib import Path
 from urllib.parse import quote_plus, unquote_plus
@@ -42,6 +45,67 @@ def file_list(files, file_glob="*"):
     return files
 
 
+def process_files(func, files, *args, processes=1):
+    """
+    Apply func(fname, *args) to each file and return list of results
+
+    Files are processed in a pool of processes if processes > 1, or in a pool
+    with a process per CPU core if processes is 0. In that case func and
+    args must be picklable, so func must be a module-level function.
+    """
+    return list(iter_process_files(func, files, *args, processes=processes))
+
+
+def iter_process_files(func, files, *args, processes=1):
+    """
+    Like process_files, but yield results in order as they become available
+    """
+    files = list(files)
+
+    if processes == 0:
+        processes = cpu_count()
+
+    if processes > 1 and len(files) > 1:
+        log.info('processing {} files with {} processes'.format(len(files),
+                                                               processes))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            yield from executor.map(func, files,
+                                    *[repeat(arg) for arg in args],
+                                    chunksize=max(1, len(files) //
+                                                  (4 * processes)))
+    else:
+        for fname in files:
+            yield func(fname, *args)
+
+
+def read_manifest(manifest_fname):
+    """
+    Read manifest, a JSON object recording completed files, returning an
+    empty dict if it is missing or corrupt
+    """
+    try:
+        with Path(manifest_fname).open() as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        log.error('ignoring corrupt manifest {}'.format(manifest_fname))
+        return {}
+
+
+def write_manifest(manifest_fname, manifest):
+    """
+    Write manifest atomically, through a temporary file
+    """
+    manifest_fname = Path(manifest_fname)
+    tmp_fname = manifest_fname.with_name(manifest_fname.name + '.tmp')
+
+    with tmp_fname.open('w') as outf:
+        json.dump(manifest, outf, indent=0, sort_keys=True)
+
+    tmp_fname.replace(manifest_fname)
+
+
 def strip_xml(s):
     """
     strip all xml tags 
@@ -4,14 +4,17 @@ extract, prune and process variables
 
 import json
 import logging
-import re
-from subprocess import check_output, STDOUT
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from subprocess import check_output, CalledProcessError, Popen, PIPE, STDOUT
 from tempfile import TemporaryDirectory
+from threading import Thread
 from pathlib import Path
 
-from lxml import etree
-
-from baleen.utils import derive_path
+from baleen import scnlp, records, rels
+from baleen.tree import ParseTree, split_trees
+from baleen.utils import (iter_process_files, process_files, read_manifest,
+                          write_manifest)
 
 log = logging.getLogger(__name__)
 
@@ -20,7 +23,18 @@ RESUME_EXTRACT = False
 RESUME_OFFSET = False
 RESUME_PREP = False
 RESUME_PRUNE = False
-
+RESUME_POSTPROC = False
+# number of processes for adding offsets and filtering preprocessed
+# variables (0 means all cores)
+PROCESSES = 1
+# no .json extension, as these are not vars files
+OFFSETS_MANIFEST_FNAME = '.offsets_manifest'
+PREP_MANIFEST_FNAME = '.prep_manifest'
+POSTPROC_MANIFEST_FNAME = '.postproc_manifest'
+# seconds between checks for new output of transformation executable
+POLL_INTERVAL = 1
+# tag added to names of output files by transformation executable
+PREP_TAG = '#prep'
 
 def extract_vars(extract_vars_exec, trees_dir, vars_dir, resume=RESUME_EXTRACT):
     """
@@ -37,50 +51,217 @@ def extract_vars(extract_vars_exec, trees_dir, vars_dir, resume=RESUME_EXTRACT):
 
 
 def preproc_vars(trans_exec, trans_fname, in_vars_dir, out_vars_dir,
-                 tmp_dir=None, resume=RESUME_PREP):
+                 tmp_dir=None, resume=RESUME_PREP, out_format=records.FORMAT,
+                 processes=PROCESSES):
     """
     Preprocess variables
 
     Deletes determiners (DT), personal/possessive pronouns (PRP or PRP$) and
     list item markers (LS or LST).
+
+    The transformation executable writes to a staging dir, while each of
+    its output files is filtered as soon as it is complete: variables from
+    which a node was deleted, as well as empty or "NP" variables, are
+    removed. Completed input files are recorded in a manifest in
+    out_vars_dir, so resuming only passes new or changed input files to the
+    executable.
+
+    Parameters
+    ----------
+    trans_exec : str
+        transformation executable
+    trans_fname : str
+        file with tree transformations
+    in_vars_dir : str
+        directory of files with variables in json format
+    out_vars_dir : str
+        directory for files with preprocessed variables
+    tmp_dir : str
+        staging dir for the output of the executable, which is kept;
+        by default a temporary dir is used
+    resume : bool
+        resume process, skipping input files recorded as completed in the
+        manifest and not modified since
+    out_format : str
+        'json', 'jsonl' or 'jsonl.gz', where the latter two can only be
+        used if the output is not read by any of the Java tools (e.g.
+        prune_vars)
+    processes : int
+        number of processes for filtering (0 means all cores)
     """
-    # TODO 3: resume only works if tmp_dir is given
-    if not tmp_dir:
-        tmp = TemporaryDirectory()
-        tmp_dir = tmp.name
+    out_vars_dir = Path(out_vars_dir)
+    out_vars_dir.mkdir(parents=True, exist_ok=True)
+    manifest_fname = out_vars_dir / PREP_MANIFEST_FNAME
+    manifest = read_manifest(manifest_fname)
+    # the Java tools read json arrays only
+    in_files = [fname for fname in records.record_files(in_vars_dir)
+                if records.record_format(fname) == 'json']
 
-    parts = [trans_exec, '--tag "#prep"']
     if resume:
-        parts.append('--resume')
-    parts += [in_vars_dir, tmp_dir, trans_fname]
-    cmd = ' '.join(parts)
-    log.info('\n' + cmd)
-    # universal_newlines=True is passed so the return value will be a string
-    # rather than bytes
-    ret = check_output(cmd, shell=True, universal_newlines=True)
-    log.info('\n{}'.format(ret))
+        in_files = [fname for fname in in_files
+                    if manifest.get(fname.name) != _file_stamp(fname)]
+        log.info('resuming with {} new or changed files'.format(
+            len(in_files)))
+
+    if not in_files:
+        return
+
+    # output files are named after the input files, plus a tag
+    name2in = {fname.name: fname for fname in in_files}
+
+    with TemporaryDirectory() as tmp:
+        # pass only the files to be processed to the executable
+        link_dir = Path(tmp) / 'in'
+        link_dir.mkdir()
+
+        for fname in in_files:
+            (link_dir / fname.name).symlink_to(fname.resolve())
+
+        stage_dir = Path(tmp_dir) if tmp_dir else Path(tmp) / 'out'
+        stage_dir.mkdir(parents=True, exist_ok=True)
+
+        # remove stale output of an earlier run in a kept staging dir
+        for staged_fname in stage_dir.glob('*.json'):
+            if _untagged_name(staged_fname) in name2in:
+                staged_fname.unlink()
+
+        cmd = ' '.join([trans_exec, '--tag "{}"'.format(PREP_TAG),
+                        str(link_dir), str(stage_dir), trans_fname])
+        log.info('\n' + cmd)
+        proc = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT,
+                     universal_newlines=True)
+        lines = []
+        reader = Thread(target=lambda: lines.extend(proc.stdout))
+        reader.start()
+        # maps futures to name and size/mtime of their input file
+        futures = {}
+        # maps names of staged files to their size at the last check
+        sizes = {}
+        errors = []
+
+        def record_done(wait=False):
+            for future in list(futures):
+                if wait or future.done():
+                    name, stamp = futures.pop(future)
+                    try:
+                        future.result()
+                    except Exception as err:
+                        # raised after checking the exit code of the executable
+                        errors.append(err)
+                    else:
+                        manifest[name] = stamp
+
+        try:
+            with _executor(processes) as executor:
+                while True:
+                    exited = proc.poll() is not None
+
+                    if exited and proc.returncode:
+                        # staged files may be truncated, so leave them
+                        break
+
+                    for staged_fname in sorted(stage_dir.glob('*.json')):
+                        in_name = _untagged_name(staged_fname)
+
+                        if in_name not in name2in:
+                            continue
+
+                        # while the executable runs, a file is complete if
+                        # it stopped growing and holds a whole JSON array
+                        size = staged_fname.stat().st_size
+
+                        if not exited and (
+                                sizes.get(staged_fname.name) != size or
+                                not _is_complete_array(staged_fname)):
+                            sizes[staged_fname.name] = size
+                            continue
+
+                        in_fname = name2in.pop(in_name)
+                        out_fname = records.records_path(
+                            staged_fname, out_format, out_vars_dir)
+                        future = executor.submit(_filter_vars, staged_fname,
+                                                 out_fname)
+                        futures[future] = in_fname.name, _file_stamp(in_fname)
+
+                    record_done()
+
+                    if exited:
+                        break
+
+                    time.sleep(POLL_INTERVAL)
 
-    Path(out_vars_dir).mkdir(parents=True, exist_ok=True)
+                record_done(wait=True)
+        finally:
+            reader.join()
+            write_manifest(manifest_fname, manifest)
 
-    for in_vars_fname in Path(tmp_dir).glob('*.json'):
-        out_vars_fname = derive_path(in_vars_fname, new_dir=out_vars_dir)
+        log.info('\n{}'.format(''.join(lines)))
 
-        if resume and out_vars_fname.exists():
-            log.info('skipping existing preprocessed file {}'.format(out_vars_fname))
-            continue
+        if proc.returncode:
+            log.error('executable failed, so {} input files are not recorded '
+                      'as completed'.format(len(name2in)))
+            raise CalledProcessError(proc.returncode, cmd, ''.join(lines))
 
-        records = json.load(in_vars_fname.open())
-        # Remove any var that has descendents
-        # (i.e. from which a node was deleted)
-        # Also remove empty vars or "NP" vars
-        out_vars_records = [rec for rec in records
-                            if rec['subStr'] not in ['', 'NP'] and
-                            'descendants' not in rec]
-        if out_vars_records:
-            log.info('writing to preprocessed variable file {}'.format(out_vars_fname))
-            json.dump(out_vars_records, out_vars_fname.open('w'), indent=0)
-        else:
-            log.info('skipping empty preprocessed variable file {}'.format(out_vars_fname))
+        if errors:
+            raise errors[0]
+
+
+def _untagged_name(staged_fname):
+    """
+    Name of the input file of a file staged by the transformation
+    executable, which is named after it plus PREP_TAG
+    """
+    head, tag, tail = staged_fname.name.rpartition(PREP_TAG)
+    return head + tail if tag else staged_fname.name
+
+
+def _executor(processes):
+    if processes == 1:
+        return ThreadPoolExecutor(max_workers=1)
+    return ProcessPoolExecutor(max_workers=processes or None)
+
+
+def _is_complete_array(fname):
+    """
+    Check if file holds a whole JSON array, which the executable may still
+    be writing
+    """
+    with fname.open('rb') as f:
+        f.seek(0, 2)
+        f.seek(max(0, f.tell() - 16))
+
+        # cheap check first: a nested array may close at the end of a buffer
+        if not f.read().rstrip().endswith(b']'):
+            return False
+
+        f.seek(0)
+
+        try:
+            return isinstance(json.load(f), list)
+        except ValueError:
+            return False
+
+
+def _keep_var(rec):
+    # Remove any var that has descendents
+    # (i.e. from which a node was deleted)
+    # Also remove empty vars or "NP" vars
+    return rec['subStr'] not in ['', 'NP'] and 'descendants' not in rec
+
+
+def _filter_vars(in_vars_fname, out_vars_fname):
+    out_vars_records = filter(_keep_var, records.read_records(in_vars_fname))
+    first, out_vars_records = records.peek(out_vars_records)
+
+    if first is not None:
+        log.info('writing to preprocessed variable file {}'.format(out_vars_fname))
+        records.write_records(out_vars_fname, out_vars_records)
+    else:
+        log.info('skipping empty preprocessed variable file {}'.format(out_vars_fname))
+
+        # remove output of an earlier run, if any
+        if out_vars_fname.exists():
+            out_vars_fname.unlink()
 
 
 def prune_vars(prune_vars_exec, in_vars_dir, out_vars_dir, resume=False,
@@ -105,7 +286,115 @@ def prune_vars(prune_vars_exec, in_vars_dir, out_vars_dir, resume=False,
     log.info('\n{}'.format(ret))
 
 
-def add_offsets(vars_dir, scnlp_dir, resume=RESUME_OFFSET):
+def postproc_vars(vars_dir, scnlp_dir, trees_dir, trans_exec, trans_fname,
+                  prune_vars_exec, pruned_dir, tagged_dir,
+                  prune_options=PRUNE_OPTIONS, resume=RESUME_POSTPROC,
+                  processes=PROCESSES):
+    """
+    Add offsets to, preprocess, prune and tag variables in a single stage
+
+    Fuses add_offsets, preproc_vars, prune_vars and tag_var_nodes. Records
+    of each document are carried from one step to the next in memory, the
+    transformation and pruning executables each run once on a temporary dir
+    holding all documents, and only the final artifacts are written: pruned
+    variables and tagged trees. Extracted variables in vars_dir are left
+    untouched.
+
+    Parameters
+    ----------
+    vars_dir : str
+        directory of files with extracted variables
+    scnlp_dir : str
+        directory containing scnlp output, as for add_offsets
+    trees_dir : str
+        directory containing lemmatized parse trees
+    trans_exec : str
+        transformation executable, as for preproc_vars
+    trans_fname : str
+        file with tree transformations, as for preproc_vars
+    prune_vars_exec : str
+        pruning executable, as for prune_vars
+    pruned_dir : str
+        output directory for pruned variables
+    tagged_dir : str
+        output directory for tagged trees
+    prune_options : str
+        options for pruning executable
+    resume : bool
+        resume process, skipping files with extracted variables recorded as
+        completed in a manifest in pruned_dir and not modified since
+    processes : int
+        number of processes (0 means all cores)
+    """
+    pruned_dir = Path(pruned_dir)
+    pruned_dir.mkdir(parents=True, exist_ok=True)
+    Path(tagged_dir).mkdir(parents=True, exist_ok=True)
+    manifest_fname = pruned_dir / POSTPROC_MANIFEST_FNAME
+    manifest = read_manifest(manifest_fname)
+    var_files = records.record_files(vars_dir)
+
+    if resume:
+        var_files = [var_fname for var_fname in var_files
+                     if manifest.get(var_fname.name) != _file_stamp(var_fname)]
+        log.info('resuming with {} new or changed files'.format(
+            len(var_files)))
+
+    if not var_files:
+        return
+
+    with TemporaryDirectory() as tmp:
+        offsets_dir, prep_dir, filtered_dir = (
+            Path(tmp) / name for name in ('offsets', 'prep', 'filtered'))
+        offsets_dir.mkdir()
+        filtered_dir.mkdir()
+
+        process_files(_offsets_to_dir, var_files, Path(scnlp_dir),
+                      offsets_dir, processes=processes)
+
+        _run_exec([trans_exec, '--tag "{}"'.format(PREP_TAG),
+                   str(offsets_dir), str(prep_dir), trans_fname])
+
+        process_files(_filter_and_tag, records.record_files(prep_dir),
+                      filtered_dir, Path(trees_dir), Path(tagged_dir),
+                      processes=processes)
+
+        _run_exec([prune_vars_exec, prune_options or '', str(filtered_dir),
+                   str(pruned_dir)])
+
+    for var_fname in var_files:
+        manifest[var_fname.name] = _file_stamp(var_fname)
+
+    write_manifest(manifest_fname, manifest)
+
+
+def _offsets_to_dir(var_fname, scnlp_dir, out_dir):
+    rec, var_records = records.peek(records.read_records(var_fname))
+
+    if rec is not None:
+        # Java tools read json arrays only
+        records.write_records(records.records_path(var_fname, 'json', out_dir),
+                              _with_offsets(var_records, rec, scnlp_dir))
+
+
+def _filter_and_tag(prep_fname, filtered_dir, trees_dir, tagged_dir):
+    var_records = list(filter(_keep_var, records.read_records(prep_fname)))
+
+    if var_records:
+        records.write_records(filtered_dir / prep_fname.name, var_records)
+        rels.tag_file_var_nodes(var_records, trees_dir, tagged_dir)
+
+
+def _run_exec(parts):
+    cmd = ' '.join(parts)
+    log.info('\n' + cmd)
+    # universal_newlines=True is passed so the return value will be a string
+    # rather than bytes
+    ret = check_output(cmd, shell=True, stderr=STDOUT, universal_newlines=True)
+    log.info('\n{}'.format(ret))
+
+
+def add_offsets(vars_dir, scnlp_dir, resume=RESUME_OFFSET,
+                processes=PROCESSES):
     """
     Add character offsets to extracted variables
 
@@ -113,107 +402,107 @@ def add_offsets(vars_dir, scnlp_dir, resume=RESUME_OFFSET):
     variables. Offsets are absolute w.r.t. to the input text (abstract) to
     SCNLP.
 
+    Files are rewritten atomically, so a crash never leaves a partially
+    written file behind. Completed files are recorded in a manifest in
+    vars_dir, along with their size and modification time.
+
     Parameters
     ----------
     vars_dir : str
-        directory of files with extracted variables in json format
+        directory of files with extracted variables in json or json lines
+        format, which is preserved
     scnlp_dir : str or Path
-        directory containing scnlp output in xml format
+        directory containing scnlp output in xml or json format, read from
+        the annotation store instead if one exists
     resume: bool
-       resume process, skipping files that already have offsets
+       resume process, skipping files recorded as completed in the manifest
+       and not modified since
+    processes : int
+        number of processes (0 means all cores)
     """
-    scnlp_dir = Path(scnlp_dir)
-
-    for var_fname in Path(vars_dir).glob('*.json'):
-        records = json.load(var_fname.open())
+    manifest_fname = Path(vars_dir) / OFFSETS_MANIFEST_FNAME
+    manifest = read_manifest(manifest_fname)
+    var_files = records.record_files(vars_dir)
 
-        try:
-            rec = records[0]
-        except IndexError:
-            log.info('skipping file without extracted variables: {}'.format(var_fname))
-            continue
-
-        if (resume and records and
-                rec.get('charOffsetBegin') and
-                rec.get('charOffsetEnd')):
-            log.info('skipping file with existing offsets: {}'.format(var_fname))
-            continue
-
-        scnlp_fname = scnlp_dir / Path(rec['filename']).with_suffix('.xml')
-        xml_tree = etree.parse(scnlp_fname.open())
-        sentences_elem = xml_tree.find('.//sentences')
+    if resume:
+        var_files = [var_fname for var_fname in var_files
+                     if manifest.get(var_fname.name) != _file_stamp(var_fname)]
+        log.info('resuming with {} new or changed files'.format(
+            len(var_files)))
+
+    try:
+        for name, stamp in iter_process_files(_add_offsets, var_files,
+                                              Path(scnlp_dir),
+                                              processes=processes):
+            manifest[name] = stamp
+    finally:
+        write_manifest(manifest_fname, manifest)
+
+
+def _add_offsets(var_fname, scnlp_dir):
+    rec, var_records = records.peek(records.read_records(var_fname))
+
+    if rec is None:
+        log.info('skipping file without extracted variables: {}'.format(var_fname))
+        return var_fname.name, _file_stamp(var_fname)
+
+    log.info('adding offsets to file: {}'.format(var_fname))
+    records.write_records(var_fname, _with_offsets(var_records, rec,
+                                                   scnlp_dir))
+    return var_fname.name, _file_stamp(var_fname)
+
+
+def _with_offsets(var_records, rec, scnlp_dir):
+    scnlp_fname = scnlp_dir / Path(rec['filename']).with_suffix('.xml')
+    with scnlp.load_sentences(scnlp_fname) as sentences:
+        # also builds the offset index, if needed, for later use by vars_to_csv
+        index = scnlp.load_offset_index(scnlp_fname, sentences)
         tree_number = None
         node2indices = []
 
-        for rec in records:
+        for rec in var_records:
             if rec['treeNumber'] != tree_number:
                 tree_number = rec['treeNumber']
-                sent_elem = sentences_elem[int(tree_number) - 1]
-                tokens_elem = sent_elem.find('tokens')
-                parse = sent_elem.find('parse').text
-                node2indices = parse_pstree(parse, tokens_elem)
+                i = int(tree_number) - 1
+                node2indices = parse_pstree(sentences[i].parse,
+                                            index.begins(i), index.ends(i))
 
             indices = node2indices[rec['nodeNumber']]
             rec['charOffsetBegin'], rec['charOffsetEnd'] = indices
+            yield rec
+
+
+def _file_stamp(fname):
+    stat = fname.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def parse_pstree(parse, begins, ends):
+    """
+    Traverse phrase structure tree in labeled bracket format, mapping node
+    numbers to character offsets. The parse is a labeled brackets strings as
+    under <parse>...</parse> in the XML output by Stanford CoreNLP. The
+    corresponding token begin and end offsets are given as sequences of ints.
+
+    Nodes, including leaves, are numbered in preorder, where node 0 spans
+    the whole parse and node 1 is the top node of the tree. If the parse
+    holds more than one tree, node 0 is the parent of their top nodes. A
+    leaf gets the offsets of its token; a non-terminal starts where its
+    first child starts and ends where its last child ends.
+    """
+    node2offsets = {}
+    first_leaf = 0
+
+    for s in split_trees(parse, multiword_leaves=True):
+        tree = ParseTree.fromstring(s, multiword_leaves=True)
+        tree_begins = begins[first_leaf:]
+        tree_ends = ends[first_leaf:]
+        top = len(node2offsets) + 1
+
+        for n in range(len(tree)):
+            node2offsets[top + n] = tree.offsets(n, tree_begins, tree_ends)
+
+        first_leaf += tree.leaf_ends[0]
 
-        with var_fname.open('w') as outf:
-            log.info('adding offsets to file: {}'.format(var_fname))
-            json.dump(records, outf, indent=0)
-
-
-def parse_pstree(parse, tokens_elem):
-    """
-    Traverse phrase structure tree in labeled bracket format, storing
-    character offsets for each node in the node2offsets dict. The parse is a
-    labeled brackets strings as under <parse>...</parse> in the XML output by
-    Stanford CoreNLP. The corresponding tokens are the elements contained in
-    <tokens>...</tokens>.
-    """
-    # Construct a regexp that will tokenize the string.
-    open_b, close_b = '()'
-    open_pattern, close_pattern = (re.escape(open_b), re.escape(close_b))
-    node_pattern = '[^\s%s%s]+' % (open_pattern, close_pattern)
-    # leaf_pattern = '[^\s%s%s]+' % (open_pattern, close_pattern)
-    # Modified original leaf pattern from NLTK to accommodate case like
-    # (NP (NP (DT the) (CD 8 1/2) (NN day) (NN period))
-    # where the leaf "8 1/2" contains whitespace
-    leaf_pattern = '[^\s%s%s]+[^%s%s]*' % (open_pattern, close_pattern,
-                                           open_pattern, close_pattern)
-    symbol_re = re.compile('%s\s*(%s)?|%s|(%s)' % (
-        open_pattern, node_pattern, close_pattern, leaf_pattern), )
-
-    # Build an element tree to conveniently propagate offsets from child to
-    # parent nodes
-    parent = etree.Element('__ROOT__')
-    token_count = 0
-
-    for match in symbol_re.finditer(parse):
-        symbol = match.group()
-        # Beginning of a tree/subtree
-        if symbol[0] == open_b:
-            # create non-terminal node
-            child = etree.Element('node')
-            parent.append(child)
-            parent = child
-        # End of a tree/subtree
-        elif symbol == close_b:
-            parent = parent.getparent()
-            # Propagate character offsets upwards
-            parent.set('start', parent[0].get('start'))
-            parent.set('end', parent[-1].get('end'))
-        # Leaf node
-        else:
-            # Copy offsets from corresponding token
-            token = tokens_elem[token_count]
-            token_count += 1
-            start, end = token[2].text, token[3].text
-            # Propagate character offsets upwards
-            parent.set('start', start)
-            parent.set('end', end)
-            # create terminal node
-            child = etree.Element('node', start=start, end=end)
-            parent.append(child)
-
-    # Finally map node numbers to character offsets
-    return dict((n, (int(elem.get('start')), int(elem.get('end'))))
-                for n, elem in enumerate(parent.iter()))
+    node2offsets[0] = node2offsets[1][0], node2offsets[top][1]
+    return node2offsets
@@ -29,4 +29,11 @@ script(
               add_meta,
               clean,
               clean_cache,
-              report])
+              cache_failures,
+              report,
+              start_nlp_server,
+              stop_nlp_server,
+              standin_nlp_server,
+              ann_store,
+              nlp_quarantine,
+              postproc])
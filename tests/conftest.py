@@ -0,0 +1,40 @@
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+# make the baleen package importable without set_env.sh
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'lib'))
+
+from baleen import scnlp_server  # noqa: E402
+
+
+class FailingStandInHandler(scnlp_server.StandInHandler):
+    """
+    Stand-in CoreNLP server handler which fails on texts with the word
+    "crashnow"
+    """
+
+    def _respond(self, status, content, content_type):
+        if b'crashnow' in content:
+            status, content = 500, b'error'
+
+        super()._respond(status, content, content_type)
+
+
+@pytest.fixture
+def nlp_server():
+    """
+    Stand-in CoreNLP server on a free port, yielding its url
+
+    The server fails on texts with the word "crashnow".
+    """
+    server = ThreadingHTTPServer((scnlp_server.HOST, 0),
+                                 FailingStandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield scnlp_server.server_url(port=server.server_port)
+    server.shutdown()
+    server.server_close()
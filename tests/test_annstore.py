@@ -0,0 +1,42 @@
+"""
+tests for baleen.annstore
+"""
+
+from baleen import scnlp
+from baleen.annstore import AnnotationStore, Sentence, write_store
+
+SENTENCES = [
+    Sentence(['iron', 'cause', 'growth', '.'], [0, 5, 12, 18],
+             [4, 11, 18, 19],
+             '(ROOT (S (NP (NN Iron)) (VP (VBZ causes) (NP (NN growth))) '
+             '(. .)))'),
+    # without parse, e.g. a sentence too long for -parse.maxlen
+    Sentence(['∼0.6', 'mg'], [20, 25], [24, 27], None),
+    # without lemma annotator
+    Sentence([None, None], [28, 32], [31, 36], '(ROOT (NP (NN Tree) (NN s)))'),
+    Sentence([], [], [], None),
+]
+
+
+def test_store(tmp_path):
+    store_fname = tmp_path / 'doc.ann'
+    write_store(store_fname, SENTENCES)
+
+    with AnnotationStore(store_fname) as store:
+        assert len(store) == len(SENTENCES)
+        assert list(store) == SENTENCES
+        assert store[-3] == SENTENCES[1]
+
+
+def test_convert_to_store_without_parse(nlp_server, tmp_path):
+    in_dir, out_dir = tmp_path / 'in', tmp_path / 'out'
+    in_dir.mkdir()
+    (in_dir / 'a.txt').write_text('Iron causes growth. It does.')
+    scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), stamp=False,
+                   annotators='tokenize,ssplit', server=nlp_server)
+    scnlp.convert_to_store(str(out_dir))
+
+    with scnlp.load_sentences(out_dir / 'a.xml') as sentences:
+        assert isinstance(sentences, AnnotationStore)
+        assert [sent.parse for sent in sentences] == [None, None]
+        assert sentences[1].lemmas == [None, None, None]
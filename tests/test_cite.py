@@ -0,0 +1,179 @@
+"""
+tests for baleen.cite, against a local stand-in for CrossRef
+"""
+
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from baleen import cite
+
+METADATA = {'title': 'Iron causes growth', 'ISSN': ['1234-5678']}
+JOURNAL = {'message': {'title': 'Journal', 'publisher': 'Publisher'}}
+
+
+class StandInCrossRef(ThreadingHTTPServer):
+    """
+    Stand-in for CrossRef, where responses maps request paths to a list of
+    (status, headers, body) responses, which are given in turn, the last one
+    on any further request
+    """
+
+    def __init__(self):
+        super().__init__(('localhost', 0), StandInCrossRefHandler)
+        self.responses = {}
+        self.hits = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://localhost:{}/'.format(self.server_port)
+
+
+class StandInCrossRefHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            path = self.path.lstrip('/')
+            self.server.hits[path] += 1
+            responses = self.server.responses.get(path, [(404, {}, b'')])
+            status, headers, body = responses[
+                min(self.server.hits[path], len(responses)) - 1]
+
+        self.send_response(status)
+
+        for key, value in headers.items():
+            self.send_header(key, value)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def crossref():
+    server = StandInCrossRef()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher(crossref):
+    return cite.Fetcher(rate_limit=0, attempts=4, backoff=0.01,
+                        max_backoff=2, doi_url=crossref.url + 'doi/',
+                        issn_url=crossref.url + 'issn/')
+
+
+def _ok(content):
+    return 200, {}, json.dumps(content).encode('utf-8')
+
+
+def test_retry_after(crossref, fetcher):
+    crossref.responses['doi/10.1/a'] = [(429, {'Retry-After': '1'}, b''),
+                                        _ok(METADATA)]
+    started = time.time()
+    assert cite.fetch_doi_metadata('10.1/a', fetcher) == METADATA
+    assert time.time() - started >= 1
+    assert crossref.hits['doi/10.1/a'] == 2
+
+
+def test_retry_after_beyond_max_backoff(crossref, fetcher):
+    # rather than waiting an hour, the request fails right away
+    crossref.responses['doi/10.1/a'] = [(429, {'Retry-After': '3600'}, b''),
+                                        _ok(METADATA)]
+    started = time.time()
+
+    with pytest.raises(cite.FetchError) as excinfo:
+        cite.fetch_doi_metadata('10.1/a', fetcher)
+
+    assert excinfo.value.status == 429
+    assert time.time() - started < 1
+    assert crossref.hits['doi/10.1/a'] == 1
+
+
+def test_server_error_then_success(crossref, fetcher):
+    crossref.responses['doi/10.1/a'] = [(503, {}, b''), (502, {}, b''),
+                                        _ok(METADATA)]
+    assert cite.fetch_doi_metadata('10.1/a', fetcher) == METADATA
+    assert crossref.hits['doi/10.1/a'] == 3
+
+
+def test_server_error(crossref, fetcher):
+    crossref.responses['doi/10.1/a'] = [(500, {}, b'')]
+
+    with pytest.raises(cite.FetchError) as excinfo:
+        cite.fetch_doi_metadata('10.1/a', fetcher)
+
+    assert excinfo.value.status == 500
+    assert crossref.hits['doi/10.1/a'] == fetcher.attempts
+
+
+def test_not_found(crossref, fetcher):
+    with pytest.raises(cite.FetchError) as excinfo:
+        cite.fetch_doi_metadata('10.1/a', fetcher)
+
+    assert excinfo.value.status == 404
+    assert cite.is_permanent(excinfo.value.status)
+    assert crossref.hits['doi/10.1/a'] == 1
+
+
+@pytest.mark.parametrize('body', [b'<html>Maintenance</html>', b'[]'])
+def test_invalid_json(crossref, fetcher, body):
+    crossref.responses['doi/10.1/a'] = [(200, {}, body)]
+    crossref.responses['issn/1234-5678'] = [(200, {}, body)]
+
+    with pytest.raises(cite.FetchError):
+        cite.fetch_doi_metadata('10.1/a', fetcher)
+
+    with pytest.raises(cite.FetchError):
+        cite.fetch_issn_metadata('1234-5678', fetcher)
+
+
+def test_rate_limit(crossref, fetcher):
+    crossref.responses['doi/10.1/a'] = [_ok(METADATA)]
+    fetcher.rate_limit = 20
+    started = time.time()
+
+    for _ in range(10):
+        cite.fetch_doi_metadata('10.1/a', fetcher)
+
+    # the first request goes right away
+    assert time.time() - started >= 9 / 20
+
+
+def test_prefetch(crossref, fetcher, tmp_path):
+    crossref.responses.update({
+        'doi/10.1/a': [(503, {}, b''), _ok(METADATA)],
+        'doi/10.1/b': [(200, {}, b'<html>Maintenance</html>')],
+        'issn/1234-5678': [_ok(JOURNAL)]})
+    meta_cache = cite.get_cache(str(tmp_path / 'meta'))
+    cit_cache = cite.get_cache(str(tmp_path / 'cit'))
+
+    # failures do not abort prefetch, and client errors are not requested
+    # again
+    for _ in range(2):
+        cite.prefetch(['10.1/a', '10.1/b', '10.1/c'], meta_cache, cit_cache,
+                      fetcher)
+
+    assert meta_cache['10.1/a'] == METADATA
+    assert meta_cache['1234-5678'] == JOURNAL['message']
+    assert cite.get_all_metadata('10.1/a', meta_cache, online=False)[
+        'journal'] == 'Journal'
+    assert {key: (status, reason) for key, status, reason, *_
+            in meta_cache.failures()} == {'10.1/b': (200, 'invalid JSON'),
+                                          '10.1/c': (404, 'Not Found')}
+    # the stand-in gives the same response for citations
+    assert cit_cache['10.1/a'] == json.dumps(METADATA)
+    # one request for metadata and one for the citation, in the first run
+    assert crossref.hits['doi/10.1/c'] == 2
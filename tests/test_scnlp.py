@@ -0,0 +1,142 @@
+"""
+tests for baleen.scnlp
+"""
+
+import os
+import sys
+import time
+from subprocess import CalledProcessError
+
+import pytest
+
+from baleen import scnlp
+from baleen.utils import read_manifest
+
+OUT_NAME = '{}#scnlp_v3.5.1.xml'
+
+
+def _write_texts(in_dir, texts):
+    in_dir.mkdir(exist_ok=True)
+
+    for name, text in texts.items():
+        (in_dir / name).write_text(text, encoding='utf-8')
+
+
+def test_core_nlp_records_only_new_outputs(nlp_server, tmp_path):
+    in_dir, out_dir = tmp_path / 'in', tmp_path / 'out'
+    _write_texts(in_dir, {'a.txt': 'Iron causes growth.',
+                          'b.txt': 'This crashnow text fails.'})
+    # complete output of b left over from an earlier run, with a timestamp
+    # which is not older than the start of the next run (as on file systems
+    # with coarse timestamps)
+    out_dir.mkdir()
+    leftover = out_dir / OUT_NAME.format('b')
+    leftover.write_text('<root>\n</root>\n')
+    future = time.time() + 60
+    os.utime(str(leftover), (future, future))
+
+    scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), version='3.5.1',
+                   server=nlp_server, resume=True, isolate=True)
+
+    manifest = read_manifest(out_dir / scnlp.MANIFEST_FNAME)
+    assert sorted(manifest) == [OUT_NAME.format('a')]
+    assert sorted(scnlp.read_quarantine(str(out_dir))) == [
+        str(in_dir / 'b.txt')]
+
+
+def test_read_newest_output(nlp_server, tmp_path):
+    in_dir, out_dir = tmp_path / 'in', tmp_path / 'out'
+    _write_texts(in_dir, {'a.txt': 'Iron causes growth.'})
+    scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), stamp=False,
+                   annotators='tokenize,ssplit', server=nlp_server)
+    # rerun with other annotators and output format
+    _write_texts(in_dir, {'a.txt': 'Iron causes growth.'})
+    scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), stamp=False,
+                   output_format='json', server=nlp_server)
+    xml_fname, json_fname = out_dir / 'a.xml', out_dir / 'a.json'
+    past = time.time() - 60
+    os.utime(str(xml_fname), (past, past))
+
+    assert scnlp.annotation_path(xml_fname) == json_fname
+    assert scnlp.annotation_files(str(out_dir)) == [str(json_fname)]
+    sent, = scnlp.read_sentences(xml_fname)
+    assert sent.lemmas == ['iron', 'causes', 'growth', '.']
+
+    os.utime(str(json_fname), (past - 60, past - 60))
+    assert scnlp.annotation_path(json_fname) == xml_fname
+    assert scnlp.annotation_files(str(out_dir)) == [str(xml_fname)]
+
+
+# stand-in for java running CoreNLP, which writes a trivial output file for
+# each input file, but runs out of memory on inputs with the word "oom" and
+# fails on inputs with the word "crashnow"; any option -fail makes it fail
+# right away
+FAKE_JAVA = '''#!{python}
+import sys
+from pathlib import Path
+
+args = sys.argv[1:]
+if '-fail' in args:
+    sys.exit('Error: could not find or load main class')
+opts = dict(zip(args, args[1:]))
+for fname in Path(opts['-filelist']).read_text().split():
+    text = Path(fname).read_text()
+    if 'oom' in text:
+        print('Terminating due to java.lang.OutOfMemoryError: Java heap space')
+        sys.exit(3)
+    if 'crashnow' in text:
+        sys.exit('Exception in thread "main" java.lang.RuntimeException')
+    out_fname = Path(opts['-outputDirectory']) / (
+        Path(fname).stem + opts['-outputExtension'])
+    out_fname.write_text('<root>\\n</root>\\n')
+'''
+
+
+@pytest.fixture
+def fake_java(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    java = bin_dir / 'java'
+    java.write_text(FAKE_JAVA.format(python=sys.executable))
+    java.chmod(0o755)
+    monkeypatch.setenv('PATH',
+                       str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_core_nlp_isolate(fake_java, tmp_path, threads):
+    in_dir, out_dir = tmp_path / 'in', tmp_path / 'out'
+    texts = {'{}.txt'.format(i): 'Iron causes growth.' for i in range(6)}
+    texts['2.txt'] = 'An oom text.'
+    _write_texts(in_dir, texts)
+
+    scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), stamp=False,
+                   isolate=True, threads=threads)
+
+    assert sorted(fname.name for fname in out_dir.glob('*.xml')) == [
+        '0.xml', '1.xml', '3.xml', '4.xml', '5.xml']
+    assert scnlp.read_quarantine(str(out_dir)) == {
+        str(in_dir / '2.txt'): 'out of memory'}
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_core_nlp_isolate_raises(fake_java, tmp_path, threads):
+    # a document making CoreNLP exit with an ordinary error is not
+    # quarantined
+    in_dir, out_dir = tmp_path / 'in', tmp_path / 'out'
+    texts = {'{}.txt'.format(i): 'Iron causes growth.' for i in range(6)}
+    texts['2.txt'] = 'A crashnow text.'
+    _write_texts(in_dir, texts)
+
+    with pytest.raises(CalledProcessError):
+        scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), stamp=False,
+                       isolate=True, threads=threads)
+
+    assert scnlp.read_quarantine(str(out_dir)) == {}
+
+    # neither is any document when CoreNLP fails to start
+    with pytest.raises(CalledProcessError):
+        scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), stamp=False,
+                       isolate=True, threads=threads, options='-fail')
+
+    assert scnlp.read_quarantine(str(out_dir)) == {}
@@ -0,0 +1,102 @@
+"""
+tests for baleen.scnlp_server
+"""
+
+import os
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+import requests
+
+from baleen import scnlp, scnlp_server
+
+LIB_DIR = Path(__file__).resolve().parents[1] / 'lib'
+
+# stand-in for java, which runs the stand-in server on the port given by the
+# -port option of StanfordCoreNLPServer
+FAKE_JAVA = '''#!/bin/sh
+while [ "$1" != -port ]; do shift; done
+exec "{python}" -c "import sys; from baleen import scnlp_server; \\
+scnlp_server.run_standin_server(port=int(sys.argv[1]))" "$2"
+'''
+
+
+def _write_texts(in_dir, texts):
+    in_dir.mkdir(exist_ok=True)
+
+    for name, text in texts.items():
+        (in_dir / name).write_text(text, encoding='utf-8')
+
+
+def _mtimes(out_dir):
+    return {fname.name: fname.stat().st_mtime_ns
+            for fname in out_dir.glob('*.xml')}
+
+
+def test_core_nlp_server(nlp_server, tmp_path):
+    in_dir, out_dir = tmp_path / 'in', tmp_path / 'out'
+    _write_texts(in_dir, {'a.txt': 'Iron causes growth.',
+                          'b.txt': 'Light limits growth. It does.'})
+
+    def run():
+        scnlp.core_nlp(str(in_dir), out_dir=str(out_dir), version='3.5.1',
+                       server=nlp_server, resume=True)
+
+    run()
+    mtimes = _mtimes(out_dir)
+    assert sorted(mtimes) == ['a#scnlp_v3.5.1.xml', 'b#scnlp_v3.5.1.xml']
+    assert all(scnlp.is_complete(out_dir / name) for name in mtimes)
+    sentences = list(scnlp.read_sentences(out_dir / 'b#scnlp_v3.5.1.xml'))
+    assert [sent.lemmas for sent in sentences] == [
+        ['light', 'limits', 'growth', '.'], ['it', 'does', '.']]
+
+    # resume skips up-to-date outputs, but redoes changed inputs
+    run()
+    assert _mtimes(out_dir) == mtimes
+    _write_texts(in_dir, {'a.txt': 'Iron causes more growth.'})
+    run()
+    new_mtimes = _mtimes(out_dir)
+    assert new_mtimes['a#scnlp_v3.5.1.xml'] != mtimes['a#scnlp_v3.5.1.xml']
+    assert new_mtimes['b#scnlp_v3.5.1.xml'] == mtimes['b#scnlp_v3.5.1.xml']
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def test_start_server_with_stale_pid_file(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    java = bin_dir / 'java'
+    java.write_text(FAKE_JAVA.format(python=sys.executable))
+    java.chmod(0o755)
+    monkeypatch.setenv('PATH',
+                       str(bin_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('PYTHONPATH', str(LIB_DIR))
+
+    port = _free_port()
+    # pid file left behind by a crashed server
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    pid_fname = tmp_path / 'baleen-scnlp-server-{}.pid'.format(port)
+    pid_fname.write_text(str(dead.pid))
+
+    pid = scnlp_server.start_server('', port=port, state_dir=str(tmp_path),
+                                    wait=30)
+
+    try:
+        assert pid != dead.pid
+        assert pid_fname.read_text() == str(pid)
+        url = scnlp_server.server_url(port=port)
+        assert requests.get(url + '/live').ok
+        # a running server is reused
+        assert scnlp_server.start_server('', port=port,
+                                         state_dir=str(tmp_path)) == pid
+    finally:
+        scnlp_server.stop_server(port=port, state_dir=str(tmp_path))
+
+    assert not pid_fname.exists()
@@ -0,0 +1,54 @@
+"""
+tests for baleen.sentcache
+"""
+
+from baleen import scnlp, sentcache
+from baleen.utils import read_manifest
+
+OUT_NAME = '{}#scnlp_v3.5.1.xml'
+
+
+def _write_texts(in_dir, texts):
+    in_dir.mkdir(exist_ok=True)
+
+    for name, text in texts.items():
+        (in_dir / name).write_text(text, encoding='utf-8')
+
+
+def _mtimes(out_dir):
+    return {fname.name: fname.stat().st_mtime_ns
+            for fname in out_dir.glob('*.xml')}
+
+
+def test_parse_sent_cached(nlp_server, tmp_path):
+    in_dir, out_dir = tmp_path / 'in', tmp_path / 'out'
+    _write_texts(in_dir, {'a.txt': 'Iron causes growth.\nLight too.\n',
+                          'b.txt': 'Light too.\nNot this crashnow line.\n'})
+
+    def run(**kwargs):
+        sentcache.parse_sent_cached(str(in_dir), tmp_path / 'cache.sqlite',
+                                    out_dir=str(out_dir), version='3.5.1',
+                                    server=nlp_server, resume=True,
+                                    isolate=True, lines_per_file=1,
+                                    **kwargs)
+
+    run()
+    mtimes = _mtimes(out_dir)
+    assert sorted(mtimes) == [OUT_NAME.format('a')]
+    sentences = list(scnlp.read_sentences(out_dir / OUT_NAME.format('a')))
+    assert [sent.begins[0] for sent in sentences] == [0, 20]
+    # outputs are recorded in the manifest and documents with failing
+    # sentences in the quarantine file, as by core_nlp
+    assert sorted(read_manifest(out_dir / scnlp.MANIFEST_FNAME)) == [
+        OUT_NAME.format('a')]
+    assert sorted(scnlp.read_quarantine(str(out_dir))) == [
+        str(in_dir / 'b.txt')]
+
+    # resume skips up-to-date outputs and quarantined documents
+    run()
+    assert _mtimes(out_dir) == mtimes
+    assert not (out_dir / OUT_NAME.format('b')).exists()
+
+    # but redoes outputs for other options
+    run(options='-ssplit.eolonly -parse.maxlen 80')
+    assert _mtimes(out_dir) != mtimes
@@ -0,0 +1,54 @@
+"""
+tests for baleen.treepat
+"""
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from baleen import rels, treepat
+
+DATA_DIR = Path(__file__).parent / 'data'
+PATTERNS_FNAME = Path(__file__).parents[1] / 'patterns' / 'cause.ini'
+TREES_FNAME = DATA_DIR / 'cause_trees.txt'
+
+
+def _read_patterns():
+    pat_defs = rels.read_patterns(PATTERNS_FNAME)
+    return [(pat_name, items['pattern'].strip())
+            for pat_name, items in pat_defs.items()
+            if pat_name != 'DEFAULT']
+
+
+def _match_file(patterns):
+    compiled = [treepat.compile_pattern(pattern) for _, pattern in patterns]
+    return treepat.match_file(TREES_FNAME, compiled)
+
+
+def test_match_file():
+    # Tagged trees in cause_trees.txt exercise each pattern in cause.ini,
+    # including a variable node that dominates the anchor word (t12a), which
+    # neither precedes nor follows it. The expected matches in
+    # cause_matches.json follow Tregex's semantics for these patterns.
+    patterns = _read_patterns()
+    expected = json.loads((DATA_DIR / 'cause_matches.json').read_text())
+    assert sorted(expected) == sorted(name for name, _ in patterns)
+
+    for (name, _), matches in zip(patterns, _match_file(patterns)):
+        assert sorted(matches) == sorted(map(tuple, expected[name])), name
+
+
+@pytest.mark.skipif(not (os.environ.get('CORENLP_HOME') and
+                         shutil.which('java')),
+                    reason='requires java and Stanford CoreNLP jars in '
+                           'CORENLP_HOME')
+def test_match_file_tregex():
+    patterns = _read_patterns()
+
+    for (name, pattern), matches in zip(patterns, _match_file(patterns)):
+        tregex_matches = rels.tregex(os.environ['CORENLP_HOME'], TREES_FNAME,
+                                     pattern)
+        assert sorted(matches) == sorted(tregex_matches), name
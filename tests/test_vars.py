@@ -0,0 +1,92 @@
+"""
+tests for baleen.vars
+"""
+
+import json
+import sys
+from pathlib import Path
+
+from baleen import scnlp, vars
+
+DATA_DIR = Path(__file__).parent / 'data'
+
+
+def test_parse_pstree():
+    # Golden test on CoreNLP parses and token offsets of the text in
+    # offsets.txt, covering bracket tokens, non-ASCII tokens and a token
+    # with whitespace ("8 1/2"). The expected node offsets in
+    # offsets_expected.json were produced by the original lxml-based
+    # implementation. (Not named offsets.json, as it would then be read as
+    # newer CoreNLP output than offsets.xml.)
+    text = (DATA_DIR / 'offsets.txt').read_text(encoding='utf-8')
+    sentences = list(scnlp.read_sentences(DATA_DIR / 'offsets.xml'))
+    expected = json.loads((DATA_DIR / 'offsets_expected.json').read_text())
+    assert len(sentences) == len(expected)
+
+    for sent, node2offsets in zip(sentences, expected):
+        node2offsets = {int(n): tuple(offsets)
+                        for n, offsets in node2offsets.items()}
+        assert vars.parse_pstree(sent.parse, sent.begins,
+                                 sent.ends) == node2offsets
+        # node 0 spans the whole sentence, which is a line of the text
+        begin, end = node2offsets[0]
+        assert text[begin:end] in text.splitlines()
+
+
+def test_parse_pstree_multiple_trees():
+    # node 0 is the parent of the top nodes of both trees
+    parse = '(ROOT (NP (NN Iron))) (ROOT (S (NP (NN 8 1/2)) (VB grows)))'
+    begins = [0, 5, 11]
+    ends = [4, 10, 16]
+    assert vars.parse_pstree(parse, begins, ends) == {
+        0: (0, 16),
+        1: (0, 4), 2: (0, 4), 3: (0, 4), 4: (0, 4),
+        5: (5, 16), 6: (5, 16), 7: (5, 10), 8: (5, 10), 9: (5, 10),
+        10: (11, 16), 11: (11, 16)}
+
+
+# stand-in for the transformation executable, which writes each input file
+# to the output dir under its name plus the tag, marking variables with the
+# word "the" as having a deleted node
+FAKE_TRANS = '''#!{python}
+import json
+import sys
+from pathlib import Path
+
+tag, in_dir, out_dir = sys.argv[2:5]
+Path(out_dir).mkdir(parents=True, exist_ok=True)
+for fname in Path(in_dir).glob('*.json'):
+    recs = json.loads(fname.read_text())
+    for rec in recs:
+        if 'the' in rec['subStr'].split():
+            rec['descendants'] = []
+    (Path(out_dir) / (fname.stem + tag + '.json')).write_text(json.dumps(recs))
+'''
+
+
+def test_preproc_vars_same_doi(tmp_path):
+    # vars files of different sources for the same DOI
+    in_dir, out_dir = tmp_path / 'vars', tmp_path / 'prep'
+    in_dir.mkdir()
+    names = ['10.1000%2Fx#abs#scnlp_v3.5.1#vars.json',
+             '10.1000%2Fx#full#scnlp_v3.5.1#vars.json']
+
+    for name, sub_str in zip(names, ['iron', 'light']):
+        (in_dir / name).write_text(json.dumps(
+            [{'subStr': sub_str}, {'subStr': 'the ' + sub_str}]))
+
+    trans_exec = tmp_path / 'trans'
+    trans_exec.write_text(FAKE_TRANS.format(python=sys.executable))
+    trans_exec.chmod(0o755)
+
+    vars.preproc_vars(str(trans_exec), 'trans.tfm', str(in_dir),
+                      str(out_dir), tmp_dir=str(tmp_path / 'stage'))
+
+    for name, sub_str in zip(names, ['iron', 'light']):
+        out_fname = out_dir / name.replace('#vars', '#vars#prep')
+        assert json.loads(out_fname.read_text()) == [{'subStr': sub_str}]
+
+    # both input files are recorded as completed
+    manifest = json.loads(
+        (out_dir / vars.PREP_MANIFEST_FNAME).read_text())
+    assert sorted(manifest) == names